@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import queue
+import traceback
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+    Sequence,
+)
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiomultiprocess.core import Process
+from aiomultiprocess.pool import CHILD_CONCURRENCY, MAX_TASKS_PER_CHILD, Pool, PoolWorker
+from aiomultiprocess.scheduler import Scheduler
+from aiomultiprocess.types import (
+    LoopInitializer,
+    PoolTask,
+    Queue,
+    QueueID,
+    TaskID,
+)
+from data_pipeline.concurrency import AIMDConcurrency
+from data_pipeline.journal import DONE, download_journal, run_tracked, task_key
+from data_pipeline.landing_zone import close_landing_zone_writers, parquet_enabled
+from data_pipeline.manifest import commit_download_manifest
+from data_pipeline.stream import close_stream_uploaders, stream_enabled
+from data_pipeline.task_feed import TaskFeed
+
+log = logging.getLogger(__name__)
+
+JOURNAL_BATCH = 100  # finished tasks journaled at once, after their files are committed to the manifest
+
+
+class DownloadWorker(PoolWorker):
+    """Pool worker for the api download pools.
+    The number of in-flight requests is not fixed. `concurrency` is the starting point and an AIMD controller
+    raises it toward `max_concurrency` while the API is healthy and cuts it back when it is overloaded.
+
+    With a `journal_name`, the key of every task that finished without a failed request is journaled,
+    once its data is written out, so that an interrupted download can resume.
+    The tasks it received but didn't start when it exits go on the `returned` queue,
+    which the workers of the same queue take tasks from before `tx`."""
+
+    def __init__(
+        self,
+        tx: Queue,
+        rx: Queue,
+        concurrency: int = CHILD_CONCURRENCY,
+        ttl: int = MAX_TASKS_PER_CHILD,
+        *,
+        initializer: Optional[Callable] = None,
+        initargs: Sequence[Any] = (),
+        loop_initializer: Optional[LoopInitializer] = None,
+        exception_handler: Optional[Callable[[BaseException], None]] = None,
+        init_client_session: bool = False,
+        session_base_url: Optional[str] = None,
+        max_concurrency: Optional[int] = None,
+        journal_name: Optional[str] = None,
+        returned: Optional[Queue] = None,
+    ) -> None:
+        super().__init__(
+            tx=tx,
+            rx=rx,
+            ttl=ttl,
+            concurrency=concurrency,
+            initializer=initializer,
+            initargs=initargs,
+            loop_initializer=loop_initializer,
+            exception_handler=exception_handler,
+            init_client_session=init_client_session,
+            session_base_url=session_base_url,
+        )
+        self.concurrency_control = AIMDConcurrency(initial=self.concurrency, maximum=max_concurrency)
+        self.journal_name = journal_name
+        self.returned = returned
+        self.task_keys: Dict[TaskID, str] = {}  # keys of the pending tasks, taken before they run
+        self.finished_tasks: list[tuple[str, str]] = []  # (key, status) of the finished tasks not yet journaled
+
+    def start_task(
+        self,
+        tid: TaskID,
+        func: Callable,
+        args: Sequence[Any],
+        kwargs: Dict[str, Any],
+        client_session: ClientSession,
+    ) -> asyncio.Future:
+        """Starts the task with the client session added to its args. Returns its future.
+        The future's result is (result, failed), see `run_tracked()`"""
+        if self.journal_name:
+            self.task_keys[tid] = task_key(args)  # NOTE: before the task runs, as it may modify its payload
+        args = [*args, client_session]  # NOTE: adds client session to the args list
+        return asyncio.ensure_future(run_tracked(func(*args, **kwargs)))
+
+    def task_finished(self, tid: TaskID, failed: bool, status: str = DONE):
+        """Queues the task's key to be journaled, unless one of its requests failed"""
+        key = self.task_keys.pop(tid, None)
+        if key is not None and not failed:
+            self.finished_tasks.append((key, status))
+
+    def journal_finished_tasks(self):
+        """Journals the tasks finished since the last call. Only call once their data is written out"""
+        if self.journal_name and self.finished_tasks:
+            # NOTE: a journaled task is skipped on resume, so its file must be in the manifest first
+            commit_download_manifest()
+            download_journal(self.journal_name).record_many(self.finished_tasks)
+            self.finished_tasks = []
+
+    async def wait_for_work(
+        self, feed: TaskFeed, pending: Dict[asyncio.Future, TaskID], running: bool
+    ) -> set[asyncio.Future]:
+        """Sleeps until a task arrives (if there is an open slot for it) or a running task finishes.
+        Returns the finished tasks"""
+        waiters = set(pending)
+        arrival = None
+        if running and len(pending) < self.concurrency_control.limit:
+            arrival = asyncio.ensure_future(feed.ready.wait())
+            waiters.add(arrival)
+        if not waiters:
+            return set()
+        done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        if arrival is not None:
+            arrival.cancel()
+            done.discard(arrival)
+        return done
+
+    async def close_feed(self, feed: TaskFeed):
+        """Stops the task feed. The tasks it received that the worker didn't start are handed back
+        on the `returned` queue, so the next worker of the queue takes them first, in their order"""
+        for task in await feed.close():
+            (self.returned if self.returned is not None else self.tx).put_nowait(task)
+
+    def client_session(self) -> ClientSession:
+        """ClientSession for the worker. Every request made with it is reported to the concurrency controller"""
+        return ClientSession(
+            connector=TCPConnector(
+                limit_per_host=max(100, self.concurrency_control.maximum), use_dns_cache=True
+            ),
+            timeout=ClientTimeout(total=90),
+            base_url=self.session_base_url if self.session_base_url else None,
+            trace_configs=[self.concurrency_control.trace_config()],
+        )
+
+    async def run(self):
+        if self.init_client_session:
+            async with self.client_session() as client_session:
+                feed = TaskFeed(self.tx, self.returned)
+                pending: Dict[asyncio.Future, TaskID] = {}
+                completed: int = 0
+                running = True
+                while running or pending:
+                    # TTL, Tasks To Live, determines how many tasks to execute before dying
+                    if self.ttl and completed >= self.ttl:
+                        running = False
+
+                    # pick up new work as long as we're "running" and we have open slots
+                    while running and len(pending) < self.concurrency_control.limit:
+                        feed.request(self.concurrency_control.limit - len(pending))
+                        try:
+                            task: PoolTask = feed.get_nowait()
+                        except queue.Empty:
+                            break
+
+                        if task is None:
+                            running = False
+                            break
+
+                        tid, func, args, kwargs = task
+                        future = self.start_task(tid, func, args, kwargs, client_session)
+                        pending[future] = tid
+
+                    # return results and/or exceptions when completed
+                    done = await self.wait_for_work(feed, pending, running)
+                    for future in done:
+                        tid = pending.pop(future)
+
+                        result = None
+                        tb = None
+                        try:
+                            result, failed = future.result()
+                            self.task_finished(tid, failed)
+                        except BaseException as e:
+                            self.task_keys.pop(tid, None)
+                            if self.exception_handler is not None:
+                                self.exception_handler(e)
+
+                            tb = traceback.format_exc()
+                        self.rx.put_nowait((tid, result, tb))
+                        completed += 1
+
+                    # NOTE: parquet rows and streamed batches are written out when the worker closes them
+                    written_out = not (parquet_enabled() or stream_enabled())
+                    if written_out and len(self.finished_tasks) >= JOURNAL_BATCH:
+                        self.journal_finished_tasks()
+
+                await self.close_feed(feed)
+
+            close_landing_zone_writers()  # NOTE: writes out the rows still buffered before the process exits
+            if await close_stream_uploaders():  # NOTE: if a batch failed to upload, all tasks are run again
+                self.journal_finished_tasks()
+            commit_download_manifest()
+            log.info(
+                f"worker finished: processed {completed} tasks, "
+                f"final in-flight limit {self.concurrency_control.limit}"
+            )
+        else:
+            await super().run()
+
+
+class DownloadPool(Pool):
+    """Process pool for the api downloads. Creates DownloadWorkers with adaptive request concurrency.
+    `childconcurrency` is each worker's starting in-flight limit and `max_childconcurrency` its ceiling.
+    `journal_name` is the download journal the workers record the finished tasks in, if any.
+    Each queue has a `returned` queue, for the tasks a worker received but didn't start before it exited."""
+
+    def __init__(
+        self,
+        processes: int = None,
+        initializer: Callable[..., None] = None,
+        initargs: Sequence[Any] = (),
+        maxtasksperchild: int = MAX_TASKS_PER_CHILD,
+        childconcurrency: int = CHILD_CONCURRENCY,
+        queuecount: Optional[int] = None,
+        scheduler: Optional[Scheduler] = None,
+        loop_initializer: Optional[LoopInitializer] = None,
+        exception_handler: Optional[Callable[[BaseException], None]] = None,
+        init_client_session: bool = False,
+        session_base_url: Optional[str] = None,
+        max_childconcurrency: Optional[int] = None,
+        journal_name: Optional[str] = None,
+    ) -> None:
+        self.max_childconcurrency = max_childconcurrency
+        self.journal_name = journal_name
+        self.returned: Dict[QueueID, Queue] = {}
+        super().__init__(
+            processes=processes,
+            initializer=initializer,
+            initargs=initargs,
+            maxtasksperchild=maxtasksperchild,
+            childconcurrency=childconcurrency,
+            queuecount=queuecount,
+            scheduler=scheduler,
+            loop_initializer=loop_initializer,
+            exception_handler=exception_handler,
+            init_client_session=init_client_session,
+            session_base_url=session_base_url,
+        )
+
+    def create_worker(
+        self,
+        qid: QueueID,
+    ) -> Process:
+        """
+        Create a worker process attached to the given transmit and receive queues.
+
+        :meta private:
+        """
+        tx, rx = self.queues[qid]
+        process = DownloadWorker(
+            tx,
+            rx,
+            self.childconcurrency,
+            ttl=self.maxtasksperchild,
+            initializer=self.initializer,
+            initargs=self.initargs,
+            loop_initializer=self.loop_initializer,
+            exception_handler=self.exception_handler,
+            init_client_session=self.init_client_session,
+            session_base_url=self.session_base_url,
+            max_concurrency=self.max_childconcurrency,
+            journal_name=self.journal_name,
+            returned=self.returned_queue(qid),
+        )
+        process.start()
+        return process
+
+    def returned_queue(self, qid: QueueID) -> Queue:
+        """The queue the workers of the queue hand back the tasks they received but didn't start"""
+        if qid not in self.returned:
+            self.returned[qid] = self.context.Queue()
+        return self.returned[qid]
@@ -1,19 +1,21 @@
 import asyncio
 import logging
+import os
 import queue
 import traceback
+from collections import Counter, deque
 from typing import (
     Any,
     Awaitable,
     Callable,
     Dict,
+    Iterable,
     Optional,
     Sequence,
 )
 
-from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from aiomultiprocess.core import Process
-from aiomultiprocess.pool import CHILD_CONCURRENCY, MAX_TASKS_PER_CHILD, Pool, PoolResult, PoolWorker
+from aiomultiprocess.pool import CHILD_CONCURRENCY, MAX_TASKS_PER_CHILD
 from aiomultiprocess.scheduler import RoundRobin
 from aiomultiprocess.types import (
     LoopInitializer,
@@ -23,34 +25,76 @@ from aiomultiprocess.types import (
     R,
     T,
     TaskID,
+    TracebackStr,
+)
+from data_pipeline.DownloadPool import DownloadPool, DownloadWorker
+from data_pipeline.journal import EMPTY, SKIPPED, task_key
+from data_pipeline.landing_zone import close_landing_zone_writers, parquet_enabled
+from data_pipeline.polygon_utils import HistoricalQuotes
+from data_pipeline.stream import close_stream_uploaders, stream_enabled
+from data_pipeline.task_feed import TaskFeed
+
+from curator.utils import (
+    checkpoint_buffered_writers,
+    close_buffered_writers,
+    extract_underlying_from_o_ticker,
+    flush_buffered_writers,
 )
 
 log = logging.getLogger(__name__)
 
+QUEUED_TASKS_PER_PROCESS = 2000  # tasks queued or in flight per worker before `QuotePool.feed()` waits
+EMPTY_RUN_LENGTH = 15  # consecutive empty tasks that indicate we've passed the listing date of the contract
+PREFETCH_TASKS_FACTOR = 2  # tasks sent to a worker's queue ahead, as a multiple of its max in-flight limit
+
 
 class QuoteScheduler(RoundRobin):
     """This scheduler is for use in the QuotePool for the Options Quotes downloader.
     It will make sure that all args for a given options ticker are put in the same queue
     Requires that all tasks add to the pool are ordered by option ticker.
-    When the same option ticker is no longer"""
+    When the option ticker changes (the pill), the next one is assigned to the queue with the fewest
+    outstanding tasks. Tasks are outstanding until the worker reports them done, see `complete_task()`.
+
+    The pool holds each queue's contracts in a backlog and only sends a queue whole contracts
+    while it has fewer than `prefetch_tasks` in flight per worker (`next_contract()`).
+    A queue whose backlog is empty steals the next not-yet-started contract from the longest backlog,
+    so one worker stuck on a slow contract doesn't hold up the contracts assigned after it.
+    The backlogs only ever hold whole contracts (see `QuotePool.feed()`), so a contract's tasks
+    always go to a single queue, whose worker tracks the contract until all its tasks are done"""
 
-    def __init__(self, o_ticker_mapping: Dict[str, int]) -> None:
+    def __init__(
+        self, o_ticker_mapping: Dict[str, int], prefetch_tasks: int = 0, processes: Optional[int] = None
+    ) -> None:
         super().__init__()
+        self.process_count = max(1, processes or os.cpu_count() or 2)  # the same default as the pool's
         self.current_o_ticker: str = ""
         self.current_queue: QueueID = 0
         self.o_ticker_mapping = o_ticker_mapping
+        self.prefetch_tasks = prefetch_tasks
         self.counter = 0
-        self.queue_size: Dict[QueueID, int] = {}  # number of tasks in each queue
+        self.queue_size: Dict[QueueID, int] = {}  # number of outstanding tasks in each queue, incl. the backlog
+        self.in_flight: Dict[QueueID, int] = {}  # number of outstanding tasks sent to each queue
+        self.backlog: Dict[QueueID, deque[list[PoolTask]]] = {}  # contracts not yet sent to each queue
+        self.task_queues: Dict[TaskID, QueueID] = {}
+        self.workers: Counter[QueueID] = Counter()  # number of worker processes on each queue
+        self.stolen = 0
 
     def initialize_queue_size(self, args):
         """initialize the queue_size dict to count tasks per o_ticker.
-        Also set initial current_o_ticker"""
-        self.queue_size = {qid: 0 for qid in self.qids}
+        Also set initial current_o_ticker.
+        The pool assigns its processes to the queues in turn, so each queue gets process_count // queues
+        workers and the first process_count % queues queues get one more"""
+        qids = list(dict.fromkeys(self.qids))
+        per_queue, remainder = divmod(self.process_count, len(qids))
+        self.workers = Counter({qid: per_queue + (i < remainder) for i, qid in enumerate(qids)})
+        self.queue_size = {qid: 0 for qid in qids}
+        self.in_flight = {qid: 0 for qid in qids}
+        self.backlog = {qid: deque() for qid in qids}
         self.current_o_ticker = args[0]
 
     def schedule_task(
         self,
-        _task_id: TaskID,
+        task_id: TaskID,
         _func: Callable[..., Awaitable[R]],
         args: Sequence[Any],
         _kwargs: Dict[str, Any],
@@ -60,9 +104,7 @@ class QuoteScheduler(RoundRobin):
         if not self.queue_size:
             self.initialize_queue_size(args)
         if pill:
-            if self.o_ticker_mapping[self.current_o_ticker] == self.counter:
-                self.queue_size[self.current_queue] += self.counter
-            else:
+            if self.o_ticker_mapping[self.current_o_ticker] != self.counter:
                 raise ValueError(
                     "incorrect number of tasks made for the o_ticker than were expected."
                     f"Expected: {self.o_ticker_mapping[self.current_o_ticker]}, Actual: {self.counter}"
@@ -73,26 +115,86 @@ class QuoteScheduler(RoundRobin):
             self.current_queue = self.cycle_queue()
 
         self.counter += 1
+        self.queue_size[self.current_queue] += 1
+        self.task_queues[task_id] = self.current_queue
         return self.current_queue
 
     def cycle_queue(self) -> QueueID:
-        """cycles the queue with the fewest tasks added to it"""
-
-        return min(self.queue_size, key=self.queue_size.get)
-
-    def complete_task(self, task_id):
-        """removes number of tasks from queue_size dict based on o_ticker and self.o_ticker_mapping
-        Unsure if it needs task_id, queue_id, o_ticker, or all of them"""
-        # NOTE: as of now, no way to pass the o_ticker from the worker to the pool to the scheduler.
-        # Don't want to pass results to the rx queue
-        pass
-
-
-class QuoteWorker(PoolWorker):
+        """cycles the queue with the fewest outstanding tasks per worker"""
+        return min(self.queue_size, key=lambda qid: self.queue_size[qid] / self.workers[qid])
+
+    def hold(self, qid: QueueID, contract: list[PoolTask]):
+        """Adds the tasks of a contract to the queue's backlog"""
+        self.backlog[qid].append(contract)
+
+    def next_contract(self, qid: QueueID) -> Optional[list[PoolTask]]:
+        """Returns the next contract to send to the queue, or None if it has enough tasks in flight.
+        Takes it from the queue's own backlog, or else steals it from the longest backlog"""
+        if not self.backlog or self.in_flight[qid] >= self.prefetch_tasks * self.workers[qid]:
+            return None
+        if self.backlog[qid]:
+            contract = self.backlog[qid].popleft()
+        else:
+            victims = [x for x in self.backlog if self.backlog[x]]
+            if not victims:
+                return None
+            victim = max(victims, key=lambda x: self.queue_size[x] - self.in_flight[x])
+            contract = self.backlog[victim].popleft()
+            self.queue_size[victim] -= len(contract)
+            self.queue_size[qid] += len(contract)
+            for task in contract:
+                self.task_queues[task[0]] = qid
+            self.stolen += 1
+            log.debug(f"queue {qid} stole {contract[0][2][0]} ({len(contract)} tasks) from queue {victim}")
+        self.in_flight[qid] += len(contract)
+        return contract
+
+    def complete_task(self, task_id: TaskID) -> Optional[QueueID]:
+        """Counts the task as done for the queue it was sent to, and returns the queue"""
+        qid = self.task_queues.pop(task_id, None)
+        if qid is not None:
+            self.queue_size[qid] -= 1
+            self.in_flight[qid] -= 1
+        return qid
+
+
+class ContractProgress:
+    """Progress of the tasks of one options contract in a QuoteWorker. Every update is constant time.
+
+    A contract's tasks have consecutive tids, one per day, newest first. The tids of empty results
+    are merged with their neighbours into runs. A run of EMPTY_RUN_LENGTH means the days before
+    the contract was listed were reached, and the rest of its tasks are skipped."""
+
+    def __init__(self, o_ticker: str, task_count: int):
+        self.o_ticker = o_ticker
+        self.task_count = task_count
+        self.started = 0
+        self.skipped = 0
+        self.finished = 0  # tasks done, including the skipped ones
+        self.listed = True  # False once the listing date is reached
+        self.run_ends: Dict[TaskID, TaskID] = {}  # first tid: last tid of each run of empty results
+        self.run_starts: Dict[TaskID, TaskID] = {}  # last tid: first tid of each run of empty results
+
+    def add_empty(self, tid: TaskID):
+        """Merges the tid of an empty result with the runs next to it"""
+        start = self.run_starts.pop(tid - 1, tid)
+        end = self.run_ends.pop(tid + 1, tid)
+        self.run_ends[start] = end
+        self.run_starts[end] = start
+        if end - start + 1 >= EMPTY_RUN_LENGTH:
+            log.debug(f"{EMPTY_RUN_LENGTH} consecutive empty tasks for {self.o_ticker}, skipping the rest")
+            self.listed = False
+            self.run_ends, self.run_starts = {}, {}
+
+
+class QuoteWorker(DownloadWorker):
     """this worker is meant for the processing of quote queues.
-    The TTL should be triggered once the tasks in the queue switch o_tickers.
-    Thereby, a worker should write the results to disc and then die
-    with a new one spinning up to process the next o_ticker"""
+    The TTL is only triggered once the tasks in the queue switch o_tickers: the worker finishes the contracts
+    it started, writes the results to disc and then dies, with a new one spinning up for the next o_ticker.
+    Finished tasks are journaled after the quotes files are checkpointed, when an o_ticker is fully processed.
+    The expected number of tasks of each o_ticker comes with its tasks, as the pool is fed while it runs.
+    The quotes file of a contract is written out before the results that finish the contract are sent,
+    so the pool can upload an underlying once its last result is in"""
 
     def __init__(
         self,
@@ -107,7 +209,9 @@ class QuoteWorker(PoolWorker):
         exception_handler: Optional[Callable[[BaseException], None]] = None,
         init_client_session: bool = False,
         session_base_url: Optional[str] = None,
-        o_ticker_count_mapping: Dict[str, int] = None,
+        max_concurrency: Optional[int] = None,
+        journal_name: Optional[str] = None,
+        returned: Optional[Queue] = None,
     ) -> None:
         super().__init__(
             tx=tx,
@@ -120,35 +224,38 @@ class QuoteWorker(PoolWorker):
             exception_handler=exception_handler,
             init_client_session=init_client_session,
             session_base_url=session_base_url,
+            max_concurrency=max_concurrency,
+            journal_name=journal_name,
+            returned=returned,
         )
-        self.o_ticker_count_mapping = o_ticker_count_mapping
-        self.o_ticker_queue_progress: Dict[str, set[int]] = {}  # tids pulled to execute
-        self.o_ticker_skip_tids: Dict[str, set[int]] = {}  # tids pulled to skip
-        self.tid_result_progress: set = set()
-        self.empty_tids: set = set()
-        self.complete_otkrs: set[str] = set()
-        self.completely_processed_otkrs: list[str] = []
+        self.contracts: Dict[str, ContractProgress] = {}  # by o_ticker, until all their tasks are done
+        self.tid_contracts: Dict[TaskID, ContractProgress] = {}  # contract of every task in flight
+        self.processed_contracts: list[ContractProgress] = []  # done, to be checkpointed and journaled
+        self.completely_processed = 0
 
     async def run(self):
         if self.init_client_session:
-            async with ClientSession(
-                connector=TCPConnector(limit_per_host=max(100, self.concurrency), use_dns_cache=True),
-                timeout=ClientTimeout(total=90),
-                base_url=self.session_base_url if self.session_base_url else None,
-            ) as client_session:
+            async with self.client_session() as client_session:
+                feed = TaskFeed(self.tx, self.returned)
                 pending: Dict[asyncio.Future, TaskID] = {}
                 completed: int = 0
                 skipped: int = 0
+                skipped_results: list[tuple[TaskID, None, None]] = []
                 running = True
+                draining = False  # the TTL was reached, only the contracts already started are finished
                 while running or pending:
-                    # TTL, Tasks To Live, determines how many tasks to execute before dying
+                    # TTL, Tasks To Live, determines how many tasks to execute before dying.
+                    # NOTE: a contract is never split between workers, its progress is tracked by one
                     if self.ttl and completed >= self.ttl:
+                        draining = True
+                    if draining and not self.contracts:
                         running = False
 
                     # pick up new work as long as we're "running" and we have open slots
-                    while running and len(pending) < self.concurrency:
+                    while running and len(pending) < self.concurrency_control.limit:
+                        feed.request(self.concurrency_control.limit - len(pending))
                         try:
-                            task: PoolTask = self.tx.get_nowait()
+                            task: PoolTask = feed.get_nowait()
                         except queue.Empty:
                             break
 
@@ -156,125 +263,125 @@ class QuoteWorker(PoolWorker):
                             running = False
                             break
 
-                        tid, func, args, kwargs = task
+                        tid, func, args, kwargs, task_count = task
 
                         # tracking progress
                         o_ticker = args[0]
-                        if o_ticker not in self.o_ticker_queue_progress:
-                            self.o_ticker_queue_progress[o_ticker] = set([tid])
-
-                        # start work on task, add to pending if not a skipped/complete otkr.
-                        # Otherwise add tid to "results" to mark as done
-                        if o_ticker not in self.complete_otkrs:
-                            self.o_ticker_queue_progress[o_ticker].add(tid)
-                            args = [
-                                *args,
-                                client_session,
-                            ]  # NOTE: adds client session to the args list
-                            future = asyncio.ensure_future(func(*args, **kwargs))
+                        if draining and o_ticker not in self.contracts:
+                            feed.push_back(task)  # NOTE: the first task of a contract for the next worker
+                            running = False
+                            break
+                        if o_ticker not in self.contracts:
+                            self.contracts[o_ticker] = ContractProgress(o_ticker, task_count)
+                        contract = self.contracts[o_ticker]
+
+                        # start work on task, add to pending if the listing date of the contract wasn't reached.
+                        # Otherwise send an empty result to mark it as done
+                        if contract.listed:
+                            contract.started += 1
+                            self.tid_contracts[tid] = contract
+                            future = self.start_task(tid, func, args, kwargs, client_session)
                             pending[future] = tid
                         else:
-                            self.rx.put_nowait((tid, None, None))
-                            self.o_ticker_skip_tids[o_ticker].add(tid)
+                            skipped_results.append((tid, None, None))
+                            contract.skipped += 1
+                            self.contract_task_done(contract)
+                            if self.journal_name:
+                                self.finished_tasks.append((task_key(args), SKIPPED))
                             skipped += 1
 
-                    if not pending:
-                        await asyncio.sleep(0.005)
-                        continue
+                    # NOTE: the contracts whose last tasks were skipped
+                    await self.send_results(skipped_results)
+                    skipped_results = []
 
                     # return results and/or exceptions when completed
-                    done, _ = await asyncio.wait(
-                        pending.keys(),
-                        timeout=0.05,
-                        return_when=asyncio.FIRST_COMPLETED,
-                    )
+                    done = await self.wait_for_work(feed, pending, running)
+                    results = []
                     for future in done:
                         tid = pending.pop(future)
+                        contract = self.tid_contracts.pop(tid)
 
                         result = None
                         tb = None
                         try:
-                            result = future.result()
+                            result, failed = future.result()
                             if result:
-                                if result[0] is False:
-                                    if result[1] not in self.complete_otkrs:
-                                        self.empty_tids.add(tid)
+                                if result[0] is False and contract.listed:
+                                    contract.add_empty(tid)
+                                self.task_finished(tid, failed, status=EMPTY)
+                            else:
+                                self.task_finished(tid, failed)
                             result = None
                         except BaseException as e:
+                            self.task_keys.pop(tid, None)
                             if self.exception_handler is not None:
                                 self.exception_handler(e)
 
                             tb = traceback.format_exc()
-                        self.rx.put_nowait((tid, result, tb))
-                        self.tid_result_progress.add(tid)
+                        results.append((tid, result, tb))
+                        self.contract_task_done(contract)
                         completed += 1
 
-                    self.eval_list_date()
-
-                    self.clean_o_ticker_progress()
-
-        log.info(f"worker finished: processed {completed} tasks, and skipped {skipped}")
-
-    def eval_list_date(self):
-        k = 15  # indicator that we've passed the listing date for the option
-        if len(self.empty_tids) > k:
-            seq_start = self.has_consecutive_sequence(k=k)
-            if seq_start:
-                self.check_completed_otkr(seq_start)
-
-    def has_consecutive_sequence(self, k=15) -> int | bool:
-        """check if there is a sequence of length k or longer in which the tids are consecutive"""
-        for tid in self.empty_tids:
-            if all((tid + i) in self.empty_tids for i in range(k)):
-                log.debug(f"consecutive sequence of {k} found within {len(self.empty_tids)} total empty tids")
-                log.debug(f"empty tids: {self.empty_tids}")
-                return tid
-        return False
-
-    def check_completed_otkr(self, tid):
-        """lookup which oticker produced the consecutive sequence of empty tids"""
-        now_empty_otkr = ""
-        for otkr in self.o_ticker_queue_progress:
-            if tid in self.o_ticker_queue_progress[otkr]:
-                now_empty_otkr = otkr
-                break
-        if now_empty_otkr:
-            self.complete_otkrs.add(now_empty_otkr)
-            self.o_ticker_skip_tids[now_empty_otkr] = set()
-            self.empty_tids -= self.o_ticker_queue_progress[now_empty_otkr]
-
-    def clean_o_ticker_progress(self):
-        """reports how many o_tickers have had all tids pulled from the queue and cleans internal tracking sets"""
-
-        for otkr in self.complete_otkrs:
-            total_tids = self.o_ticker_count_mapping[otkr]
-            self.empty_tids -= self.o_ticker_queue_progress[otkr]
-            if otkr not in self.completely_processed_otkrs:
-                if (
-                    len(self.o_ticker_skip_tids.get(otkr, []) | self.o_ticker_queue_progress.get(otkr, []))
-                    >= total_tids
-                ):
-                    self.completely_processed_otkrs.append(otkr)
-                    log.info(f"all processed for {otkr}! ({total_tids} tasks)")
-
-                elif (
-                    len(
-                        (
-                            self.o_ticker_queue_progress.get(otkr, set())
-                            | self.o_ticker_skip_tids.get(otkr, set())
-                        )
-                        - self.tid_result_progress
-                    )
-                    == 0
-                ):
-                    self.completely_processed_otkrs.append(otkr)
-                    log.info(f"all processed for {otkr}!! \
-({len(self.o_ticker_queue_progress.get(otkr, []))} processed, \
-{total_tids - len(self.o_ticker_queue_progress.get(otkr, []))} will be skipped, \
-{total_tids} expected)")
-
-
-class QuotePool(Pool):
+                    await self.send_results(results)
+
+                await self.close_feed(feed)
+
+        close_buffered_writers()  # NOTE: the writer threads die with the process, so flush them first
+        close_landing_zone_writers()
+        if await close_stream_uploaders():
+            self.journal_finished_tasks()
+        log.info(
+            f"worker finished: processed {completed} tasks, and skipped {skipped}. "
+            f"{self.completely_processed} contracts completely processed. "
+            f"final in-flight limit {self.concurrency_control.limit}"
+        )
+
+    def contract_task_done(self, contract: "ContractProgress"):
+        contract.finished += 1
+        if contract.finished >= contract.task_count:
+            del self.contracts[contract.o_ticker]
+            self.processed_contracts.append(contract)
+
+    async def send_results(self, results: list[tuple[TaskID, Any, Optional[TracebackStr]]]):
+        """Sends the results to the pool. The pool may upload an underlying as soon as its last result is in,
+        so the quotes files of the contracts these results finish are written out first.
+        The contracts are then checkpointed. The file I/O runs in a thread, off the event loop"""
+        if not results:
+            return
+        if self.processed_contracts:
+            paths = {
+                HistoricalQuotes.quotes_path(extract_underlying_from_o_ticker(contract.o_ticker))
+                for contract in self.processed_contracts
+            }
+            await asyncio.to_thread(flush_buffered_writers, paths)
+        for result in results:
+            self.rx.put_nowait(result)
+        await self.checkpoint_processed_contracts()
+
+    async def checkpoint_processed_contracts(self):
+        """Checkpoints the quotes files and journals the finished tasks once contracts are fully processed"""
+        if not self.processed_contracts:
+            return
+        await asyncio.to_thread(checkpoint_buffered_writers)
+        if not (parquet_enabled() or stream_enabled()):  # NOTE: buffered until the process exits
+            self.journal_finished_tasks()
+        for contract in self.processed_contracts:
+            log.info(
+                f"all processed for {contract.o_ticker}! ({contract.started} processed, "
+                f"{contract.skipped} skipped, {contract.task_count} expected)"
+            )
+        self.completely_processed += len(self.processed_contracts)
+        self.processed_contracts = []
+
+
+class QuotePool(DownloadPool):
+    """Process pool for the options quotes. It is long-lived: `feed()` queues the tasks of one underlying
+    after another while the workers run, so the pool never drains between batches or underlyings.
+    Results are not stored. Finished tasks are counted per underlying, and `ticker_done()` tells when
+    all the tasks of an underlying are finished, e.g. to upload it while the next ones download.
+    The tasks of each contract are held back until the QuoteScheduler hands them to a queue with room,
+    see `dispatch()`. The workers' reports of finished tasks free that room."""
+
     def __init__(
         self,
         processes: int = None,
@@ -288,11 +395,25 @@ class QuotePool(Pool):
         exception_handler: Optional[Callable[[BaseException], None]] = None,
         init_client_session: bool = False,
         session_base_url: Optional[str] = None,
+        max_childconcurrency: Optional[int] = None,
         o_ticker_count_mapping: Dict[str, int] = None,
+        journal_name: Optional[str] = None,
+        max_queued_tasks: Optional[int] = None,
     ) -> None:
-        self.o_ticker_count_mapping: dict[str, int] = o_ticker_count_mapping
-        scheduler = QuoteScheduler(self.o_ticker_count_mapping)
+        self.o_ticker_count_mapping: dict[str, int] = dict(o_ticker_count_mapping or {})
+        # NOTE: a worker's in-flight limit adapts up to max_childconcurrency, keep its next requests ready
+        prefetch_tasks = PREFETCH_TASKS_FACTOR * max(childconcurrency, max_childconcurrency or 0)
+        scheduler = QuoteScheduler(
+            self.o_ticker_count_mapping, prefetch_tasks=prefetch_tasks, processes=processes
+        )
         self.tasks_scheduled = 0
+        self.failed_tasks = 0
+        self.current_o_ticker: Optional[str] = None
+        self.open_contract: Optional[tuple[QueueID, list[PoolTask]]] = None  # the contract being fed
+        self.task_tickers: Dict[TaskID, str] = {}  # underlying of every task queued or in flight
+        self.ticker_tasks: Dict[str, int] = {}  # number of tasks queued or in flight per underlying
+        self.ticker_futures: Dict[str, asyncio.Future] = {}  # see ticker_done()
+        self.task_capacity = asyncio.Event()
         super().__init__(
             processes=processes,
             initializer=initializer,
@@ -305,7 +426,10 @@ class QuotePool(Pool):
             exception_handler=exception_handler,
             init_client_session=init_client_session,
             session_base_url=session_base_url,
+            max_childconcurrency=max_childconcurrency,
+            journal_name=journal_name,
         )
+        self.max_queued_tasks = max_queued_tasks or QUEUED_TASKS_PER_PROCESS * self.process_count
 
     def queue_work(
         self,
@@ -316,6 +440,8 @@ class QuotePool(Pool):
     ) -> TaskID:
         """
         pass the queues themselves to the scheduler enabling scheduling based on load.
+        The task is added to the contract being fed, which is sent once it is complete.
+        The o_ticker's expected number of tasks is sent along with the task.
 
         :meta private:
         """
@@ -330,8 +456,11 @@ class QuotePool(Pool):
             pill,
         )
 
-        tx, _ = self.queues[qid]
-        tx.put_nowait((task_id, func, args, kwargs))
+        if pill:
+            self.close_contract()
+        if self.open_contract is None:
+            self.open_contract = (qid, [])
+        self.open_contract[1].append((task_id, func, args, kwargs, self.o_ticker_count_mapping[args[0]]))
 
         self.tasks_scheduled += 1
         if self.tasks_scheduled % 250000 == 0:
@@ -339,31 +468,88 @@ class QuotePool(Pool):
 
         return task_id
 
-    # def finish_work(self, task_id: TaskID, value: Any, tb: Optional[TracebackStr]):
-    #     """overwriting the inherited function. Not using ._results in the pool"""
-    #     self.scheduler.complete_task(task_id)
-
-    def starmap(
+    def close_contract(self):
+        """Hands the contract being fed to its queue's backlog. Then fills every queue that has room"""
+        if self.open_contract is not None:
+            qid, contract = self.open_contract
+            self.open_contract = None
+            self.scheduler.hold(qid, contract)
+            for qid in self.scheduler.workers:
+                self.dispatch(qid)
+
+    def dispatch(self, qid: QueueID):
+        """Sends whole contracts to the queue while its workers have room for them.
+        If its backlog is empty, the scheduler steals one from another queue"""
+        tx, _ = self.queues[qid]
+        while contract := self.scheduler.next_contract(qid):
+            for task in contract:
+                tx.put_nowait(task)
+
+    def finish_work(self, task_id: TaskID, value: Any, tb: Optional[TracebackStr]):
+        """overwriting the inherited function. Not using ._results in the pool,
+        the task is counted as finished for its underlying instead.
+        The worker's queue then has room for its next contract"""
+        qid = self.scheduler.complete_task(task_id)
+        if qid is not None:
+            self.dispatch(qid)
+        if tb is not None:
+            self.failed_tasks += 1
+            log.error(f"quote task {task_id} failed:\n{tb}")
+
+        ticker = self.task_tickers.pop(task_id, None)
+        if ticker is not None:
+            self.ticker_tasks[ticker] -= 1
+            self._resolve_ticker(ticker)
+        if len(self.task_tickers) < self.max_queued_tasks:
+            self.task_capacity.set()
+
+    async def feed(
         self,
         func: Callable[..., Awaitable[R]],
-        iterable: Sequence[Sequence[T]],
-    ):
-        """Run a coroutine once for each sequence of items in the iterable."""
+        iterable: Iterable[Sequence[T]],
+        o_ticker_count_mapping: Dict[str, int],
+        ticker: str,
+    ) -> int:
+        """Queues a coroutine call for each sequence of items in the iterable, as tasks of the underlying.
+        The iterable may be lazy (e.g. a QuoteRequestPlan), it is only consumed once.
+        Before each contract, waits while `max_queued_tasks` are queued or in flight, so it keeps up with
+        the workers without holding every task of the run in the queues. Contracts are never split,
+        so the queued tasks may exceed `max_queued_tasks` by up to one contract.
+        Returns the number of tasks queued"""
         if not self.running:
             raise RuntimeError("pool is closed")
 
-        current_o_ticker = iterable[0][0]
-        tids = []
+        self.o_ticker_count_mapping.update(o_ticker_count_mapping)
+        self.ticker_tasks.setdefault(ticker, 0)
+        queued = 0
         for args in iterable:
-            pill = False
-            if not args[0] == current_o_ticker:
-                # passes pill to scheduler to cycle queues
-                pill = True
-                current_o_ticker = args[0]
+            # passes pill to scheduler to cycle queues when the o_ticker changes, also across calls
+            pill = self.current_o_ticker is not None and args[0] != self.current_o_ticker
+            if pill or self.open_contract is None:
+                while len(self.task_tickers) >= self.max_queued_tasks:
+                    self.close_contract()  # NOTE: the previous contract is complete
+                    self.task_capacity.clear()
+                    await self.task_capacity.wait()
+            self.current_o_ticker = args[0]
 
             tid = self.queue_work(func, args, {}, pill=pill)
-            tids.append(tid)
-        return PoolResult(self, tids)
+            self.task_tickers[tid] = ticker
+            self.ticker_tasks[ticker] += 1
+            queued += 1
+        self.close_contract()
+        return queued
+
+    def ticker_done(self, ticker: str) -> asyncio.Future:
+        """Call once every task of the underlying has been fed.
+        Returns a future that resolves with the ticker when all its tasks are finished"""
+        future = self.ticker_futures[ticker] = asyncio.get_running_loop().create_future()
+        self._resolve_ticker(ticker)  # NOTE: resolves it right away if its tasks are already finished
+        return future
+
+    def _resolve_ticker(self, ticker: str):
+        if ticker in self.ticker_futures and self.ticker_tasks.get(ticker, 0) == 0:
+            self.ticker_futures.pop(ticker).set_result(ticker)
+            self.ticker_tasks.pop(ticker, None)
 
     def create_worker(
         self,
@@ -386,7 +572,9 @@ class QuotePool(Pool):
             exception_handler=self.exception_handler,
             init_client_session=self.init_client_session,
             session_base_url=self.session_base_url,
-            o_ticker_count_mapping=self.o_ticker_count_mapping,
+            max_concurrency=self.max_childconcurrency,
+            journal_name=self.journal_name,
+            returned=self.returned_queue(qid),
         )
         process.start()
         return process
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import typer
+from data_pipeline.fake_polygon import FakePolygon, SyntheticMarket
+
+from curator.proj_constants import log
+
+CURATOR_PATH = Path(__file__).resolve().parents[1]
+RSS_SAMPLE_SECONDS = 0.25  # interval between samples of the pipeline's process tree RSS
+
+app = typer.Typer(
+    help=(
+        "Benchmarks the full download and upload pipeline against a local fake Polygon server."
+        " The upload writes to the db configured in the environment, so point it at a scratch db"
+    )
+)
+
+
+def _process_tree_rss(pid: int) -> int:
+    """Resident memory in bytes of the process and all its descendants (e.g. pool workers), read from /proc"""
+    children: dict[int, list[int]] = {}
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # NOTE: the command name may contain spaces, the fields after it are split on the last ")"
+            ppid = int(stat_path.read_text().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue  # NOTE: the process exited while scanning
+        children.setdefault(ppid, []).append(int(stat_path.parent.name))
+
+    rss_pages = 0
+    tree = [pid]
+    while tree:
+        process = tree.pop()
+        tree.extend(children.get(process, []))
+        try:
+            rss_pages += int(Path(f"/proc/{process}/statm").read_text().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+async def _sample_tree_rss(pid: int, peak: list[int]):
+    """Keeps the peak RSS of the process tree in `peak[0]`, until cancelled"""
+    while True:
+        peak[0] = max(peak[0], await asyncio.to_thread(_process_tree_rss, pid))
+        await asyncio.sleep(RSS_SAMPLE_SECONDS)
+
+
+async def run_benchmark(
+    server: FakePolygon,
+    tickers: list[str],
+    partial: list[int],
+    months_hist: int,
+    plan: str,
+    download_path: str,
+) -> dict:
+    """Runs `main.py add` for the tickers against the fake server in a subprocess and returns its metrics.
+    The pipeline runs in its own process so that it reads the server's url and the download path from the env,
+    and so that its memory can be measured apart from the server's.
+    `peak_tree_rss_mb` is the peak of the summed RSS of the pipeline and its pool workers,
+    sampled every RSS_SAMPLE_SECONDS. `peak_process_rss_mb` is the peak of the largest single process of them"""
+    env = {
+        **os.environ,
+        "POLYGON_BASE_URL": server.base_url,
+        "POLYGON_API_KEY": "benchmark",
+        "POLYGON_PLAN": plan,
+        "POLYGON_RESPONSE_CACHE": "false",
+        "POLYGON_DOWNLOAD_PATH": download_path,
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(CURATOR_PATH.parent), os.getenv("PYTHONPATH")])),
+    }
+    cmd = [sys.executable, "-m", "data_pipeline.main", "add", *tickers, "--months-hist", str(months_hist)]
+    for component in partial:
+        cmd += ["--partial", str(component)]
+
+    await server.start()
+    try:
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(*cmd, cwd=CURATOR_PATH, env=env)
+        peak_tree_rss = [0]
+        sampler = asyncio.create_task(_sample_tree_rss(process.pid, peak_tree_rss))
+        try:
+            return_code = await process.wait()
+        finally:
+            sampler.cancel()
+        wall_seconds = time.perf_counter() - start
+    finally:
+        await server.stop()
+
+    stats = server.stats.summary()
+    return {
+        **stats,
+        "wall_seconds": round(wall_seconds, 2),
+        "pipeline_records_per_second": round(stats["records"] / wall_seconds, 1),
+        "peak_tree_rss_mb": round(peak_tree_rss[0] / 1024**2, 1),
+        # NOTE: ru_maxrss of the children is the largest single process, not their sum. In kilobytes on linux
+        "peak_process_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "return_code": return_code,
+    }
+
+
+@app.command(name="run")
+def run(
+    tickers: list[str] = typer.Argument(None, help="Fake underlying tickers to pull. Defaults to --n-tickers"),
+    n_tickers: int = typer.Option(5, "--n-tickers", "-n", help="Number of fake underlyings to generate"),
+    seed: int = typer.Option(7, "--seed", help="Seed of the synthetic market data"),
+    expirations: int = typer.Option(3, "--expirations", help="Monthly expirations listed per underlying"),
+    strikes: int = typer.Option(10, "--strikes", help="Strikes listed per expiration and contract type"),
+    quotes_per_day: int = typer.Option(200, "--quotes-per-day", help="Quotes per contract per trading day"),
+    partial: list[int] = typer.Option(
+        [1, 2, 3, 4, 5, 6], "--partial", "-p", help="Pipeline components to run, as in `main.py add`"
+    ),
+    months_hist: int = typer.Option(2, "--months-hist", "-m", help="Months of history to pull"),
+    latency: float = typer.Option(0.02, "--latency", help="Injected latency per request, in seconds"),
+    latency_jitter: float = typer.Option(0.01, "--jitter", help="Random +/- spread of the injected latency"),
+    error_rate: float = typer.Option(0.0, "--error-rate", help="Share of requests answered with a 429"),
+    drop_rate: float = typer.Option(0.0, "--drop-rate", help="Share of requests whose connection is dropped"),
+    port: int = typer.Option(8089, "--port", help="Port of the fake server"),
+    plan: str = typer.Option("local", "--plan", help="Rate limit profile the pipeline runs with"),
+    output: Path = typer.Option(None, "--output", "-o", help="Also write the metrics to this json file"),
+):
+    """Serves a seeded synthetic market from a local fake Polygon server, runs the pipeline against it,
+    and reports requests/sec, records/sec, p50/p99 latency and the peak RSS of the pipeline's process tree.
+    Save the output of a run as a baseline to compare changes to the pipeline against"""
+    market = SyntheticMarket(
+        seed=seed,
+        tickers=tickers or None,
+        n_tickers=n_tickers,
+        expirations=expirations,
+        strikes=strikes,
+        quotes_per_day=quotes_per_day,
+    )
+    server = FakePolygon(
+        market=market,
+        port=port,
+        latency=latency,
+        latency_jitter=latency_jitter,
+        error_rate=error_rate,
+        drop_rate=drop_rate,
+    )
+    with tempfile.TemporaryDirectory(prefix="polygon_benchmark_") as download_path:
+        metrics = asyncio.run(
+            run_benchmark(server, market.tickers, partial, months_hist, plan, download_path)
+        )
+
+    if metrics["return_code"] != 0:
+        log.warning(f"the pipeline exited with code {metrics['return_code']}, the metrics are incomplete")
+    typer.echo(json.dumps(metrics, indent=2))
+    if output:
+        output.write_text(json.dumps(metrics, indent=2))
+
+
+def main():
+    """Run the Typer CLI"""
+    app()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import TraceConfig
+from aiohttp.client_exceptions import ClientConnectionError, ServerDisconnectedError
+
+log = logging.getLogger(__name__)
+
+OVERLOAD_EXCEPTIONS = (ServerDisconnectedError, ClientConnectionError, asyncio.TimeoutError)
+
+
+class AIMDConcurrency:
+    """Additive-increase/multiplicative-decrease controller for the number of in-flight requests in a worker.
+
+    The limit grows by `increase` after every full round of successful requests (one round == `limit` requests)
+    as long as the smoothed latency stays within `latency_tolerance` x the best latency seen.
+    It is multiplied by `decrease` on a 429, 5xx, timeout, or dropped connection,
+    at most once per round-trip so that a burst of errors from the same round only backs off once.
+
+    Feed it with `trace_config()` on the worker's ClientSession, then read `limit` in the worker loop."""
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: int = None,
+        increase: int = 1,
+        decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(maximum or initial, initial)
+        self.increase_step = increase
+        self.decrease_factor = decrease
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(max(self.minimum, initial))
+        self.latency: float | None = None  # exponentially weighted moving average of request latency
+        self.base_latency: float | None = None  # best smoothed latency seen, the "healthy" reference
+        self.successes = 0
+        self.failures = 0
+        self._last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _set_limit(self, value: float, reason: str):
+        old = self.limit
+        self._limit = min(self.maximum, max(self.minimum, value))
+        if self.limit != old:
+            latency = f"{self.latency:.3f}s" if self.latency is not None else "n/a"
+            log.info(f"in-flight request limit {old} -> {self.limit} ({reason}, latency: {latency})")
+
+    def record_success(self, latency: float):
+        """Update the latency estimate and raise the limit after a healthy round of requests"""
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.base_latency = self.latency if self.base_latency is None else min(self.base_latency, self.latency)
+
+        self.successes += 1
+        if self.successes >= self.limit:
+            self.successes = 0
+            if self.latency <= self.base_latency * self.latency_tolerance:
+                self._set_limit(self._limit + self.increase_step, "healthy round")
+
+    def record_overload(self, reason: str):
+        """Cut the limit after a throttling response, timeout or dropped connection"""
+        self.failures += 1
+        self.successes = 0
+        now = time.monotonic()
+        if now - self._last_decrease >= (self.latency or 1.0):
+            self._last_decrease = now
+            self._set_limit(self._limit * self.decrease_factor, reason)
+
+    def trace_config(self) -> TraceConfig:
+        """aiohttp TraceConfig that reports every request made by the session to this controller"""
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        context.start = time.monotonic()
+
+    async def _on_request_end(self, session, context, params):
+        status = params.response.status
+        if status == 429 or status >= 500:
+            self.record_overload(f"status code {status}")
+        else:
+            self.record_success(time.monotonic() - context.start)
+
+    async def _on_request_exception(self, session, context, params):
+        if isinstance(params.exception, OVERLOAD_EXCEPTIONS):
+            self.record_overload(type(params.exception).__name__)
@@ -1,6 +1,8 @@
-from datetime import datetime
+import asyncio
+from datetime import date, datetime
+from typing import Awaitable, Callable
 
-from aiomultiprocess import Pool
+from data_pipeline.DownloadPool import DownloadPool
 from data_pipeline.exceptions import (
     InvalidArgs,
     ProjBaseException,
@@ -9,21 +11,26 @@ from data_pipeline.exceptions import (
     ProjIndexError,
     ProjTimeoutError,
 )
+from data_pipeline.journal import DONE, download_journal, task_key
+from data_pipeline.landing_zone import parquet_enabled
 from data_pipeline.polygon_utils import (
     CurrentContractSnapshot,
     HistoricalOptionsPrices,
     HistoricalQuotes,
     HistoricalStockPrices,
+    OptionsChainSnapshot,
     OptionsContracts,
     PolygonPaginator,
     StockMetaData,
 )
 from data_pipeline.QuotePool import QuotePool
+from data_pipeline.rate_limiter import TokenBucket, install_rate_limiter, shared_rate_limiter
+from data_pipeline.retry import RetryBudget, install_retry_budget, shared_retry_budget
 from db_tools.queries import lookup_multi_ticker_ids
 from db_tools.utils import OptionTicker
 
-from curator.proj_constants import POLYGON_BASE_URL, log
-from curator.utils import pool_kwarg_config
+from curator.proj_constants import MAX_CONCURRENT_REQUESTS, POLYGON_BASE_URL, log
+from curator.utils import pool_kwarg_config, timestamp_now
 
 planned_exceptions = (
     InvalidArgs,
@@ -35,11 +42,32 @@ planned_exceptions = (
 )
 
 
+def _init_download_worker(rate_limiter: TokenBucket, retry_budget: RetryBudget):
+    """Pool initializer. Installs the run-wide shared rate limiter and retry budget in the worker process"""
+    install_rate_limiter(rate_limiter)
+    install_retry_budget(retry_budget)
+
+
+def _download_pool_kwargs() -> dict:
+    """pool kwargs shared by every download pool.
+    Each worker gets a client session and draws from the same cross-process rate limiter and retry budget.
+    `childconcurrency` is only the starting in-flight limit per worker.
+    It adapts up to `max_childconcurrency`"""
+    return {
+        "max_childconcurrency": MAX_CONCURRENT_REQUESTS,
+        "init_client_session": True,
+        "session_base_url": POLYGON_BASE_URL,
+        "initializer": _init_download_worker,
+        "initargs": (shared_rate_limiter(), shared_retry_budget()),
+    }
+
+
 async def api_pool_downloader(
     paginator: PolygonPaginator,
     args_data: list = None,
     pool_kwargs: dict = {},
     batch_num: int = None,
+    watermarks: dict | None = None,
 ):
     """This function creates a process pool to download data from the polygon api and store it in json files.
     It is the base module co-routine for all our data pulls.
@@ -50,22 +78,46 @@ async def api_pool_downloader(
         paginator: PolygonPaginator object, specific to the endpoint being queried,
         args_data: list of data args to be used to generate pool args
         pool_kwargs: kwargs to be passed to the process pool
+        watermarks: optional dict of ticker/o_ticker: date of the latest stored record, for incremental pulls.
+            Only supported by paginators whose generate_request_args() accepts watermarks
 
     url_args: list of tuples, each tuple contains the args for the paginator's download_data method
+
+    If the paginator is resumable, the tasks journaled as finished by an interrupted run of the same download
+    are skipped. The journal is cleared once the download finishes.
+
+    Returns the millisecond timestamp the download started at (that of the interrupted run when resuming).
+    The files of the download are the ones the manifest has as written since then.
     """
     log.info("generating urls to be queried")
-    url_args = paginator.generate_request_args(args_data)
+    if watermarks is not None:
+        url_args = paginator.generate_request_args(args_data, watermarks)
+    else:
+        url_args = paginator.generate_request_args(args_data)
+
+    journal = download_journal(paginator.paginator_type) if paginator.resumable else None
+    started = journal.started_at() if journal else timestamp_now()
+    if journal and url_args:
+        completed = journal.completed()
+        if completed:
+            remaining = [args for args in url_args if task_key(args) not in completed]
+            log.info(f"resuming {paginator.paginator_type}: {len(url_args) - len(remaining)} tasks were done")
+            url_args = remaining
+
     if url_args:
         log.info("fetching data from polygon api")
         log.debug(f"tasks: {len(url_args)}")
-        pool_kwargs = dict(**pool_kwargs, **{"init_client_session": True, "session_base_url": POLYGON_BASE_URL})
+        pool_kwargs = {**_download_pool_kwargs(), **pool_kwargs}
         pool_kwargs = pool_kwarg_config(pool_kwargs)
-        async with Pool(**pool_kwargs) as pool:
+        async with DownloadPool(**pool_kwargs, journal_name=journal and journal.name) as pool:
             await pool.starmap(paginator.download_data, url_args)
 
         log.info(f"finished downloading data for {paginator.paginator_type}. Process pool closed")
     elif batch_num:
         log.info(f"no data to download for {paginator.paginator_type} batch: {batch_num}")
+    if journal:
+        journal.clear()
+    return started
 
 
 async def download_stock_metadata(tickers: list[str], all_: bool = True):
@@ -76,23 +128,29 @@ async def download_stock_metadata(tickers: list[str], all_: bool = True):
     else:
         log.info(f"pulling ticker metadata for tickers: {tickers}")
     meta = StockMetaData(tickers, all_)
-    pool_kwargs = {"processes": 1, "childconcurrency": 1, "queuecount": 1}
+    pool_kwargs = {"processes": 1, "childconcurrency": 1, "max_childconcurrency": 1, "queuecount": 1}
     await api_pool_downloader(meta, pool_kwargs=pool_kwargs)
 
 
-async def download_stock_prices(ticker_id_lookup: dict[str, int], start_date: str, end_date: str):
+async def download_stock_prices(
+    ticker_id_lookup: dict[str, int], start_date: str, end_date: str, watermarks: dict[str, date] | None = None
+) -> int:
+    """Returns the millisecond timestamp the download started at, see `api_pool_downloader()`"""
     tickers = list(ticker_id_lookup.keys())
-    prices = HistoricalStockPrices(start_date, end_date)
+    prices = HistoricalStockPrices(start_date, end_date, ticker_id_lookup=ticker_id_lookup)
     pool_kwargs = {"childconcurrency": 5, "processes": 1, "queuecount": 1}
-    await api_pool_downloader(paginator=prices, args_data=tickers, pool_kwargs=pool_kwargs)
+    return await api_pool_downloader(
+        paginator=prices, args_data=tickers, pool_kwargs=pool_kwargs, watermarks=watermarks
+    )
 
 
 async def download_options_contracts(
     tickers: list[str] = None,
     ticker_id_lookup: dict | None = None,
     months_hist: int = 24,
+    incremental: bool = False,
 ):
-    # NOTE: if refreshing, just pull the current month, months_hist = 1
+    # NOTE: if refreshing, use incremental=True to skip the past months that were already downloaded
     if not tickers and not ticker_id_lookup:
         raise InvalidArgs("Must provide either tickers or ticker_id_lookup")
     elif not tickers:
@@ -100,85 +158,180 @@ async def download_options_contracts(
     elif not ticker_id_lookup:
         tickers_w_ids = await lookup_multi_ticker_ids(tickers, stock=True)
         ticker_id_lookup = {x[0]: x[1] for x in tickers_w_ids}
-    options = OptionsContracts(tickers, ticker_id_lookup, months_hist)
+    options = OptionsContracts(tickers, ticker_id_lookup, months_hist, incremental=incremental)
     await api_pool_downloader(paginator=options, args_data=tickers)
 
 
-async def download_options_prices(o_tickers: list[tuple[str, int, datetime, str]], months_hist: int = 24):
+async def download_options_prices(
+    o_tickers: list[tuple[str, int, datetime, str]],
+    months_hist: int = 24,
+    watermarks: dict[str, date] | None = None,
+) -> int:
     """This function downloads options prices from polygon and stores it as local json.
+    Returns the millisecond timestamp the download started at, see `api_pool_downloader()`
 
     Args:
         o_tickers: list of OptionTicker tuples
         month_hist: number of months of history to pull
+        watermarks: optional dict of o_ticker: date of the latest stored price, for incremental pulls
     """
     pool_kwargs = {"childconcurrency": 250, "maxtasksperchild": 50000}
     op_prices = HistoricalOptionsPrices(months_hist=months_hist)
-    await api_pool_downloader(paginator=op_prices, pool_kwargs=pool_kwargs, args_data=o_tickers)
+    return await api_pool_downloader(
+        paginator=op_prices, pool_kwargs=pool_kwargs, args_data=o_tickers, watermarks=watermarks
+    )
 
 
-async def download_options_snapshots(o_tickers: list[OptionTicker]):
+async def download_options_snapshots(o_tickers: list[OptionTicker], chain: bool = False):
     """This function downloads options snapshots from polygon and stores it as local json.
 
     Args:
         o_tickers: list of OptionTicker tuples
+        chain: page through each underlying's whole chain instead of requesting every contract separately
     """
-    pool_kwargs = {"childconcurrency": 250, "maxtasksperchild": 50000}
-    op_snapshots = CurrentContractSnapshot()
+    if chain:
+        pool_kwargs = {"childconcurrency": 10}
+        op_snapshots = OptionsChainSnapshot()
+    else:
+        pool_kwargs = {"childconcurrency": 250, "maxtasksperchild": 50000}
+        op_snapshots = CurrentContractSnapshot()
     await api_pool_downloader(paginator=op_snapshots, pool_kwargs=pool_kwargs, args_data=o_tickers)
 
 
-async def download_options_quotes(ticker: str, o_tickers: list[OptionTicker], months_hist: int = 24):
+async def download_options_quotes(
+    tickers: list[str],
+    o_tickers: list[OptionTicker],
+    months_hist: int = 24,
+    watermarks: dict[str, date] | None = None,
+    window_requests: bool = False,
+    on_ticker_done: Callable[[str, int], Awaitable] | None = None,
+) -> list:
     """This function downloads options quotes from polygon and stores it as local json.
+    The underlyings are downloaded in the order of `tickers`, through one QuotePool for the whole run.
+    Each worker process writes a new quotes file per run, named with the time it was created.
 
     Args:
+        tickers: underlying tickers whose quotes are downloaded
         o_tickers: list of OptionTicker tuples
         month_hist: number of months of history to pull
+        watermarks: optional dict of o_ticker: date of the latest stored quote, for incremental pulls
+        window_requests: request each target quote on its own (limit=1) instead of pulling whole days
+        on_ticker_done: awaited with each underlying once its quotes are downloaded (e.g. its upload),
+            while the next underlyings download. It also gets the millisecond timestamp the download started at
+            (that of the interrupted run when resuming), the oldest quotes file of the run.
+            An underlying it finished before an interruption is left out. Returns the results of every call
     """
-    pool_kwargs = {"childconcurrency": 14, "maxtasksperchild": 1000, "processes": 30}
+    # NOTE: a queue per worker, so the QuoteScheduler balances and steals contracts between single workers
+    pool_kwargs = {"childconcurrency": 14, "maxtasksperchild": 1000, "processes": 30, "queuecount": 30}
     o_ticker_lookup = {x.o_ticker: x.id for x in o_tickers}
-    op_quotes = HistoricalQuotes(months_hist=months_hist, o_ticker_lookup=o_ticker_lookup)
-    BATCH_SIZE_OTICKERS = 1000
-    batch_o_tickers = [x for x in o_tickers if x.underlying_ticker == ticker]
-    for i in range(0, len(batch_o_tickers), BATCH_SIZE_OTICKERS):
-        small_batch = batch_o_tickers[i : i + BATCH_SIZE_OTICKERS]
+    op_quotes = HistoricalQuotes(
+        months_hist=months_hist, o_ticker_lookup=o_ticker_lookup, window_requests=window_requests
+    )
+    journal = download_journal(op_quotes.paginator_type)
+    started = journal.started_at()
+    completed = journal.completed()  # NOTE: the tasks finished by an interrupted run
 
-        log.info(f"downloading quotes for {i+BATCH_SIZE_OTICKERS}/{len(batch_o_tickers)} batch of o_tickers")
+    async def ticker_done(ticker: str):
+        # NOTE: journaled, so an underlying uploaded before an interruption isn't uploaded twice
+        key = task_key(("ticker_done", ticker))
+        if key in completed:
+            log.info(f"{ticker} was handled by the interrupted run")
+            return None
+        result = await on_ticker_done(ticker, started)
+        journal.record_many([(key, DONE)])
+        return result
 
-        await api_quote_downloader(
-            paginator=op_quotes,
-            pool_kwargs=pool_kwargs,
-            args_data=small_batch,
-        )
-    log.info(f"-- Completely done downloading {ticker}")
+    results = await api_quote_downloader(
+        paginator=op_quotes,
+        tickers=tickers,
+        args_data=o_tickers,
+        pool_kwargs=pool_kwargs,
+        watermarks=watermarks,
+        completed=completed,
+        on_ticker_done=ticker_done if on_ticker_done else None,
+    )
+    journal.clear()  # NOTE: kept until the last underlying, so that a restart skips the finished ones
+    return results
 
 
 async def api_quote_downloader(
     paginator: HistoricalQuotes,
+    tickers: list[str],
     args_data: list = None,
     pool_kwargs: dict = {},
-):
+    watermarks: dict | None = None,
+    completed: set[str] | None = None,
+    on_ticker_done: Callable[[str], Awaitable] | None = None,
+) -> list:
     """This function creates a process pool to download data from the polygon api and store it in json files.
-    It is the base module co-routine for all our data pulls.
-    It generates the urls to be queried, creates and runs a process pool to perform the I/O queries.
-    The results for each request are returned via PoolResults generator.
+    It generates the urls to be queried for one batch of contracts at a time, and feeds them to a single
+    QuotePool that runs for all the underlyings, so the workers never wait for the next batch.
+
+    Once all the tasks of an underlying are finished, `on_ticker_done` is started for it in the background.
+    The calls run one at a time, in the order of the underlyings. With the parquet landing zone,
+    the workers only write out their rows when they exit, so the calls wait until the pool is closed.
+    A call that raises is logged and its result is None, the other underlyings carry on.
 
     Args:
         paginator: PolygonPaginator object, specific to the endpoint being queried,
+        tickers: underlying tickers, in the order they are downloaded
         args_data: list of data args to be used to generate pool args
         pool_kwargs: kwargs to be passed to the process pool
+        watermarks: optional dict of o_ticker: date of the latest stored quote, for incremental pulls
+        completed: keys of the tasks journaled as finished by an interrupted run. They are left out of the plan
+        on_ticker_done: optional coroutine function awaited with each underlying once its quotes are downloaded
 
     url_args: list of tuples, each tuple contains the args for the paginator's download_data method
     """
-    log.info("generating urls to be queried")
-    url_args, o_ticker_count_mapping = paginator.generate_request_args(args_data)
-    if url_args:
-        log.info("fetching data from polygon api")
-        log.info(f"tasks: {len(url_args)}")
-        pool_kwargs = dict(**pool_kwargs, **{"init_client_session": True, "session_base_url": POLYGON_BASE_URL})
-        pool_kwargs = pool_kwarg_config(pool_kwargs)
-        log.info("creating quote pool")
-        async with QuotePool(**pool_kwargs, o_ticker_count_mapping=o_ticker_count_mapping) as pool:
-            log.info("deploying QuoteWorkers in Pool")
-            await pool.starmap(paginator.download_data, url_args)
+    BATCH_SIZE_OTICKERS = 1000
+    ticker_o_tickers: dict[str, list[OptionTicker]] = {ticker: [] for ticker in tickers}
+    for o_ticker in args_data:
+        if o_ticker.underlying_ticker in ticker_o_tickers:
+            ticker_o_tickers[o_ticker.underlying_ticker].append(o_ticker)
 
-        log.info(f"finished downloading data for {paginator.paginator_type}. Process pool closed")
+    callback_lock = asyncio.Lock()
+    defer_callbacks = parquet_enabled()
+
+    async def ticker_callback(ticker: str):
+        """Awaits `on_ticker_done` for the underlying. A failure is logged, so it can't stop the other ones"""
+        try:
+            return await on_ticker_done(ticker)
+        except Exception as e:
+            log.exception(e, extra={"context": f"on_ticker_done failed for {ticker}"})
+            return None
+
+    async def when_downloaded(done: asyncio.Future, ticker: str):
+        await done
+        log.info(f"-- Completely done downloading {ticker}")
+        if on_ticker_done and not defer_callbacks:
+            async with callback_lock:
+                return await ticker_callback(ticker)
+
+    pool_kwargs = {**_download_pool_kwargs(), **pool_kwargs}
+    pool_kwargs = pool_kwarg_config(pool_kwargs)
+    log.info("creating quote pool")
+    async with QuotePool(**pool_kwargs, journal_name=paginator.paginator_type) as pool:
+        log.info("deploying QuoteWorkers in Pool")
+        finished = []
+        for n, ticker in enumerate(tickers, start=1):
+            batch_o_tickers = ticker_o_tickers[ticker]
+            tasks = 0
+            for i in range(0, len(batch_o_tickers), BATCH_SIZE_OTICKERS):
+                url_args = paginator.generate_request_args(
+                    batch_o_tickers[i : i + BATCH_SIZE_OTICKERS], watermarks, completed=completed
+                )
+                if len(url_args):
+                    tasks += await pool.feed(
+                        paginator.download_data, url_args, url_args.o_ticker_count_mapping(), ticker
+                    )
+            log.info(f"queued {tasks} quote tasks for {ticker} ({n}/{len(tickers)})")
+            finished.append(asyncio.create_task(when_downloaded(pool.ticker_done(ticker), ticker)))
+        results = await asyncio.gather(*finished)
+
+    log.info(
+        f"finished downloading data for {paginator.paginator_type}, {pool.failed_tasks} tasks failed. "
+        "Process pool closed"
+    )
+    if on_ticker_done and defer_callbacks:
+        results = [await ticker_callback(ticker) for ticker in tickers]
+    return results
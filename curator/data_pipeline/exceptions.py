@@ -73,11 +73,25 @@ class ProjAttributeError(ProjBaseException, AttributeError):
 
 
 class ProjAPIOverload(ProjBaseException):
-    """An exception indicating a 429 response from the API"""
+    """An exception indicating a 429 response from the API.
+    `retry_after` holds the seconds requested by the `Retry-After` header, if the API sent one"""
+
+    def __init__(self, message: str | None = None, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
 class ProjAPIError(ProjBaseException):
-    """An exception indicating a 400 response from the API"""
+    """An exception indicating a 400 response from the API.
+    `status` holds the status code of the response"""
+
+    def __init__(self, message: str | None = None, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+class ProjAPIServerError(ProjAPIError):
+    """An exception indicating a 5xx response from the API. Unlike a 4xx, the same request may succeed later"""
 
 
 class PoolResultException(ProjBaseException):
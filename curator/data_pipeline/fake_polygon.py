@@ -0,0 +1,421 @@
+import asyncio
+import random
+import string
+import time
+import zlib
+from collections import Counter
+from datetime import date, datetime, time as dt_time, timedelta
+from urllib.parse import urlencode
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from aiohttp import web
+
+from curator.proj_constants import log
+
+MARKET_TZ = ZoneInfo("America/New_York")
+LISTED_DAYS_BEFORE_EXPIRATION = 120  # synthetic contracts only trade for this many days up to their expiration
+TIMESPAN_MINUTES = {"minute": 1, "hour": 60}
+MAX_PAGE_LIMITS = {"aggs": 50000, "contracts": 1000, "tickers": 1000, "snapshot": 250, "quotes": 50000}
+
+
+def _rng(*key) -> random.Random:
+    """Random generator seeded from the key, so the same data is generated for it on every request and run"""
+    return random.Random(zlib.crc32(":".join(str(k) for k in key).encode()))
+
+
+def _to_date(value: str) -> date:
+    """Aggregates ranges are either dates or millisecond timestamps"""
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value) / 1000, MARKET_TZ).date()
+    return date.fromisoformat(value)
+
+
+def _ns(day: date, hour: int, minute: int = 0) -> int:
+    """Nanosecond timestamp of a market time on `day`"""
+    return int(datetime.combine(day, dt_time(hour, minute), MARKET_TZ).timestamp() * 1000000000)
+
+
+def _weekdays(start: date, end: date) -> list[date]:
+    days = (start + timedelta(days=i) for i in range((end - start).days + 1))
+    return [day for day in days if day.weekday() < 5]
+
+
+def _third_friday(year: int, month: int) -> date:
+    first = date(year, month, 1)
+    return first + timedelta(days=(4 - first.weekday()) % 7 + 14)
+
+
+class SyntheticMarket:
+    """Seeded generator of the data the fake Polygon server returns.
+
+    Every value is derived from the seed and what it describes (ticker, contract, day),
+    so repeated requests and runs see the same data without anything being stored.
+    Contracts expire on the third Friday of the next `expirations` months, with `strikes` calls and puts each.
+    They only have prices and quotes in the LISTED_DAYS_BEFORE_EXPIRATION days before they expire"""
+
+    def __init__(
+        self,
+        seed: int = 7,
+        tickers: list[str] | None = None,
+        n_tickers: int = 5,
+        expirations: int = 3,
+        strikes: int = 10,
+        quotes_per_day: int = 200,
+    ):
+        self.seed = seed
+        self.tickers = tickers or [self._ticker_name(i) for i in range(n_tickers)]
+        self.expirations = expirations
+        self.strikes = strikes
+        self.quotes_per_day = quotes_per_day
+
+    @staticmethod
+    def _ticker_name(i: int) -> str:
+        """Letters only, like real tickers. The underlying of an options ticker ends at the first digit"""
+        letters = string.ascii_uppercase
+        return "Z" + letters[i // 676 % 26] + letters[i // 26 % 26] + letters[i % 26]
+
+    def base_price(self, ticker: str) -> float:
+        return round(_rng(self.seed, ticker).uniform(20, 500), 2)
+
+    def ticker_details(self, ticker: str) -> dict:
+        return {
+            "ticker": ticker,
+            "name": f"{ticker} Synthetic Corp",
+            "type": "CS",
+            "active": True,
+            "market": "stocks",
+            "locale": "us",
+            "primary_exchange": "XNYS",
+            "currency_name": "usd",
+            "cik": f"{zlib.crc32(ticker.encode()) % 10000000:010d}",
+        }
+
+    @staticmethod
+    def o_ticker(underlying: str, expiration: date, contract_type: str, strike: float) -> str:
+        strike = int(round(strike * 1000))
+        return f"O:{underlying}{expiration:%y%m%d}{contract_type[0].upper()}{strike:08d}"
+
+    @staticmethod
+    def parse_o_ticker(o_ticker: str) -> tuple[str, date, str, float]:
+        """Returns the underlying, expiration date, contract type and strike of an options ticker"""
+        body = o_ticker.split(":")[-1]
+        strike = int(body[-8:]) / 1000
+        contract_type = "call" if body[-9] == "C" else "put"
+        expiration = datetime.strptime(body[-15:-9], "%y%m%d").date()
+        return body[:-15], expiration, contract_type, strike
+
+    def contracts(self, underlying: str, as_of: date) -> list[dict]:
+        """The contracts of an underlying that are listed on `as_of`, sorted by ticker"""
+        price = self.base_price(underlying)
+        step = max(0.5, round(price * 0.025 * 2) / 2)
+        strikes = [round(price + (i - self.strikes // 2) * step, 1) for i in range(self.strikes)]
+        contracts = []
+        month = date(as_of.year, as_of.month, 1)
+        for _ in range(self.expirations + 1):
+            expiration = _third_friday(month.year, month.month)
+            month = (month + timedelta(days=32)).replace(day=1)
+            if not as_of <= expiration <= as_of + timedelta(days=LISTED_DAYS_BEFORE_EXPIRATION):
+                continue
+            for strike in strikes:
+                for contract_type in ("call", "put"):
+                    contracts.append(
+                        {
+                            "ticker": self.o_ticker(underlying, expiration, contract_type, strike),
+                            "underlying_ticker": underlying,
+                            "expiration_date": str(expiration),
+                            "strike_price": strike,
+                            "contract_type": contract_type,
+                            "shares_per_contract": 100,
+                            "primary_exchange": "BATO",
+                            "exercise_style": "american",
+                            "cfi": "OCASPS" if contract_type == "call" else "OPASPS",
+                        }
+                    )
+        return sorted(contracts, key=lambda x: x["ticker"])
+
+    def trading_days(self, ticker: str, start: date, end: date) -> list[date]:
+        """Weekdays in [start, end] with data. Options only trade between their listing and expiration"""
+        if ticker.startswith("O:"):
+            _, expiration, _, _ = self.parse_o_ticker(ticker)
+            start = max(start, expiration - timedelta(days=LISTED_DAYS_BEFORE_EXPIRATION))
+            end = min(end, expiration)
+        return _weekdays(start, end) if start <= end else []
+
+    def bars(self, ticker: str, multiplier: int, timespan: str, start: date, end: date) -> list[dict]:
+        """Aggregate bars, oldest first. Intraday bars cover 4:00-20:00 for stocks, the session for options"""
+        bars = []
+        for day in self.trading_days(ticker, start, end):
+            if timespan in TIMESPAN_MINUTES:
+                first, last = (570, 960) if ticker.startswith("O:") else (240, 1200)  # minutes after midnight
+                width = TIMESPAN_MINUTES[timespan] * multiplier
+                starts = [_ns(day, m // 60, m % 60) // 1000000 for m in range(first, last, width)]
+            else:
+                starts = [_ns(day, 0) // 1000000]
+            rng = _rng(self.seed, ticker, day)
+            price = self.base_price(ticker) * (0.05 if ticker.startswith("O:") else 1) * rng.uniform(0.8, 1.2)
+            for t in starts:
+                open_price = price
+                price = max(0.01, price * rng.gauss(1, 0.01))
+                volume = rng.randint(1, 100000)
+                bars.append(
+                    {
+                        "v": volume,
+                        "vw": round((open_price + price) / 2, 4),
+                        "o": round(open_price, 4),
+                        "c": round(price, 4),
+                        "h": round(max(open_price, price) * 1.005, 4),
+                        "l": round(min(open_price, price) * 0.995, 4),
+                        "t": t,
+                        "n": rng.randint(1, max(1, volume // 10)),
+                    }
+                )
+        return bars
+
+    def quotes(self, o_ticker: str, day: date) -> list[dict]:
+        """Quotes of a contract during the session of `day`, oldest first"""
+        if not self.trading_days(o_ticker, day, day):
+            return []
+        rng = _rng(self.seed, o_ticker, day, "quotes")
+        session_open, session_close = _ns(day, 9, 30), _ns(day, 16)
+        stamps = sorted(rng.randrange(session_open, session_close) for _ in range(self.quotes_per_day))
+        mid = self.base_price(o_ticker) * 0.05 * rng.uniform(0.5, 1.5)
+        quotes = []
+        for sequence_number, sip_timestamp in enumerate(stamps):
+            mid = max(0.05, mid * rng.gauss(1, 0.005))
+            quotes.append(
+                {
+                    "ask_exchange": rng.randint(300, 325),
+                    "ask_price": round(mid * 1.02, 2),
+                    "ask_size": rng.randint(1, 500),
+                    "bid_exchange": rng.randint(300, 325),
+                    "bid_price": round(mid * 0.98, 2),
+                    "bid_size": rng.randint(1, 500),
+                    "sequence_number": sequence_number,
+                    "sip_timestamp": sip_timestamp,
+                }
+            )
+        return quotes
+
+    def snapshot(self, contract: dict, now_ns: int) -> dict:
+        rng = _rng(self.seed, contract["ticker"], "snapshot", now_ns // (60 * 1000000000))
+        return {
+            "details": {
+                k: contract[k]
+                for k in ("ticker", "contract_type", "exercise_style", "expiration_date", "strike_price")
+            },
+            "greeks": {
+                "delta": round(rng.uniform(0, 1) * (1 if contract["contract_type"] == "call" else -1), 4),
+                "gamma": round(rng.uniform(0, 0.1), 4),
+                "theta": round(rng.uniform(-1, 0), 4),
+                "vega": round(rng.uniform(0, 1), 4),
+            },
+            "implied_volatility": round(rng.uniform(0.1, 1.5), 4),
+            "open_interest": rng.randint(0, 50000),
+            "last_quote": {"last_updated": now_ns - rng.randint(0, 60 * 1000000000)},
+            "underlying_asset": {"ticker": contract["underlying_ticker"]},
+        }
+
+
+class ServerStats:
+    """Counts what the fake server served. Latency is measured from receiving a request to handing back its
+    response, so it includes the injected latency"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.records = 0
+        self.statuses: Counter = Counter()
+        self.latencies: list[float] = []
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            "seconds": round(elapsed, 2),
+            "requests": self.requests,
+            "records": self.records,
+            "requests_per_second": round(self.requests / elapsed, 1),
+            "records_per_second": round(self.records / elapsed, 1),
+            "p50_latency_ms": round(float(np.percentile(latencies, 50)), 2),
+            "p99_latency_ms": round(float(np.percentile(latencies, 99)), 2),
+            "statuses": dict(self.statuses),
+        }
+
+
+class FakePolygon:
+    """Local stand-in for the Polygon API, serving the endpoints the paginators hit:
+    aggregates, options contracts, tickers, options snapshots (per contract and per chain) and quotes.
+    Listings are paginated with `next_url` like the real API.
+
+    Faults can be injected into any request: `latency` (seconds, +/- `latency_jitter`),
+    429s with a `Retry-After` header (`error_rate`), and dropped connections (`drop_rate`).
+    Run it with `start()`, point POLYGON_BASE_URL at `base_url`, and read `stats` afterwards."""
+
+    def __init__(
+        self,
+        market: SyntheticMarket | None = None,
+        host: str = "127.0.0.1",
+        port: int = 8089,
+        latency: float = 0.02,
+        latency_jitter: float = 0.01,
+        error_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        retry_after: int = 1,
+    ):
+        self.market = market or SyntheticMarket()
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+        self.stats = ServerStats()
+        self._faults = random.Random(self.market.seed)
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/v2/aggs/ticker/{ticker}/range/{multiplier}/{timespan}/{start}/{end}", self.aggs)
+        app.router.add_get("/v3/reference/options/contracts", self.options_contracts)
+        app.router.add_get("/v3/reference/tickers", self.tickers)
+        app.router.add_get("/v3/snapshot/options/{underlying}", self.chain_snapshot)
+        app.router.add_get("/v3/snapshot/options/{underlying}/{o_ticker}", self.contract_snapshot)
+        app.router.add_get("/v3/quotes/{o_ticker}", self.quotes)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.stats = ServerStats()
+        log.info(f"fake polygon server listening on {self.base_url}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        start = time.perf_counter()
+        self.stats.requests += 1
+        if self.latency:
+            await asyncio.sleep(max(0.0, self._faults.gauss(self.latency, self.latency_jitter)))
+
+        if self._faults.random() < self.drop_rate:
+            self.stats.statuses["dropped"] += 1
+            request.transport.close()  # NOTE: the client sees the server disconnect without a response
+            return web.Response()
+        if self._faults.random() < self.error_rate:
+            response = web.json_response(
+                {"status": "ERROR", "error": "exceeded the maximum requests per minute"},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        else:
+            response = await handler(request)
+
+        self.stats.statuses[response.status] += 1
+        self.stats.latencies.append(time.perf_counter() - start)
+        return response
+
+    def _request_id(self) -> str:
+        return f"{self.stats.requests:x}"
+
+    def _page(self, request: web.Request, results: list[dict], endpoint: str, default_limit: int) -> dict:
+        """Slices out the page at the request's cursor and adds the `next_url` of the page after it"""
+        limit = min(int(request.query.get("limit", default_limit)), MAX_PAGE_LIMITS[endpoint])
+        offset = int(request.query.get("cursor", 0))
+        page = {"status": "OK", "request_id": self._request_id(), "results": results[offset : offset + limit]}
+        page["count"] = len(page["results"])
+        if offset + limit < len(results):
+            params = {k: v for k, v in request.query.items() if k not in ("apiKey", "cursor")}
+            params["cursor"] = offset + limit
+            page["next_url"] = f"{self.base_url}{request.path}?{urlencode(params)}"
+        self.stats.records += page["count"]
+        return page
+
+    async def aggs(self, request: web.Request) -> web.Response:
+        ticker = request.match_info["ticker"]
+        bars = self.market.bars(
+            ticker,
+            int(request.match_info["multiplier"]),
+            request.match_info["timespan"],
+            _to_date(request.match_info["start"]),
+            _to_date(request.match_info["end"]),
+        )
+        if request.query.get("sort") == "desc":
+            bars.reverse()
+        page = self._page(request, bars, "aggs", 5000)
+        page.update(ticker=ticker, adjusted=True, queryCount=len(bars), resultsCount=page["count"])
+        return web.json_response(page)
+
+    async def options_contracts(self, request: web.Request) -> web.Response:
+        query = request.query
+        as_of = date.fromisoformat(query.get("as_of", str(date.today())))
+        contracts = self.market.contracts(query["underlying_ticker"], as_of)
+        for param, keep in (
+            ("expiration_date.lt", lambda x, v: x < v),
+            ("expiration_date.lte", lambda x, v: x <= v),
+            ("expiration_date.gte", lambda x, v: x >= v),
+        ):
+            if param in query:
+                contracts = [c for c in contracts if keep(c["expiration_date"], query[param])]
+        return web.json_response(self._page(request, contracts, "contracts", 10))
+
+    async def tickers(self, request: web.Request) -> web.Response:
+        tickers = [request.query["ticker"]] if "ticker" in request.query else self.market.tickers
+        return web.json_response(
+            self._page(request, [self.market.ticker_details(t) for t in tickers], "tickers", 100)
+        )
+
+    async def chain_snapshot(self, request: web.Request) -> web.Response:
+        query = request.query
+        contracts = self.market.contracts(request.match_info["underlying"], date.today())
+        for param, field, keep in (
+            ("expiration_date.gte", "expiration_date", lambda x, v: x >= v),
+            ("expiration_date.lte", "expiration_date", lambda x, v: x <= v),
+            ("strike_price.gte", "strike_price", lambda x, v: x >= float(v)),
+            ("strike_price.lte", "strike_price", lambda x, v: x <= float(v)),
+        ):
+            if param in query:
+                contracts = [c for c in contracts if keep(c[field], query[param])]
+        now_ns = time.time_ns()
+        snapshots = [self.market.snapshot(contract, now_ns) for contract in contracts]
+        return web.json_response(self._page(request, snapshots, "snapshot", 10))
+
+    async def contract_snapshot(self, request: web.Request) -> web.Response:
+        o_ticker = request.match_info["o_ticker"]
+        underlying, expiration, contract_type, strike = self.market.parse_o_ticker(o_ticker)
+        contract = {
+            "ticker": o_ticker,
+            "underlying_ticker": underlying,
+            "expiration_date": str(expiration),
+            "strike_price": strike,
+            "contract_type": contract_type,
+            "exercise_style": "american",
+        }
+        self.stats.records += 1
+        snapshot = self.market.snapshot(contract, time.time_ns())
+        return web.json_response({"status": "OK", "request_id": self._request_id(), "results": snapshot})
+
+    async def quotes(self, request: web.Request) -> web.Response:
+        """Quotes of one day, either `timestamp=<date>` or a nanosecond `timestamp.gte`/`timestamp.lt` range"""
+        query = request.query
+        o_ticker = request.match_info["o_ticker"]
+        if "timestamp" in query:
+            quotes = self.market.quotes(o_ticker, date.fromisoformat(query["timestamp"]))
+        else:
+            gte = int(query.get("timestamp.gte", 0))
+            lt = int(query.get("timestamp.lt", 2**63 - 1))
+            day = datetime.fromtimestamp(gte / 1000000000, MARKET_TZ).date()
+            quotes = [q for q in self.market.quotes(o_ticker, day) if gte <= q["sip_timestamp"] < lt]
+        if query.get("order", "desc") == "desc":
+            quotes.reverse()
+        return web.json_response(self._page(request, quotes, "quotes", 1000))
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextvars import ContextVar
+from json import JSONDecodeError
+from typing import Any, Awaitable, Iterable, Iterator, Sequence
+
+from curator.proj_constants import BASE_DOWNLOAD_PATH, log
+
+_download_journals = {}  # this process's journals by name. Managed by `download_journal()`
+_failed_requests: ContextVar[list | None] = ContextVar("failed_requests", default=None)
+
+JOURNAL_PATH = f"{BASE_DOWNLOAD_PATH}/.journal"
+
+# statuses of a finished task. All of them are skipped when the download resumes
+DONE = "done"
+EMPTY = "empty"  # the API had no data for the task
+SKIPPED = "skipped"  # not requested, e.g. quotes for dates before the contract was listed
+
+
+def task_key(args: Sequence) -> str:
+    """Stable key of a task's args (without the client session), the same in every process and run"""
+    return hashlib.sha1(json.dumps(args, default=str, sort_keys=True).encode()).hexdigest()
+
+
+class DownloadJournal:
+    """Append-only journal of the finished tasks of a download, so an interrupted download can resume.
+
+    Each process appends to its own file in `<journal_path>/<name>/`, one json line per entry:
+    either the key of a finished task with its status (DONE, EMPTY or SKIPPED),
+    or the pagination cursor of a long listing, saved after each page.
+    Lines go straight to the OS, so they survive the process crashing or being killed.
+    Workers only journal a task once its data is written out.
+    The journal is cleared when the download finishes."""
+
+    def __init__(self, name: str, journal_path: str = JOURNAL_PATH):
+        self.name = name
+        self.path = f"{journal_path}/{name}"
+        self._fd: int | None = None
+        self._cursors: dict[str, dict] | None = None
+
+    def _append(self, entries: Iterable[dict]):
+        if self._fd is None:
+            os.makedirs(self.path, exist_ok=True)
+            file_path = f"{self.path}/{os.getpid()}.jsonl"
+            self._fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.write(self._fd, "".join(json.dumps(entry) + "\n" for entry in entries).encode())
+
+    def record_many(self, tasks: Iterable[tuple[str, str]]):
+        """Journals (key, status) pairs in a single write"""
+        self._append({"key": key, "status": status} for key, status in tasks)
+
+    def save_cursor(self, key: str, cursor: dict):
+        """Saves where a paginated task can pick up again, e.g. the next_url and how far its file was written"""
+        self._append([{"key": key, "cursor": cursor}])
+
+    def _entries(self) -> Iterator[dict]:
+        if not os.path.exists(self.path):
+            return
+        for file_name in os.listdir(self.path):
+            with open(f"{self.path}/{file_name}", "r") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except JSONDecodeError:
+                        continue  # NOTE: the last line of a process that was killed mid-write
+
+    def completed(self) -> set[str]:
+        """Returns the keys of every finished task"""
+        return {entry["key"] for entry in self._entries() if "status" in entry}
+
+    def cursor(self, key: str) -> dict | None:
+        """Returns the furthest cursor saved for an unfinished task by a previous run, if any"""
+        if self._cursors is None:
+            self._cursors = {}
+            completed = set()
+            for entry in self._entries():
+                if "status" in entry:
+                    completed.add(entry["key"])
+                elif entry["cursor"]["count"] > self._cursors.get(entry["key"], {}).get("count", -1):
+                    self._cursors[entry["key"]] = entry["cursor"]
+            for completed_key in completed:
+                self._cursors.pop(completed_key, None)
+        return self._cursors.get(key)
+
+    def started_at(self) -> int:
+        """Returns the millisecond timestamp the download started at.
+        A download resumed after an interruption keeps the timestamp of the interrupted run"""
+        marker = f"{self.path}.started"
+        try:
+            with open(marker, "r") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            started = int(time.time() * 1000)
+            os.makedirs(os.path.dirname(marker), exist_ok=True)
+            with open(marker, "w") as f:
+                f.write(str(started))
+            return started
+
+    def clear(self):
+        """Deletes the journal once the download has finished"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._cursors = None
+        shutil.rmtree(self.path, ignore_errors=True)
+        if os.path.exists(f"{self.path}.started"):
+            os.remove(f"{self.path}.started")
+        log.debug(f"cleared the {self.name} download journal")
+
+
+def download_journal(name: str) -> DownloadJournal:
+    """Returns this process's journal with the given name (the paginator_type), creating it if needed"""
+    if name not in _download_journals:
+        _download_journals[name] = DownloadJournal(name)
+    return _download_journals[name]
+
+
+def record_failed_request(url: str):
+    """Marks the task running in the current context as failed. Called when a request is given up on"""
+    failures = _failed_requests.get()
+    if failures is not None:
+        failures.append(url)
+
+
+async def run_tracked(coro: Awaitable) -> tuple[Any, bool]:
+    """Runs a task's coroutine. Returns its result and whether any of its requests were given up on.
+    Must run as its own asyncio task, so that the failures of concurrent tasks are tracked apart"""
+    failures = []
+    _failed_requests.set(failures)
+    result = await coro
+    return result, bool(failures)
@@ -0,0 +1,145 @@
+import os
+from datetime import datetime
+
+from data_pipeline.exceptions import InvalidArgs
+
+from curator.proj_constants import LANDING_ZONE_PATH, STORAGE_BACKEND, log
+from curator.utils import timestamp_now
+
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # NOTE: pyarrow is optional. Only the parquet storage backend needs it
+    pa = None
+    pq = None
+
+_landing_zone_writers = {}  # this process's writers by (paginator_type, underlying). See landing_zone_writer()
+
+AGGS_FIELDS = [
+    ("v", "float64"),
+    ("vw", "float64"),
+    ("o", "float64"),
+    ("c", "float64"),
+    ("h", "float64"),
+    ("l", "float64"),
+    ("t", "int64"),
+    ("n", "int64"),
+]
+
+# typed schema of the records stored for each paginator_type
+SCHEMA_FIELDS = {
+    "StockPrices": AGGS_FIELDS + [("otc", "bool_"), ("ticker", "string")],
+    "OptionsPrices": AGGS_FIELDS + [("options_ticker", "string")],
+    "OptionsQuotes": [
+        ("ask_exchange", "int32"),
+        ("ask_price", "float64"),
+        ("ask_size", "int64"),
+        ("bid_exchange", "int32"),
+        ("bid_price", "float64"),
+        ("bid_size", "int64"),
+        ("sequence_number", "int64"),
+        ("sip_timestamp", "int64"),
+        ("options_ticker_id", "int64"),
+    ],
+}
+
+
+def parquet_enabled() -> bool:
+    """True if raw data is stored in the parquet landing zone instead of json files"""
+    if STORAGE_BACKEND not in ("json", "parquet"):
+        raise InvalidArgs(f"Unknown storage backend: {STORAGE_BACKEND}. Must be 'json' or 'parquet'")
+    if STORAGE_BACKEND == "parquet" and pa is None:
+        raise InvalidArgs("The parquet storage backend requires pyarrow. Install the extra with `poetry install -E parquet`")
+    return STORAGE_BACKEND == "parquet"
+
+
+def schema(paginator_type: str) -> "pa.Schema":
+    return pa.schema([(name, getattr(pa, type_)()) for name, type_ in SCHEMA_FIELDS[paginator_type]])
+
+
+def partition_path(paginator_type: str, underlying: str, load_date: str = "") -> str:
+    """Directory of a partition, e.g. "~/.polygon_data/parquet/OptionsQuotes/underlying=SPY/date=2024-06-03".
+    The date is the day the data was downloaded"""
+    load_date = load_date or datetime.now().strftime("%Y-%m-%d")
+    return f"{LANDING_ZONE_PATH}/{paginator_type}/underlying={underlying}/date={load_date}"
+
+
+class ParquetPartitionWriter:
+    """Buffers the records of one paginator_type and underlying ticker,
+    and writes them as zstd compressed parquet files of up to `flush_rows` rows into today's partition.
+    Each process writes its own part files, so no file is shared between processes."""
+
+    def __init__(self, paginator_type: str, underlying: str, flush_rows: int = 250000):
+        self.paginator_type = paginator_type
+        self.underlying = underlying
+        self.flush_rows = flush_rows
+        self.schema = schema(paginator_type)
+        self.count = 0
+        self._rows: list[dict] = []
+
+    def write(self, records: list[dict]):
+        """Buffers the records. Keys that aren't in the schema are dropped"""
+        self._rows.extend(records)
+        self.count += len(records)
+        if len(self._rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        path = partition_path(self.paginator_type, self.underlying)
+        os.makedirs(path, exist_ok=True)
+        file_name = f"{path}/part-{os.getpid()}-{timestamp_now()}.parquet"
+        table = pa.Table.from_pylist(self._rows, schema=self.schema)
+        pq.write_table(table, file_name, compression="zstd")
+        log.debug(f"{table.num_rows} rows written to {file_name}")
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        log.info(f"{self.count} {self.paginator_type} records written for {self.underlying}")
+
+
+def landing_zone_writer(paginator_type: str, underlying: str) -> ParquetPartitionWriter:
+    """Returns this process's writer for the paginator_type and underlying ticker, creating it if needed"""
+    key = (paginator_type, underlying)
+    if key not in _landing_zone_writers:
+        _landing_zone_writers[key] = ParquetPartitionWriter(paginator_type, underlying)
+    return _landing_zone_writers[key]
+
+
+def close_landing_zone_writers():
+    """Writes out the buffered rows of every writer in this process. Call before the process exits"""
+    while _landing_zone_writers:
+        _, writer = _landing_zone_writers.popitem()
+        writer.close()
+
+
+def latest_partition_files(paginator_type: str, underlying: str, since: int | None = None) -> list[str]:
+    """Returns the part files of the most recent load date of an underlying ticker.
+    With `since` (a millisecond timestamp), the part files written since then instead, e.g. by this run"""
+    path = f"{LANDING_ZONE_PATH}/{paginator_type}/underlying={underlying}"
+    if not os.path.exists(path):
+        return []
+    load_dates = sorted(d for d in os.listdir(path) if d.startswith("date="))
+    if not load_dates:
+        return []
+    if since is None:
+        latest = f"{path}/{load_dates[-1]}"
+        return [f"{latest}/{f}" for f in sorted(os.listdir(latest)) if f.endswith(".parquet")]
+
+    first_date = "date=" + datetime.fromtimestamp(since / 1000).strftime("%Y-%m-%d")
+    return [
+        f"{path}/{load_date}/{f}"
+        for load_date in load_dates
+        if load_date >= first_date
+        for f in sorted(os.listdir(f"{path}/{load_date}"))
+        # NOTE: part-<pid>-<timestamp>.parquet
+        if f.endswith(".parquet") and int(f[: -len(".parquet")].rsplit("-", 1)[1]) >= since
+    ]
+
+
+def read_columns(file_path: str, columns: list[str]) -> "pa.Table":
+    """Reads only the given columns of a part file"""
+    return pq.read_table(file_path, columns=columns)
@@ -5,6 +5,7 @@ import typer
 from data_pipeline.orchestrator import (
     import_all,
     import_partial,
+    refresh_import,
     remove_tickers_from_universe,
 )
 
@@ -106,7 +107,7 @@ def refresh(
             " 3: options contracts,"
             " 4: options prices,"
             " 5: options snapshots,"
-            # " 6: options quotes"
+            " 6: options quotes"
         ),
     ),
     start_date: datetime = typer.Option(
@@ -126,8 +127,12 @@ def refresh(
         help="Months of historical options contracts to pull. **Only works if you DO NOT specify a start/end date**",
     ),
 ):
-    # TODO: a logic to look up the date of the most recent pull and set as start date
-    pass
+    """Incrementally pulls only the data newer than what is already stored in the db.
+    `start_date` / `months_hist` only apply to tickers and contracts with no stored data yet"""
+    if all_tickers:
+        tickers = []
+
+    asyncio.run(refresh_import(tickers, start_date, end_date, months_hist, partial))
 
 
 @app.command(name="remove")
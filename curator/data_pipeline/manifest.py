@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import time
+
+from curator.proj_constants import BASE_DOWNLOAD_PATH
+
+_download_manifest = None  # the manifest connection used in this process. Created by `download_manifest()`
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    file_path TEXT PRIMARY KEY,
+    paginator_type TEXT NOT NULL,
+    underlying TEXT NOT NULL,
+    contract TEXT NOT NULL DEFAULT '',
+    as_of TEXT NOT NULL DEFAULT '',
+    written_at INTEGER NOT NULL,
+    byte_size INTEGER NOT NULL,
+    record_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS downloads_latest
+    ON downloads (paginator_type, underlying, contract, as_of, written_at);
+"""
+
+SQL_PARAMS_MAX = 900  # underlyings per query, well under sqlite's limit on bound params
+RECORD_BATCH = 500  # rows buffered before they are inserted in one transaction
+
+
+class DownloadManifest:
+    """Index of the files written by the paginators, in a SQLite db next to the downloads.
+
+    Each download adds one row: paginator type, underlying, contract, as_of, file path, size and record count.
+    `contract` and `as_of` are empty strings for data types that don't have them.
+    The runners find the files to upload with an indexed query instead of listing every directory.
+    The db is in WAL mode, so every download process can write to it at the same time.
+    Rows are buffered and inserted `RECORD_BATCH` at a time in one transaction.
+    Call `commit()` before the files are journaled as finished and before the process exits."""
+
+    def __init__(self, db_path: str = f"{BASE_DOWNLOAD_PATH}/manifest.sqlite"):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")  # NOTE: still durable across crashes of the process
+        self._conn.executescript(SCHEMA)
+        self._rows: list[tuple] = []
+
+    def record(
+        self,
+        paginator_type: str,
+        underlying: str,
+        file_path: str,
+        record_count: int,
+        contract: str = "",
+        as_of: str = "",
+        written_at: int | None = None,
+    ):
+        """Adds a written file to the manifest. `written_at` is the millisecond timestamp of the download.
+        The row is buffered until `RECORD_BATCH` rows are, or until `commit()`"""
+        self._rows.append(
+            (
+                file_path,
+                paginator_type,
+                underlying,
+                contract,
+                as_of,
+                written_at if written_at is not None else int(time.time() * 1000),
+                os.path.getsize(file_path),
+                record_count,
+            )
+        )
+        if len(self._rows) >= RECORD_BATCH:
+            self.commit()
+
+    def commit(self):
+        """Inserts the buffered rows in one transaction"""
+        if not self._rows:
+            return
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._rows
+            )
+        self._rows = []
+
+    def _query(self, sql: str, paginator_type: str, underlyings: list[str], params: tuple = ()) -> list[tuple]:
+        """Runs `sql` for chunks of the underlyings. `{underlyings}` in `sql` is replaced by the placeholders.
+        `params` are bound after the underlyings"""
+        rows = []
+        for i in range(0, len(underlyings), SQL_PARAMS_MAX):
+            chunk = underlyings[i : i + SQL_PARAMS_MAX]
+            placeholders = ", ".join("?" * len(chunk))
+            rows.extend(
+                self._conn.execute(sql.format(underlyings=placeholders), (paginator_type, *chunk, *params))
+            )
+        return rows
+
+    def latest_files(
+        self, paginator_type: str, underlyings: list[str], since: int = 0
+    ) -> dict[tuple[str, str, str], str]:
+        """Returns the most recent file of every (underlying, contract, as_of) of the underlyings.
+        With `since` (a millisecond timestamp), only the files written since then, e.g. by the current run"""
+        rows = self._query(
+            """
+            SELECT underlying, contract, as_of, file_path, MAX(written_at) FROM downloads
+            WHERE paginator_type = ? AND underlying IN ({underlyings}) AND written_at >= ?
+            GROUP BY underlying, contract, as_of
+            """,
+            paginator_type,
+            list(underlyings),
+            (since,),
+        )
+        return {(underlying, contract, as_of): file_path for underlying, contract, as_of, file_path, _ in rows}
+
+    def latest_download(self, paginator_type: str, underlyings: list[str]) -> dict[str, list[str]]:
+        """Returns all files written by the most recent download of each underlying,
+        for data types that write several files per download, e.g. one per page of a chain snapshot"""
+        rows = self._query(
+            """
+            SELECT d.underlying, d.file_path FROM downloads d
+            JOIN (
+                SELECT paginator_type, underlying, MAX(written_at) AS written_at FROM downloads
+                WHERE paginator_type = ? AND underlying IN ({underlyings})
+                GROUP BY underlying
+            ) latest USING (paginator_type, underlying, written_at)
+            """,
+            paginator_type,
+            list(underlyings),
+        )
+        files: dict[str, list[str]] = {}
+        for underlying, file_path in sorted(rows):
+            files.setdefault(underlying, []).append(file_path)
+        return files
+
+    def written_times(self, paginator_type: str, underlying: str, as_of: str = "") -> list[int]:
+        """Returns the millisecond timestamps of the downloads of an underlying's listing"""
+        rows = self._conn.execute(
+            "SELECT written_at FROM downloads WHERE paginator_type = ? AND underlying = ? AND as_of = ?",
+            (paginator_type, underlying, as_of),
+        )
+        return [written_at for (written_at,) in rows]
+
+
+def download_manifest() -> DownloadManifest:
+    """Returns the download manifest for this process, opening it if needed"""
+    global _download_manifest
+    if _download_manifest is None:
+        _download_manifest = DownloadManifest()
+    return _download_manifest
+
+
+def commit_download_manifest():
+    """Inserts the rows this process buffered in the download manifest, if it opened it"""
+    if _download_manifest is not None:
+        _download_manifest.commit()
@@ -1,4 +1,6 @@
+import functools
 from datetime import datetime
+from typing import Awaitable, Callable
 
 from data_pipeline.download import (
     download_options_contracts,
@@ -8,6 +10,8 @@ from data_pipeline.download import (
     download_stock_metadata,
     download_stock_prices,
 )
+from data_pipeline.priority import DownloadPriority
+from data_pipeline.stages import StageGraph
 from data_pipeline.uploader import (
     upload_options_contracts,
     upload_options_prices,
@@ -16,125 +20,183 @@ from data_pipeline.uploader import (
     upload_stock_metadata,
     upload_stock_prices,
 )
-from db_tools.queries import delete_stock_ticker, latest_date_per_ticker
-from db_tools.utils import generate_o_ticker_lookup, pull_tickers_from_db
-from pandas import DataFrame
+from db_tools.queries import delete_stock_ticker
+from db_tools.utils import (
+    generate_o_ticker_lookup,
+    pull_stock_price_watermarks,
+    pull_tickers_from_db,
+    split_quotes_and_prices_dates,
+)
 
 from curator.proj_constants import log
+from curator.utils import months_ago
 
+ALL_COMPONENTS = [1, 2, 3, 4, 5, 6]
 
-async def import_all(tickers: list, start_date: datetime, end_date: datetime, months_hist: int):
-    """this is THE trigger function. It will do the following:
-
-    1. Download all metadata and prices for both stocks and options
-    2. It will clean that data
-    3. It will upload that data to the database
-
-    The goal is for this to be able to create the process pools required for each step.
-
-    May add toggle if "refreshing" the data or pulling everything fresh.
-    As of now, refreshing won't change anything. Pull all history everytime.
-    """
-    all_ = True if len(tickers) == 0 else False
-    # Download and upload metadata
 
-    await download_stock_metadata(tickers=tickers, all_=all_)
-    await upload_stock_metadata(tickers=tickers, all_=all_)
+def _stock_metadata_stage(tickers: list, all_: bool) -> Callable[[], Awaitable]:
+    async def stock_metadata():
+        await download_stock_metadata(tickers=tickers, all_=all_)
+        await upload_stock_metadata(tickers=tickers, all_=all_)
 
-    # Get ticker_id_lookup from db
-    ticker_lookup = await pull_tickers_from_db(tickers, all_=all_)
+    return stock_metadata
 
-    # Download and upload options contract data
-    await download_options_contracts(ticker_id_lookup=ticker_lookup, months_hist=months_hist)
-    await upload_options_contracts(ticker_lookup, months_hist=months_hist)
 
-    # Download and upload current snapshot of options contracts
-    o_tickers = await generate_o_ticker_lookup(tickers, all_=all_, unexpired=True)
+def _stock_prices_stage(
+    tickers: list, start_date: datetime, end_date: datetime, refresh: bool
+) -> Callable[..., Awaitable]:
+    async def stock_prices(ticker_lookup: dict):
+        watermarks = await pull_stock_price_watermarks(tickers) if refresh else None
+        started = await download_stock_prices(ticker_lookup, start_date, end_date, watermarks=watermarks)
+        await upload_stock_prices(ticker_lookup, since=started)
 
-    await download_options_snapshots(list(o_tickers.values()))
-    await upload_options_snapshots(o_tickers)
+    return stock_prices
 
-    # Download and upload options prices data
-    o_tickers = await generate_o_ticker_lookup(tickers, all_=all_)
 
-    await download_options_prices(o_tickers=list(o_tickers.values()), months_hist=months_hist)
-    await upload_options_prices(o_tickers)
+def _options_contracts_stage(months_hist: int, refresh: bool) -> Callable[..., Awaitable]:
+    async def options_contracts(ticker_lookup: dict):
+        if refresh:
+            # NOTE: past "as_of" listings don't change. Only the current and newly closed months are pulled
+            await download_options_contracts(
+                ticker_id_lookup=ticker_lookup, months_hist=months_hist, incremental=True
+            )
+            await upload_options_contracts(
+                ticker_lookup, months_hist=1, hist_limit_date=months_ago(months=2).strftime("%Y-%m-%d")
+            )
+        else:
+            await download_options_contracts(ticker_id_lookup=ticker_lookup, months_hist=months_hist)
+            await upload_options_contracts(ticker_lookup, months_hist=months_hist)
+
+    return options_contracts
+
+
+def _options_prices_stage(months_hist: int) -> Callable[..., Awaitable]:
+    async def options_prices(o_tickers: dict, priority: DownloadPriority, watermarks: tuple = (None, None)):
+        started = await download_options_prices(
+            o_tickers=priority.contracts(o_tickers.values()),
+            months_hist=months_hist,
+            watermarks=watermarks[0],
+        )
+        # NOTE: only the files of this run. Contracts that weren't downloaded again are left as they are
+        await upload_options_prices(o_tickers, since=started)
+
+    return options_prices
+
+
+def _options_snapshots_stage() -> Callable[..., Awaitable]:
+    async def options_snapshots(unexpired_o_tickers: dict):
+        await download_options_snapshots(list(unexpired_o_tickers.values()), chain=True)
+        await upload_options_snapshots(unexpired_o_tickers, chain=True)
+
+    return options_snapshots
+
+
+def _options_quotes_stage(months_hist: int, refresh: bool) -> Callable[..., Awaitable]:
+    async def options_quotes(
+        ticker_lookup: dict, o_tickers: dict, priority: DownloadPriority, watermarks: tuple = (None, None)
+    ):
+        final_tickers = priority.underlyings(ticker_lookup.keys())
+        action = "refreshing" if refresh else "downloading"
+        log.info(f"{action} quotes for {len(final_tickers)} underlyings")
+        # NOTE: each underlying is uploaded as soon as its quotes are in, while the next ones download
+        failed_paths = await download_options_quotes(
+            tickers=final_tickers,
+            o_tickers=priority.contracts(o_tickers.values()),
+            months_hist=months_hist,
+            watermarks=watermarks[1],
+            on_ticker_done=upload_options_quotes,
+        )
+        log.info(f"failed to parse these paths: {failed_paths}")
+        log.info("-- Done Uploading Quote Data")
 
-    # Download and upload quotes
-    final_tickers = list(ticker_lookup.keys())
-    failed_paths = []
-    ticker_counter = 0
-    for ticker in final_tickers:
-        ticker_counter += 1
-        log.info(f"downloading quotes for {ticker} ({ticker_counter}/{len(final_tickers)})")
-        download_options_quotes(ticker=ticker, o_tickers=list(o_tickers.values()), months_hist=months_hist)
-        temp_paths = upload_options_quotes(ticker)
-        failed_paths.append(temp_paths)
-    log.info(f"failed to parse these paths: {failed_paths}")
-    log.info("-- Done Uploading Quote Data")
+    return options_quotes
 
-    # Download and upload underlying stock prices
-    # NOTE: at the end due to it being the free api
-    await download_stock_prices(ticker_lookup, start_date, end_date)
-    await upload_stock_prices(ticker_lookup)
 
+def build_import_graph(
+    partial: list[int],
+    tickers: list,
+    start_date: datetime,
+    end_date: datetime,
+    months_hist: int,
+    refresh: bool = False,
+) -> StageGraph:
+    """Builds the stage graph that downloads, cleans, and uploads the components in `partial`.
 
-async def import_partial(
-    partial: list[int], tickers: list, start_date: datetime, end_date: datetime, months_hist: int
-):
-    """This will download, clean, and upload data for the components specified in `partial`
-    This is meant to be used on an adhoc basis to fill in data gaps or backfill changes
-    """
+    Components only wait for the inputs they declare (the ticker lookup, the o_ticker lookups,
+    and the options contracts when they are part of the run). Independent components run concurrently,
+    e.g. the stock prices alongside the options contracts, and the snapshots alongside the options prices.
+    The stages of each component are built by the `_<component>_stage()` helpers, this only wires them up.
 
+    With `refresh`, only the data newer than what is stored in the db is pulled (see `refresh_import()`)"""
     all_ = True if len(tickers) == 0 else False
-    ticker_lookup = None
-    o_tickers = None
+    graph = StageGraph("refresh" if refresh else "import")
+    # NOTE: (price_watermarks, quote_watermarks) when refreshing
+    watermark_needs = ["watermarks"] if refresh else []
 
     if 1 in partial:  # stock metadata
-        await download_stock_metadata(tickers=tickers, all_=all_)
-        await upload_stock_metadata(tickers=tickers, all_=all_)
+        graph.add("stock_metadata", _stock_metadata_stage(tickers, all_))
+
+    if {2, 3, 6} & set(partial):
+        lookup = functools.partial(pull_tickers_from_db, tickers, all_)
+        graph.add("ticker_lookup", lookup, after=["stock_metadata"], uses_pool=False)
 
     if 2 in partial:  # stock prices
-        ticker_lookup = await pull_tickers_from_db(tickers, all_)
-        await download_stock_prices(ticker_lookup, start_date, end_date)
-        await upload_stock_prices(ticker_lookup)
+        stock_prices = _stock_prices_stage(tickers, start_date, end_date, refresh)
+        graph.add("stock_prices", stock_prices, needs=["ticker_lookup"])
 
     if 3 in partial:  # options contracts
-        if not ticker_lookup:
-            ticker_lookup = await pull_tickers_from_db(tickers, all_)
-        await download_options_contracts(ticker_id_lookup=ticker_lookup, months_hist=months_hist)
-        await upload_options_contracts(ticker_lookup, months_hist=months_hist)
+        graph.add("options_contracts", _options_contracts_stage(months_hist, refresh), needs=["ticker_lookup"])
+
+    if 4 in partial or 6 in partial:
+        # NOTE: the most liquid underlyings and the contracts nearest the money and expiration are pulled first
+        graph.add("priority", functools.partial(DownloadPriority.load, tickers), uses_pool=False)
+        o_tickers = functools.partial(generate_o_ticker_lookup, tickers, all_=all_)
+        graph.add("o_tickers", o_tickers, after=["options_contracts"], uses_pool=False)
+        if refresh:
+            watermarks = functools.partial(split_quotes_and_prices_dates, tickers)
+            graph.add("watermarks", watermarks, after=["options_contracts"], uses_pool=False)
 
     if 4 in partial:  # options prices
-        o_tickers = await generate_o_ticker_lookup(tickers, all_=all_)
-        await download_options_prices(o_tickers=list(o_tickers.values()), months_hist=months_hist)
-        await upload_options_prices(o_tickers)
+        options_prices = _options_prices_stage(months_hist)
+        graph.add("options_prices", options_prices, needs=["o_tickers", "priority", *watermark_needs])
 
     if 5 in partial:  # snapshots
-        if not o_tickers:
-            o_tickers = await generate_o_ticker_lookup(tickers, all_=all_, unexpired=True)
-        await download_options_snapshots(list(o_tickers.values()))
-        await upload_options_snapshots(o_tickers)
+        unexpired_o_tickers = functools.partial(generate_o_ticker_lookup, tickers, all_=all_, unexpired=True)
+        graph.add("unexpired_o_tickers", unexpired_o_tickers, after=["options_contracts"], uses_pool=False)
+        graph.add("options_snapshots", _options_snapshots_stage(), needs=["unexpired_o_tickers"])
 
     if 6 in partial:  # quotes
-        if not ticker_lookup:
-            ticker_lookup = await pull_tickers_from_db(tickers, all_)
-        if not o_tickers:
-            o_tickers = await generate_o_ticker_lookup(tickers, all_=all_)
-
-        final_tickers = list(ticker_lookup.keys())
-        failed_paths = []
-        ticker_counter = 0
-        for ticker in final_tickers:
-            ticker_counter += 1
-            log.info(f"downloading quotes for {ticker}  ({ticker_counter}/{len(final_tickers)})")
-            await download_options_quotes(
-                ticker=ticker, o_tickers=list(o_tickers.values()), months_hist=months_hist
-            )
-            temp_paths = await upload_options_quotes(ticker)
-            failed_paths.append(temp_paths)
-        log.info(f"failed to parse these paths: {failed_paths}")
-        log.info("-- Done Uploading Quote Data")
+        options_quotes = _options_quotes_stage(months_hist, refresh)
+        graph.add(
+            "options_quotes", options_quotes, needs=["ticker_lookup", "o_tickers", "priority", *watermark_needs]
+        )
+
+    return graph
+
+
+async def import_all(tickers: list, start_date: datetime, end_date: datetime, months_hist: int):
+    """this is THE trigger function. It will do the following:
+
+    1. Download all metadata and prices for both stocks and options
+    2. It will clean that data
+    3. It will upload that data to the database
+
+    The goal is for this to be able to create the process pools required for each step.
+    The components run as a stage graph, see `build_import_graph()`.
+
+    May add toggle if "refreshing" the data or pulling everything fresh.
+    As of now, refreshing won't change anything. Pull all history everytime.
+    """
+    await import_partial(ALL_COMPONENTS, tickers, start_date, end_date, months_hist)
+
+
+async def import_partial(
+    partial: list[int], tickers: list, start_date: datetime, end_date: datetime, months_hist: int
+):
+    """This will download, clean, and upload data for the components specified in `partial`
+    This is meant to be used on an adhoc basis to fill in data gaps or backfill changes
+    """
+    await build_import_graph(partial, tickers, start_date, end_date, months_hist).run()
 
 
 async def remove_tickers_from_universe(tickers: list[str]):
@@ -148,29 +210,12 @@ async def remove_tickers_from_universe(tickers: list[str]):
 async def refresh_import(
     tickers: list, start_date: datetime, end_date: datetime, months_hist: int, partial: list[int]
 ):
-    """refreshes all or partial components for the given tickers
-    start date and end date is set to today, start date from the most recent going back to 24 months at most"""
-    all_ = True if len(tickers) == 0 else False
-
-    await download_stock_metadata(tickers=tickers, all_=all_)
-    await upload_stock_metadata(tickers=tickers, all_=all_)
-
-    ticker_lookup = await pull_tickers_from_db(tickers, all_)
-
-    if 2 in partial:
-        dates = await latest_date_per_ticker(tickers=tickers, options=False)
-        dates = DataFrame(dates)
-        min_date = dates["latest_date"].min() if dates["latest_date"].min() >= start_date else start_date
-        await download_stock_prices(ticker_lookup, min_date, end_date)
-        await upload_stock_prices(ticker_lookup)
-
-    if 3 in partial:
-        await download_options_contracts(ticker_id_lookup=ticker_lookup, months_hist=months_hist)
-        await upload_options_contracts(ticker_lookup, months_hist=months_hist)
-
-    if 4 in partial:
-        o_tickers = await generate_o_ticker_lookup(tickers, all_=all_)
-        dates = await latest_date_per_ticker(tickers=tickers, options=True)
+    """Incrementally refreshes the components in `partial` for the given tickers.
+    It reads the high-water mark (latest stored date) of every ticker and options contract,
+    and only requests the prices and quotes newer than the mark. Expired contracts already caught up are skipped.
+    Tickers and contracts without a mark are pulled from `start_date` / `months_hist` like a regular import.
+    Runtime scales with the new data rather than with the depth of history"""
+    await build_import_graph(partial, tickers, start_date, end_date, months_hist, refresh=True).run()
 
 
 # if __name__ == "__main__":
@@ -4,6 +4,8 @@ from datetime import datetime
 from json import JSONDecodeError
 from typing import Any, Generator
 
+from data_pipeline.landing_zone import SCHEMA_FIELDS, latest_partition_files, read_columns
+from data_pipeline.manifest import download_manifest
 from db_tools.queries import (
     update_options_prices,
     update_options_quotes,
@@ -14,11 +16,13 @@ from db_tools.queries import (
 )
 from db_tools.utils import OptionTicker
 
-from curator.proj_constants import BASE_DOWNLOAD_PATH, POSTGRES_BATCH_MAX, log
+from curator.proj_constants import BASE_DOWNLOAD_PATH, LANDING_ZONE_PATH, POSTGRES_BATCH_MAX, log
 from curator.utils import (
     clean_o_ticker,
     months_ago,
     read_data_from_file,
+    read_jsonl_file,
+    string_to_date,
     timestamp_now,
     timestamp_to_datetime,
 )
@@ -93,7 +97,10 @@ class PathRunner(ABC):
         log.info(f"uploading data from {file_path}")
         close_file = True if self.runner_type == "OptionsQuotes" else False
         try:
-            raw_data = read_data_from_file(file_path, close_file)
+            if file_path.endswith(".jsonl"):
+                raw_data = read_jsonl_file(file_path)
+            else:
+                raw_data = read_data_from_file(file_path, close_file)
         except FileNotFoundError:
             log.warning(f"file not found at: {file_path} for {self.runner_type}, with ticker: {ticker_data}")
             raw_data = None
@@ -162,11 +169,13 @@ class MetaDataRunner(PathRunner):
 
 
 class StockPricesRunner(PathRunner):
-    """Runner for stock prices local data"""
+    """Runner for stock prices local data.
+    With `since` (a millisecond timestamp), only the files downloaded since then are uploaded (by this run)"""
 
     runner_type = "StockPrices"
 
-    def __init__(self):
+    def __init__(self, since: int | None = None):
+        self.since = since
         super().__init__()
 
     def generate_path_args(self, ticker_id_lookup: dict) -> list[tuple[str, tuple[int]]]:
@@ -175,33 +184,35 @@ class StockPricesRunner(PathRunner):
             raise FileNotFoundError
 
         tickers = list(ticker_id_lookup.keys())
+        latest_files = download_manifest().latest_files(self.runner_type, tickers, since=self.since or 0)
         path_args = []
         for ticker in tickers:
-            temp_path = self.base_directory + "/" + ticker
-            path_args.append(
-                (
-                    self._determine_most_recent_file(temp_path),
-                    (ticker_id_lookup[ticker],),  # a tuple
-                )
-            )
+            file = latest_files.get((ticker, "", ""))
+            if file is None:
+                if self.since is not None:  # NOTE: not downloaded by this run
+                    continue
+                file = self._determine_most_recent_file(self.base_directory + "/" + ticker)  # pre-manifest
+            path_args.append((file, (ticker_id_lookup[ticker],)))  # a tuple
         return path_args
 
     async def upload_func(self, data: list[dict]):
         return await update_stock_prices(data)
 
+    key_mapping = {
+        "v": "volume",
+        "vw": "volume_weight_price",
+        "c": "close_price",
+        "o": "open_price",
+        "h": "high_price",
+        "l": "low_price",
+        "t": "as_of_date",
+        "n": "number_of_transactions",
+        "otc": "otc",
+    }
+
     def clean_data(self, results: list[dict], ticker_id: tuple[int]) -> list[dict]:
         clean_results = []
-        key_mapping = {
-            "v": "volume",
-            "vw": "volume_weight_price",
-            "c": "close_price",
-            "o": "open_price",
-            "h": "high_price",
-            "l": "low_price",
-            "t": "as_of_date",
-            "n": "number_of_transactions",
-            "otc": "otc",
-        }
+        key_mapping = self.key_mapping
         for page in results:
             if page.get("results"):
                 for record in page.get("results"):
@@ -246,7 +257,7 @@ class OptionsContractsRunner(PathRunner):
 
         Returns:
             path_args: list of tuples containing the file path and the ticker idto be passed to the pool.
-            e.g. "(~/.polygon_data/OptionsContracts/SPY/2022-06-01/1688127754374.json, (9912,))"
+            e.g. "(~/.polygon_data/OptionsContracts/SPY/2022-06-01/1688127754374.json, (9912, "2022-06-01"))"
         """
         # NOTE: may need try/except in case specific ticker files didn't successfully download
         if not os.path.exists(self.base_directory):
@@ -254,23 +265,27 @@ class OptionsContractsRunner(PathRunner):
             raise FileNotFoundError
 
         tickers = list(ticker_id_lookup.keys())
+        latest_files: dict[str, dict[str, str]] = {}
+        for (ticker, _, as_of), file in download_manifest().latest_files(self.runner_type, tickers).items():
+            latest_files.setdefault(ticker, {})[as_of] = file
+
         path_args = []
         for ticker in tickers:
-            temp_dir_list = os.listdir(self.base_directory + "/" + ticker)
-            temp_dir_list.append(self.hist_limit_date)
-            temp_dir_list.sort(reverse=True)
-            i = temp_dir_list.index(self.hist_limit_date)
-            for date in temp_dir_list[:i]:
-                temp_path = f"{self.base_directory}/{ticker}/{date}"
-                path_args.append(
-                    (
-                        self._determine_most_recent_file(temp_path),
-                        (ticker_id_lookup[ticker],),  # a tuple
-                    )
-                )
+            ticker_files = latest_files.get(ticker, {})
+            ticker_path = f"{self.base_directory}/{ticker}"
+            for date in os.listdir(ticker_path) if os.path.exists(ticker_path) else []:
+                if date not in ticker_files and date > self.hist_limit_date:
+                    # NOTE: a month downloaded before the manifest existed
+                    ticker_files[date] = self._determine_most_recent_file(f"{ticker_path}/{date}")
+            for date in sorted(ticker_files, reverse=True):
+                if date > self.hist_limit_date:
+                    # a tuple of the ticker id and the "as_of" date
+                    path_args.append((ticker_files[date], (ticker_id_lookup[ticker], date)))
         return path_args
 
-    def clean_data(self, results: list[dict], ticker_id: tuple[int]) -> list[dict]:
+    def clean_data(self, results: list[dict], ticker_id: tuple[int, str]) -> list[dict]:
+        """The "as_of" date of the listing is stored as `first_listed_as_of`.
+        The db keeps the earliest one, i.e. the first monthly listing the contract appeared in"""
         # TODO: make sure this fits the json data schema
         clean_results = []
         key_mapping = {
@@ -287,6 +302,7 @@ class OptionsContractsRunner(PathRunner):
             for record in page.get("results"):
                 t = {key_mapping[key]: record.get(key) for key in key_mapping}
                 t["underlying_ticker_id"] = ticker_id[0]
+                t["first_listed_as_of"] = string_to_date(ticker_id[1])
                 clean_results.append(t)
         clean_results = list({v["options_ticker"]: v for v in clean_results}.values())
         # NOTE: the list(comprehension) above ascertains that all options_tickers are unique
@@ -294,13 +310,26 @@ class OptionsContractsRunner(PathRunner):
 
 
 class OptionsPricesRunner(PathRunner):
-    """Runner for options prices local data"""
+    """Runner for options prices local data.
+    With `since` (a millisecond timestamp), only the files downloaded since then are uploaded (by this run)"""
 
     runner_type = "OptionsPrices"
 
-    def __init__(self):
+    def __init__(self, since: int | None = None):
+        self.since = since
         super().__init__()
 
+    key_mapping = {
+        "v": "volume",
+        "vw": "volume_weight_price",
+        "c": "close_price",
+        "o": "open_price",
+        "h": "high_price",
+        "l": "low_price",
+        "t": "as_of_date",
+        "n": "number_of_transactions",
+    }
+
     def _make_o_ticker(self, clean_o_ticker: str) -> str:
         """re-adds the option prefix to the clean options ticker"""
         return f"O:{clean_o_ticker}"
@@ -322,10 +351,19 @@ class OptionsPricesRunner(PathRunner):
             log.warning("no options contracts found. Download options contracts first!")
             raise FileNotFoundError
 
+        underlyings = list({x.underlying_ticker for x in o_tickers_lookup.values()})
+        latest_files = download_manifest().latest_files(self.runner_type, underlyings, since=self.since or 0)
         o_tickers = o_tickers_lookup.keys()
         path_args = []
         for o_ticker in o_tickers:
-            temp_path = (
+            file = latest_files.get((o_tickers_lookup[o_ticker].underlying_ticker, o_ticker, ""))
+            if file is not None:
+                path_args.append((file, o_tickers_lookup[o_ticker]))
+                continue
+            if self.since is not None:  # NOTE: not downloaded by this run
+                continue
+
+            temp_path = (  # NOTE: not in the manifest. Either not downloaded or downloaded before it existed
                 self.base_directory
                 + "/"
                 + o_tickers_lookup[o_ticker].underlying_ticker
@@ -351,16 +389,7 @@ class OptionsPricesRunner(PathRunner):
             OptionTicker named tuple containing o_ticker, id, expiration_date, underlying_ticker.
         """
         clean_results = []
-        key_mapping = {
-            "v": "volume",
-            "vw": "volume_weight_price",
-            "c": "close_price",
-            "o": "open_price",
-            "h": "high_price",
-            "l": "low_price",
-            "t": "as_of_date",
-            "n": "number_of_transactions",
-        }
+        key_mapping = self.key_mapping
         if isinstance(results, list):
             for page in results:
                 for record in page:
@@ -390,42 +419,119 @@ class OptionsSnapshotRunner(OptionsPricesRunner):
         results = results[0]
         clean_results = {}
         if isinstance(results, dict) and results.get("results"):
-            results = results.get("results")
-            clean_results["options_ticker_id"] = o_ticker.id
-            clean_results["as_of_date"] = timestamp_to_datetime(
-                results.get("last_quote", {}).get("last_updated", timestamp_now() * 1000000) / 1000000,
-            ).date()
-            clean_results["implied_volatility"] = results.get("implied_volatility", 0.0)
-            clean_results["delta"] = results.get("greeks", {}).get("delta", 0.0)
-            clean_results["gamma"] = results.get("greeks", {}).get("gamma", 0.0)
-            clean_results["theta"] = results.get("greeks", {}).get("theta", 0.0)
-            clean_results["vega"] = results.get("greeks", {}).get("vega", 0.0)
-            clean_results["open_interest"] = results.get("open_interest", 0)
+            clean_results = self._clean_snapshot(results.get("results"), o_ticker.id)
         return [clean_results]
 
+    def _clean_snapshot(self, snapshot: dict, options_ticker_id: int) -> dict:
+        """Cleans the snapshot of a single contract into a record for the db"""
+        return {
+            "options_ticker_id": options_ticker_id,
+            "as_of_date": timestamp_to_datetime(
+                snapshot.get("last_quote", {}).get("last_updated", timestamp_now() * 1000000) / 1000000,
+            ).date(),
+            "implied_volatility": snapshot.get("implied_volatility", 0.0),
+            "delta": snapshot.get("greeks", {}).get("delta", 0.0),
+            "gamma": snapshot.get("greeks", {}).get("gamma", 0.0),
+            "theta": snapshot.get("greeks", {}).get("theta", 0.0),
+            "vega": snapshot.get("greeks", {}).get("vega", 0.0),
+            "open_interest": snapshot.get("open_interest", 0),
+        }
+
     async def upload_func(self, data: list[dict]):
         return await update_options_snapshot(data)
 
 
-class OptionsQuoteRunner(OptionsPricesRunner):
-    """Runner for options quote data"""
+class OptionsChainSnapshotRunner(OptionsSnapshotRunner):
+    """Runner for options chain snapshot data. Each file is one page of a chain and is uploaded in bulk"""
 
-    runner_type = "OptionsQuotes"
+    runner_type = "ChainSnapshot"
 
     def __init__(self):
         super().__init__()
 
+    def generate_path_args(self, o_tickers_lookup: dict[str, OptionTicker]) -> list[tuple[str, dict[str, int]]]:
+        """This function will generate the arguments to be passed to the pool. Requires the o_tickers_lookup.
+        There is one arg per page file of the most recent download of each underlying's chain.
+
+        Args:
+            o_tickers_lookup (dict): dict(o_ticker: OptionTicker namedtuple)
+
+        Returns:
+            path_args: list of tuples containing the file path and a dict(o_ticker: options_ticker_id)
+            for the contracts of that underlying.
+            e.g. "(~/.polygon_data/ChainSnapshot/SPY/1688127754374/0.json, {"O:SPY251219C00500000": 123})"
+        """
+        if not os.path.exists(self.base_directory):
+            log.warning("no options chain snapshots found. Download options chain snapshots first!")
+            raise FileNotFoundError
+
+        chains: dict[str, dict[str, int]] = {}
+        for o_ticker, ticker_data in o_tickers_lookup.items():
+            chains.setdefault(ticker_data.underlying_ticker, {})[o_ticker] = ticker_data.id
+
+        latest_downloads = download_manifest().latest_download(self.runner_type, list(chains))
+        path_args = []
+        for under_ticker, id_lookup in chains.items():
+            if under_ticker in latest_downloads:
+                path_args.extend((file, id_lookup) for file in latest_downloads[under_ticker])
+                continue
+
+            temp_path = f"{self.base_directory}/{under_ticker}"  # NOTE: downloaded before the manifest existed
+            try:
+                download_path = self._determine_most_recent_file(temp_path)
+            except (FileNotFoundError, IndexError):
+                log.debug(f"no chain snapshot found at: {temp_path} for {self.runner_type}")
+                continue
+            path_args.extend((f"{download_path}/{page}", id_lookup) for page in os.listdir(download_path))
+        return path_args
+
+    def clean_data(self, results: dict, id_lookup: dict[str, int]) -> list[dict]:
+        """This function will clean the data and return a list of dicts to be uploaded to the db
+
+        Args:
+            results (dict): one page of the raw chain snapshot data
+            id_lookup (dict): dict(o_ticker: options_ticker_id). Contracts missing from the db are skipped
+        """
+        clean_results = []
+        if isinstance(results, dict):
+            for snapshot in results.get("results", []):
+                options_ticker_id = id_lookup.get(snapshot.get("details", {}).get("ticker"))
+                if options_ticker_id is not None:
+                    clean_results.append(self._clean_snapshot(snapshot, options_ticker_id))
+        return clean_results
+
+
+class OptionsQuoteRunner(OptionsPricesRunner):
+    """Runner for options quote data.
+    Quotes are inserted, not upserted, so a quotes file must only be uploaded once.
+    Every worker process writes a new file per run, named with the millisecond timestamp it was created at.
+    With `since`, the files created since then (by this run) are uploaded"""
+
+    runner_type = "OptionsQuotes"
+
+    def __init__(self, since: int | None = None):
+        super().__init__(since)
+
     async def upload_func(self, data: list[dict]):
         return await update_options_quotes(data)
 
     def generate_path_args(self, ticker: str) -> list[str]:
-        """returns the paths to each of the json file for each process in each ticker subdirectory"""
+        """returns the paths to the json files of the run for each process in each ticker subdirectory.
+        Without `since`, the most recent file of each process"""
         if not os.path.exists(self.base_directory):
             log.warning("no options contracts found. Download options contracts first!")
             raise FileNotFoundError
         ticker_path = self.base_directory + "/" + ticker
-        dirs = os.listdir(ticker_path)
-        return [(self._determine_most_recent_file(ticker_path + "/" + dir), (ticker)) for dir in dirs]
+        # NOTE: no quotes were written for an underlying without tasks or whose tasks were all empty
+        dirs = os.listdir(ticker_path) if os.path.exists(ticker_path) else []
+        if self.since is None:
+            return [(self._determine_most_recent_file(ticker_path + "/" + dir), (ticker)) for dir in dirs]
+        return [
+            (f"{ticker_path}/{dir}/{file}", (ticker))
+            for dir in dirs
+            for file in os.listdir(f"{ticker_path}/{dir}")
+            if int(file.split(".")[0]) >= self.since
+        ]
 
     def clean_data(self, results: list[dict], o_ticker: OptionTicker) -> list[dict]:
         """This function will clean the data and return a list of dicts to be uploaded to the db
@@ -452,3 +558,99 @@ class OptionsQuoteRunner(OptionsPricesRunner):
             record.get("sip_timestamp", timestamp_now() * 1000000), nano_sec=True, msec_units=False
         )
         return record
+
+
+class ParquetRunner(PathRunner):
+    """Base class for the runners of the parquet landing zone (POLYGON_STORAGE_BACKEND=parquet).
+    Mixed in ahead of the json runner of the same data type, whose `upload_func` and `key_mapping` it reuses.
+    Only the `columns` needed for the db are read from each part file."""
+
+    columns: list[str] = []
+
+    def __init__(self, since: int | None = None):
+        super().__init__(since)
+        self.base_directory = f"{LANDING_ZONE_PATH}/{self.runner_type}"
+
+    def _records(self, table) -> list[dict]:
+        """Renames the columns to the db columns and converts the table to records"""
+        return table.rename_columns([self.key_mapping.get(c, c) for c in table.column_names]).to_pylist()
+
+    async def upload(self, file_path: str, ticker_data: Any = ()) -> str | None:
+        """This function will read the columns from the part file, clean the data, and upload to the database"""
+        log.info(f"uploading data from {file_path}")
+        try:
+            table = read_columns(file_path, self.columns)
+        except FileNotFoundError:
+            log.warning(f"file not found at: {file_path} for {self.runner_type}, with ticker: {ticker_data}")
+            return
+        except (OSError, ValueError):
+            log.warning(f"failed to read {file_path}. Make sure it is a correct parquet file")
+            return file_path
+
+        clean_data = self.clean_data(table, ticker_data)
+        if len(clean_data) > 0:
+            for batch in self._make_batch_generator(clean_data):
+                await self.upload_func(batch)
+
+
+class StockPricesParquetRunner(ParquetRunner, StockPricesRunner):
+    """Runner for stock prices in the parquet landing zone"""
+
+    columns = list(StockPricesRunner.key_mapping)
+
+    def generate_path_args(self, ticker_id_lookup: dict) -> list[tuple[str, int]]:
+        """One arg per part file of the latest download of each ticker, with the ticker id"""
+        return [
+            (file_path, ticker_id_lookup[ticker])
+            for ticker in ticker_id_lookup
+            for file_path in latest_partition_files(self.runner_type, ticker, self.since)
+        ]
+
+    def clean_data(self, table, ticker_id: int) -> list[dict]:
+        clean_results = self._records(table)
+        for t in clean_results:
+            t["as_of_date"] = timestamp_to_datetime(t["as_of_date"], msec_units=True)
+            t["ticker_id"] = ticker_id
+        return clean_results
+
+
+class OptionsPricesParquetRunner(ParquetRunner, OptionsPricesRunner):
+    """Runner for options prices in the parquet landing zone. Each part file holds many contracts"""
+
+    columns = list(OptionsPricesRunner.key_mapping) + ["options_ticker"]
+
+    def generate_path_args(self, o_tickers_lookup: dict[str, OptionTicker]) -> list[tuple[str, dict[str, int]]]:
+        """One arg per part file of the latest download of each underlying,
+        with a dict(o_ticker: options_ticker_id) of the underlying's contracts"""
+        id_lookups: dict[str, dict[str, int]] = {}
+        for o_ticker, ticker_data in o_tickers_lookup.items():
+            id_lookups.setdefault(ticker_data.underlying_ticker, {})[o_ticker] = ticker_data.id
+        return [
+            (file_path, id_lookup)
+            for under_ticker, id_lookup in id_lookups.items()
+            for file_path in latest_partition_files(self.runner_type, under_ticker, self.since)
+        ]
+
+    def clean_data(self, table, id_lookup: dict[str, int]) -> list[dict]:
+        o_tickers = table.column("options_ticker").to_pylist()
+        clean_results = []
+        for o_ticker, t in zip(o_tickers, self._records(table.select(list(self.key_mapping)))):
+            if o_ticker in id_lookup:
+                t["as_of_date"] = timestamp_to_datetime(t["as_of_date"], msec_units=True)
+                t["options_ticker_id"] = id_lookup[o_ticker]
+                clean_results.append(t)
+        return clean_results
+
+
+class OptionsQuoteParquetRunner(ParquetRunner, OptionsQuoteRunner):
+    """Runner for options quotes in the parquet landing zone"""
+
+    columns = [name for name, _ in SCHEMA_FIELDS["OptionsQuotes"]]
+
+    def generate_path_args(self, ticker: str) -> list[tuple[str, str]]:
+        """returns the part files of the latest download of the underlying ticker"""
+        files = latest_partition_files(self.runner_type, ticker, self.since)
+        return [(file_path, ticker) for file_path in files]
+
+    def clean_data(self, table, ticker: str) -> list[dict]:
+        return [self._convert_timestamps(record) for record in table.to_pylist()]
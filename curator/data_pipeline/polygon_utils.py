@@ -1,27 +1,43 @@
 import asyncio
+import math
 import os
 from abc import ABC, abstractmethod
+from bisect import bisect_right
 from datetime import date, datetime
 from enum import Enum
+from typing import AsyncIterator
 
 import numpy as np
 import pandas as pd
 from aiohttp import ClientSession
-from aiohttp.client_exceptions import (
-    ClientConnectionError,
-    ClientConnectorError,
-    ClientResponseError,
-    ServerDisconnectedError,
-)
-from data_pipeline.exceptions import ProjAPIError, ProjAPIOverload
+from data_pipeline.exceptions import ProjAPIError, ProjAPIOverload, ProjAPIServerError
+from data_pipeline.journal import download_journal, record_failed_request, task_key
+from data_pipeline.landing_zone import landing_zone_writer, parquet_enabled
+from data_pipeline.manifest import download_manifest
+from data_pipeline.path_runner import OptionsPricesRunner, OptionsQuoteRunner, StockPricesRunner
+from data_pipeline.rate_limiter import shared_rate_limiter
+from data_pipeline.response_cache import IMMUTABLE, SHORT_TTL, response_cache
+from data_pipeline.retry import RetryPolicy, parse_retry_after
+from data_pipeline.stream import keep_raw, stream_enabled, stream_uploader
 from dateutil.relativedelta import relativedelta
 from db_tools.utils import OptionTicker
 
-from curator.proj_constants import BASE_DOWNLOAD_PATH, POLYGON_API_KEY, POLYGON_BASE_URL, log
+from curator.proj_constants import (
+    BASE_DOWNLOAD_PATH,
+    MAX_QUERY_PER_SECOND,
+    POLYGON_API_KEY,
+    POLYGON_BASE_URL,
+    RESPONSE_CACHE_ENABLED,
+    log,
+)
 from curator.utils import (
+    buffered_writer,
     extract_underlying_from_o_ticker,
     first_weekday_of_month,
+    JsonListWriter,
+    strike_from_o_ticker,
     string_to_date,
+    string_to_datetime,
     timestamp_now,
     timestamp_to_datetime,
     trading_days_in_range,
@@ -40,6 +56,24 @@ class Timespans(Enum):
     year = "year"
 
 
+AGGS_PAGE_LIMIT = 50000  # max number of bars the aggregates endpoint returns per page
+
+
+def bars_per_trading_day(timespan: Timespans, multiplier: int, hours_per_day: float) -> float:
+    """Estimates the max number of aggregate bars returned for a single trading day"""
+    intraday_seconds = {Timespans.second: 1, Timespans.minute: 60, Timespans.hour: 3600}
+    days_per_bar = {
+        Timespans.day: 1,
+        Timespans.week: 5,
+        Timespans.month: 21,
+        Timespans.quarter: 63,
+        Timespans.year: 252,
+    }
+    if timespan in intraday_seconds:
+        return math.ceil(hours_per_day * 3600 / (intraday_seconds[timespan] * multiplier))
+    return 1 / (days_per_bar[timespan] * multiplier)
+
+
 class PolygonPaginator(ABC):
     """API paginator interface for calls to the Polygon API. \
         It tracks queries made to the polygon API and calcs potential need for sleep
@@ -51,17 +85,15 @@ class PolygonPaginator(ABC):
 
     paginator_type = "Generic"
 
-    MAX_QUERY_PER_SECOND = 99
+    MAX_QUERY_PER_SECOND = MAX_QUERY_PER_SECOND  # NOTE: enforced across processes by the shared rate limiter
+    retry_policy = RetryPolicy()
+    resumable = True  # an interrupted download skips the tasks it journaled as finished when it is run again
     # MAX_QUERY_PER_MINUTE = 4  # free api limits to 5 / min which is 4 when indexed at 0
 
     def __init__(self):
         self.clean_results = []
         self.clean_data_generator = iter(())
 
-    def _api_sleep_time(self) -> int:
-        """Returns the time to sleep based if the endpoint returns a 429 error"""
-        return 60
-
     def _clean_url(self, url: str) -> str:
         """Clean the url to remove the base url"""
         return url.replace(POLYGON_BASE_URL, "")
@@ -81,6 +113,19 @@ class PolygonPaginator(ABC):
             str of the file name"""
         return f"{BASE_DOWNLOAD_PATH}/{self.paginator_type}/{path}/", f"{file_name}.json"
 
+    def _record_download(self, writer: JsonListWriter, underlying: str, contract: str = "", as_of: str = ""):
+        """Adds the file of a closed writer to the download manifest, unless no file was written"""
+        if writer.written:
+            download_manifest().record(
+                self.paginator_type,
+                underlying,
+                writer.file_path + writer.file_name,
+                writer.count,
+                contract=contract,
+                as_of=as_of,
+                written_at=int(writer.file_name.split(".")[0]),
+            )
+
     async def _execute_request(self, session: ClientSession, url: str, payload: dict = {}) -> tuple[int, dict]:
         """Execute the request and return the response status code and json response
         Args:
@@ -93,115 +138,165 @@ class PolygonPaginator(ABC):
                 json_response: dict of the json response
         """
         payload["apiKey"] = POLYGON_API_KEY
+        await shared_rate_limiter().acquire()
         async with session.request(method="GET", url=url, params=payload) as response:
             status_code = response.status
             if status_code == 429:
-                raise ProjAPIOverload(f"API Overload, 429 error code: {url} {payload}")
+                raise ProjAPIOverload(
+                    f"API Overload, 429 error code: {url} {payload}",
+                    retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                )
+            elif status_code >= 500:
+                raise ProjAPIServerError(
+                    f"API Server Error, status code {status_code}: {url} {payload}", status=status_code
+                )
             elif status_code >= 400:
-                raise ProjAPIError(f"API Error, status code {status_code}: {url} {payload}")
+                raise ProjAPIError(f"API Error, status code {status_code}: {url} {payload}", status=status_code)
             json_response = await response.json() if status_code == 200 else {}
             return (status_code, json_response)
 
-    async def _query_all(
+    def _cache_ttl(self, url: str, payload: dict) -> float | None:
+        """Returns how long (seconds) responses for this request may be served from the response cache.
+        None means the request is never cached. Overwrite per paginator.
+        The ttl of the first request applies to every page that follows it"""
+        return None
+
+    @staticmethod
+    def _ttl_for_date(as_of: date) -> float:
+        """Data for a closed trading date can't change. Today's data can"""
+        return IMMUTABLE if as_of < datetime.now().date() else SHORT_TTL
+
+    async def _cached_request(
+        self, session: ClientSession, url: str, payload: dict, ttl: float | None
+    ) -> tuple[int, dict]:
+        """Serves the request from the response cache when possible.
+        Otherwise executes it and caches the result"""
+        if ttl is None:
+            return await self._execute_request(session, url, payload)
+
+        cache = response_cache()
+        key = cache.key(url, payload)
+        cached_response = await cache.get(key)
+        if cached_response is not None:
+            return 200, cached_response
+
+        status, response = await self._execute_request(session, url, payload)
+        if status == 200:
+            await cache.put(key, response, ttl)
+        return status, response
+
+    async def _iter_pages(
         self, session: ClientSession, url: str, payload: dict = {}, limit: bool = False
-    ) -> list[dict]:
-        """Query the API until all results have been returned
+    ) -> AsyncIterator[dict]:
+        """Query the API until all results have been returned, yielding each page as soon as it arrives.
+        Only one page is held in memory at a time, so consumers should write/process each page as they go.
+
         Args:
             session: aiohttp ClientSession
             url: url to query
             payload: dict of query params
             limit: bool to determine if query should be limited to the first page of results. Default set to false
 
-        Returns:
-            list of dicts of the json response
+        Yields:
+            dict of the json response for each page
         """
-        results = []
-        status = 0
-        retry = 0
+        attempts: dict[str, int] = {}  # retries per error class for the current page
+        ttl = self._cache_ttl(url, payload) if RESPONSE_CACHE_ENABLED else None
 
-        while True and retry <= 5:
+        while True:
             try:
-                status, response = await self._execute_request(session, url, payload)
-
-            except ProjAPIOverload as e:
-                log.exception(e, extra={"context": "Going to sleep for 60 seconds..."} if not retry else {})
-                status = 1
-
-            except ProjAPIError as e:
-                log.exception(e)
-                status = 2
-
-            except (
-                ClientConnectionError,
-                ClientConnectorError,
-                ClientResponseError,
-                ServerDisconnectedError,
-            ) as e:
-                if retry == 5:
-                    log.exception(
-                        e,
-                        extra={"context": "Connection Lost Going to sleep for 15 seconds..."},
-                        exc_info=False,
-                    )
-                    log.warn(f"task that failed: \nurl: {url}, \npayload: {payload}")
-                status = 3
-
-            except asyncio.TimeoutError as e:
-                if retry == 5:
-                    log.exception(
-                        e,
-                        extra={"context": "Event loop request timed out! Consider decreasing concurrency"},
-                        exc_info=False,
-                    )
-                    log.warn(f"task that failed: \nurl: {url}, \npayload: {payload}")
-                status = 4
+                status, response = await self._cached_request(session, url, payload, ttl)
 
             except Exception as e:
-                log.exception(e, extra={"context": "Unexpected Error while querying the API"})
-                status = 5
-
-            finally:
-                if status == 200:
-                    results.append(response)
-                    if retry > 0:
-                        log.info(f"retries: {retry}")
-                    if response.get("next_url") and not limit:
-                        url = self._clean_url(response["next_url"])
-                        payload = {}
-                        status = 0
-                        retry = 0
+                delay = self.retry_policy.retry_delay(e, attempts)
+                if delay is None:
+                    error_class = self.retry_policy.error_class(e)
+                    if error_class is None:
+                        log.exception(e, extra={"context": "Unexpected Error while querying the API"})
+                    elif error_class == "client_error":
+                        log.error(f"API client error, status code {e.status}, not retried: {url}")
                     else:
-                        break
-
-                elif status == 1:
-                    await asyncio.sleep(self._api_sleep_time())
-                    status = 0
-
-                elif status in (2, 4) and retry is False:
-                    retry += 1
-                    status = 0
-
-                elif status == 3 and retry is False:
-                    await asyncio.sleep(8)
-                    retry += 1
-                    status = 0
+                        log.exception(
+                            e, extra={"context": f"Giving up after retries: {attempts}"}, exc_info=False
+                        )
+                    log.warning(f"task that failed: \nurl: {url}, \npayload: {payload}")
+                    record_failed_request(url)  # NOTE: keeps the task out of the journal, so it is retried
+                    break
 
+                if isinstance(e, ProjAPIOverload):
+                    # NOTE: pauses every process drawing from the shared rate limiter, not just this coroutine
+                    shared_rate_limiter().pause(delay)
                 else:
-                    break
+                    log.debug(f"retrying in {delay:.2f} seconds after {type(e).__name__}: {url}")
+                    await asyncio.sleep(delay)
+                continue
+
+            next_url = response.get("next_url") if not limit else None
+            if status == 200:
+                if attempts:
+                    log.info(f"retries: {attempts}")
+                yield response
+            del response  # NOTE: drop the page before requesting the next one
+
+            if next_url:
+                url = self._clean_url(next_url)
+                payload = {}
+                attempts = {}
+            else:
+                break
 
-        return results
+    async def _query_all(
+        self, session: ClientSession, url: str, payload: dict = {}, limit: bool = False
+    ) -> list[dict]:
+        """Query the API until all results have been returned. Collects every page from `_iter_pages()`.
+        Prefer iterating `_iter_pages()` directly when the pages can be processed one at a time.
+
+        Returns:
+            list of dicts of the json response
+        """
+        return [page async for page in self._iter_pages(session, url, payload, limit)]
 
     async def download_data(self, url: str, payload: dict, ticker: str, session: ClientSession = None):
-        """query_data() is an api to call the _query_all() function.
-        Downloaded data is then saved to json.
+        """query_data() is an api to call the _iter_pages() function.
+        Downloaded data is saved to json one page at a time.
+        The cursor of each page is journaled with how far the file was written,
+        so an interrupted listing (e.g. all the StockMetaData) picks up from the next page in the same file.
 
         Overwrite this to customize the way to insert the ticker_id into the query results
         """
         log.info(f"Downloading data for {ticker}")
         log.debug(f"Downloading data for {ticker} with url: {url} and payload: {payload}")
-        results = await self._query_all(session, url, payload)
-        log.info(f"Writing data for {ticker} to file")
-        write_api_data_to_file(results, *self._download_path(ticker, str(timestamp_now())))
+        journal = download_journal(self.paginator_type)
+        key = task_key((url, payload, ticker))
+        cursor = journal.cursor(key) if self.resumable else None
+        writer = None
+        if cursor:
+            try:
+                writer = JsonListWriter.resume(
+                    cursor["file_path"], cursor["file_name"], cursor["offset"], cursor["count"]
+                )
+                url, payload = self._clean_url(cursor["next_url"]), {}
+                log.info(f"resuming the download for {ticker} after {cursor['count']} pages")
+            except FileNotFoundError:
+                log.warning(f"can't resume the download for {ticker}, its file is gone. Starting over")
+        if writer is None:
+            writer = JsonListWriter(*self._download_path(ticker, str(timestamp_now())))
+
+        with writer:
+            async for page in self._iter_pages(session, url, payload):
+                writer.write(page)
+                if self.resumable and page.get("next_url"):
+                    journal.save_cursor(
+                        key,
+                        {
+                            "next_url": page["next_url"],
+                            "file_path": writer.file_path,
+                            "file_name": writer.file_name,
+                            "offset": writer.flush(),
+                            "count": writer.count,
+                        },
+                    )
+        self._record_download(writer, ticker)
 
     @abstractmethod
     def generate_request_args(self, args_data):
@@ -224,6 +319,8 @@ class StockMetaData(PolygonPaginator):
         It can be used to query for a single individual ticker or to pull the entire corpus"""
 
     paginator_type = "StockMetaData"
+    retry_policy = RetryPolicy(budgets={"connection": 10, "timeout": 10})
+    # NOTE: the full listing is one long chain of pages. Losing it mid-way is expensive, so retry harder
 
     def __init__(self, tickers: list[str], all_: bool):
         self.tickers = tickers
@@ -245,13 +342,90 @@ class StockMetaData(PolygonPaginator):
             urls = [(self.url_base, self.payload, "")]
         return urls
 
+    def _cache_ttl(self, url: str, payload: dict) -> float | None:
+        return SHORT_TTL
+
 
 # class StockDetails(StockMetaData):
 # NOTE: this class will hit the same endpoint but will add `/{ticker}?{date}` for historical data
 # add if then logic to exception handling to check the ticker events endpoint if ticker not found
 
 
-class HistoricalStockPrices(PolygonPaginator):
+class AggregatesPaginator(PolygonPaginator):
+    """Base paginator for the aggregates (bars) endpoint.
+    A ticker's date range is split into shards aligned to the trading calendar, each small enough for one page.
+    The shards are downloaded concurrently and their pages are stitched back together in order (newest first).
+    This keeps long minute/second level histories from being limited by one serial chain of `next_url` requests.
+
+    Inheriting classes need to set `self.timespan` and `self.multiplier`"""
+
+    paginator_type = "Aggregates"
+    cal_type = "e_cal"
+    trading_hours_per_day = 16  # NOTE: stock aggregates include pre and post market hours
+    shard_concurrency = 4  # max shards of a single ticker downloaded at the same time
+
+    def _shard_date_ranges(self, start_date: date, end_date: date) -> list[tuple[date, date]]:
+        """Splits the date range into consecutive (start, end) shards of trading days, newest shard first.
+        Each shard is sized to fit in a single page of AGGS_PAGE_LIMIT bars"""
+        days = trading_days_in_range(str(start_date), str(end_date), cal_type=self.cal_type, count=False).index
+        bars_per_day = bars_per_trading_day(
+            Timespans(self.timespan), self.multiplier, self.trading_hours_per_day
+        )
+        days_per_shard = max(1, int(AGGS_PAGE_LIMIT // bars_per_day))
+        if len(days) <= days_per_shard:
+            return [(start_date, end_date)]
+
+        shards = [
+            [days[i].date(), days[min(i + days_per_shard, len(days)) - 1].date()]
+            for i in range(0, len(days), days_per_shard)
+        ]
+        shards[0][0], shards[-1][1] = start_date, end_date  # NOTE: keep the non-trading days at the edges
+        return [tuple(shard) for shard in reversed(shards)]
+
+    def _construct_urls(self, ticker: str, start_date: date, end_date: date) -> list[str]:
+        """function to construct the urls of every shard of the ticker's aggregates"""
+        return [
+            f"/v2/aggs/ticker/{ticker}/range/{self.multiplier}/{self.timespan}/{shard_start}/{shard_end}"
+            for shard_start, shard_end in self._shard_date_ranges(start_date, end_date)
+        ]
+
+    def _cache_ttl(self, url: str, payload: dict) -> float | None:
+        """the end date is the last segment of the aggregates url"""
+        return self._ttl_for_date(string_to_date(url.rstrip("/").split("/")[-1]))
+
+    async def _iter_sharded_pages(
+        self, session: ClientSession, urls: list[str], payload: dict = {}
+    ) -> AsyncIterator[dict]:
+        """Downloads the shards concurrently and yields their pages in shard order.
+        While an earlier shard is yielded, a shard buffers one page and waits,
+        so memory stays bounded by `shard_concurrency` rather than by the size of the shards"""
+        if len(urls) == 1:
+            async for page in self._iter_pages(session, urls[0], payload):
+                yield page
+            return
+
+        semaphore = asyncio.Semaphore(self.shard_concurrency)
+        shard_queues = [asyncio.Queue(maxsize=1) for _ in urls]
+
+        async def fetch_shard(url: str, shard_queue: asyncio.Queue):
+            try:
+                async with semaphore:
+                    async for page in self._iter_pages(session, url, dict(payload)):
+                        await shard_queue.put(page)
+            finally:
+                await shard_queue.put(None)
+
+        tasks = [asyncio.ensure_future(fetch_shard(url, q)) for url, q in zip(urls, shard_queues)]
+        try:
+            for shard_queue in shard_queues:
+                while (page := await shard_queue.get()) is not None:
+                    yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class HistoricalStockPrices(AggregatesPaginator):
     """Object to query Polygon API and retrieve historical prices for the underlying stock"""
 
     paginator_type = "StockPrices"
@@ -263,38 +437,82 @@ class HistoricalStockPrices(PolygonPaginator):
         multiplier: int = 1,
         timespan: Timespans = Timespans.hour,
         adjusted: bool = True,
+        ticker_id_lookup: dict[str, int] | None = None,
     ):
         self.multiplier = multiplier
         self.timespan = timespan.value
         self.start_date = start_date.date()
         self.end_date = end_date.date()
         self.adjusted = "true" if adjusted else "false"
-        self.payload = {"adjusted": self.adjusted, "sort": "desc", "limit": 50000}
+        self.payload = {"adjusted": self.adjusted, "sort": "desc", "limit": AGGS_PAGE_LIMIT}
+        self.ticker_id_lookup = ticker_id_lookup or {}  # NOTE: only needed to stream the prices to the db
         super().__init__()
 
-    def generate_request_args(self, args_data: list[str]) -> list[tuple[str, dict, str]]:
+    def generate_request_args(
+        self, args_data: list[str], watermarks: dict[str, date] | None = None
+    ) -> list[tuple[list[str], dict, str]]:
         """Generate the urls to query the stock prices endpoint.
 
         Args:
             args_data: list of tickers(str)
+            watermarks: optional dict of ticker: date of the latest stored price.
+                Only prices from the watermark onward are requested for those tickers
 
         Returns:
-            url_args: list(tuple) of the (url, payload, and ticker) for each request
+            url_args: list(tuple) of the (shard urls, payload, and ticker) for each request
         """
-        return [
-            (
-                f"/v2/aggs/ticker/{ticker}/range/{self.multiplier}/{self.timespan}/{self.start_date}/{self.end_date}",
-                self.payload,
-                ticker,
-            )
-            for ticker in args_data
-        ]
+        watermarks = watermarks or {}
+        url_args = []
+        for ticker in args_data:
+            start_date = max(self.start_date, watermarks.get(ticker, self.start_date))
+            if start_date <= self.end_date:
+                url_args.append((self._construct_urls(ticker, start_date, self.end_date), self.payload, ticker))
+        return url_args
+
+    async def download_data(self, urls: list[str], payload: dict, ticker: str, session: ClientSession = None):
+        """Overwriting inherited download_data().
+        Downloads the shards of the ticker's date range concurrently and writes them to a single file in order.
+        In stream-through mode each page is also cleaned and queued for upload to the db as it arrives.
+
+        NOTE: session = None prevents the function from crashing without a session input initially.
+        This lets us wait for the process pool to insert the session into the args.
+        """
+        log.info(f"Downloading price data for {ticker} in {len(urls)} shard(s)")
+        log.debug(f"Downloading data for {ticker} with urls: {urls} and payload: {payload}")
+        stream = stream_uploader(StockPricesRunner) if stream_enabled() else None
+        ticker_data = (self.ticker_id_lookup.get(ticker),)
+        if not keep_raw():
+            async for page in self._iter_sharded_pages(session, urls, payload):
+                await stream.put([page], ticker_data)
+            return
+
+        if parquet_enabled():
+            writer = landing_zone_writer(self.paginator_type, ticker)
+            async for page in self._iter_sharded_pages(session, urls, payload):
+                writer.write([{**record, "ticker": ticker} for record in page.get("results", [])])
+                if stream:
+                    await stream.put([page], ticker_data)
+            return
+
+        with JsonListWriter(*self._download_path(ticker, str(timestamp_now()))) as writer:
+            async for page in self._iter_sharded_pages(session, urls, payload):
+                writer.write(page)
+                if stream:
+                    await stream.put([page], ticker_data)
+        self._record_download(writer, ticker)
 
 
 class OptionsContracts(PolygonPaginator):
     """Object to query options contract tickers for a given underlying ticker based on given dates.
     It will pull all options contracts that exist for each underlying ticker as of the first business day of each month.
-    Number of months are determined by `month_hist`"""
+    Number of months are determined by `month_hist`
+
+    The full listings are pulled, as the first month a contract appears in is used to estimate its listing date.
+
+    With `incremental=True`, past months that were already downloaded after they closed are skipped,
+    since a past `as_of` listing never changes. The current month is always pulled, as of today.
+    A past month that was only downloaded while it was current is bounded to the contracts expiring before
+    the next month's `as_of` date. The later contracts show up again in the next month's listing."""
 
     paginator_type = "OptionsContracts"
 
@@ -303,11 +521,13 @@ class OptionsContracts(PolygonPaginator):
         tickers: list[str],
         ticker_id_lookup: dict[str, int],  # ticker str is key, id is value
         months_hist: int = 24,
+        incremental: bool = False,
     ):
         super().__init__()
         self.tickers = tickers
         self.ticker_id_lookup = ticker_id_lookup
         self.months_hist = months_hist
+        self.incremental = incremental
         self.base_dates = self._determine_base_dates()
 
     def _determine_base_dates(self) -> list[datetime]:
@@ -327,23 +547,57 @@ class OptionsContracts(PolygonPaginator):
             counter += 1
         return [str(x) for x in first_weekday_of_month(np.array(year_month_array)).tolist()]
 
-    def generate_request_args(self, args_data: list[str]) -> list[tuple[str, dict, str]]:
+    def _download_times(self, ticker: str, as_of: str) -> list[int]:
+        """Returns the millisecond timestamps (the file names) of the downloads of a listing"""
+        download_times = download_manifest().written_times(self.paginator_type, ticker, as_of)
+        if download_times:
+            return download_times
+        path = self._download_path(f"{ticker}/{as_of}", "")[0]  # NOTE: downloaded before the manifest existed
+        if not os.path.exists(path):
+            return []
+        file_stamps = [f.split(".")[0] for f in os.listdir(path) if f.endswith(".json")]
+        return [int(stamp) for stamp in file_stamps if stamp.isdigit()]
+
+    def generate_request_args(self, args_data: list[str]) -> list[tuple[str, dict, str, str]]:
         """Generate the urls to query the options contracts endpoint.
 
         Args:
             args_data: list of tickers
 
         Returns:
-            url_args: list(tuple) of the (url, payload, and ticker_id) for each request"""
+            url_args: list(tuple) of the (url, payload, ticker and as_of folder) for each request"""
         url_base = "/v3/reference/options/contracts"
         payload = {"limit": 1000}
-        return [
-            (url_base, dict(payload, **{"underlying_ticker": ticker, "as_of": date}), ticker)
-            for ticker in args_data
-            for date in self.base_dates
-        ]
+        today = datetime.now().strftime("%Y-%m-%d")
+        url_args = []
+        skipped = 0
+        for ticker in args_data:
+            for i, as_of in enumerate(self.base_dates):  # NOTE: base_dates start with the current month
+                query = {"underlying_ticker": ticker, "as_of": as_of}
+                if i == 0:
+                    if self.incremental:
+                        query["as_of"] = today  # NOTE: picks up contracts listed since the month started
+                elif self.incremental:
+                    next_as_of = self.base_dates[i - 1]
+                    download_times = self._download_times(ticker, as_of)
+                    closed_at = string_to_datetime(next_as_of).timestamp() * 1000
+                    if any(download_time >= closed_at for download_time in download_times):
+                        skipped += 1  # NOTE: downloaded after the month closed. The listing is complete
+                        continue
+                    if download_times:
+                        query["expiration_date.lt"] = next_as_of
+                url_args.append((url_base, dict(payload, **query), ticker, as_of))
+        if self.incremental:
+            log.info(f"skipping {skipped} options contract listings that were already downloaded")
+        return url_args
+
+    def _cache_ttl(self, url: str, payload: dict) -> float | None:
+        """past `as_of` listings never change"""
+        return self._ttl_for_date(string_to_date(payload["as_of"]))
 
-    async def download_data(self, url: str, payload: dict, ticker: str, session: ClientSession = None):
+    async def download_data(
+        self, url: str, payload: dict, ticker: str, as_of: str, session: ClientSession = None
+    ):
         """Overwriting inherited download_data().
         This special case will add a specific identified to json filename from the payload dict.
 
@@ -352,17 +606,20 @@ class OptionsContracts(PolygonPaginator):
         """
         log.info(f"Downloading options contract data for {ticker}")
         log.debug(f"Downloading data for {ticker} with url: {url} and payload: {payload}")
-        results = await self._query_all(session, url, payload)
-        log.info(f"Writing options contract data for {ticker} to file")
-        write_api_data_to_file(
-            results, *self._download_path(ticker + "/" + str(payload["as_of"]), str(timestamp_now()))
-        )  # NOTE: this creates a folder for each "as_of" date
+        with JsonListWriter(
+            *self._download_path(ticker + "/" + as_of, str(timestamp_now()))
+        ) as writer:  # NOTE: this creates a folder for each "as_of" month
+            async for page in self._iter_pages(session, url, payload):
+                writer.write(page)
+        self._record_download(writer, ticker, as_of=as_of)
 
 
-class HistoricalOptionsPrices(PolygonPaginator):
+class HistoricalOptionsPrices(AggregatesPaginator):
     """Object to query Polygon API and retrieve historical prices for the options chain for a given ticker"""
 
     paginator_type = "OptionsPrices"
+    cal_type = "o_cal"
+    trading_hours_per_day = 6.5
 
     def __init__(
         self,
@@ -382,62 +639,100 @@ class HistoricalOptionsPrices(PolygonPaginator):
         start_date = end_date - relativedelta(months=self.months_hist)
         return start_date, end_date
 
-    def _construct_url(self, o_ticker: str, expiration_date: datetime) -> str:
-        """function to construct the url for the options prices endpoint"""
-        return f"/v2/aggs/ticker/{o_ticker}/range/{self.multiplier}/{self.timespan}/" + "{0}/{1}".format(
-            *self._determine_start_end_dates(expiration_date)
-        )
+    @staticmethod
+    def _caught_up_to_expiration(watermark: date, expiration_date: date) -> bool:
+        """True if the contract has expired and its data is stored up to the last trading day before expiration.
+        NOTE: watermarks stop before the expiration date, so this counts as "complete"."""
+        return expiration_date < datetime.now().date() and np.busday_count(watermark, expiration_date) <= 1
 
-    def generate_request_args(self, args_data: list[OptionTicker]) -> list[tuple[str, dict, str, str, str]]:
+    def generate_request_args(
+        self, args_data: list[OptionTicker], watermarks: dict[str, date] | None = None
+    ) -> list[tuple[list[str], dict, str, str, str]]:
         """Generate the urls to query the options prices endpoint.
 
         Args:
-            args_data: list of named tuples. OptionTicker(options_ticker, id, expiration_date, underlying_ticker)
+            args_data: list of named tuples.
+                OptionTicker(options_ticker, id, expiration_date, underlying_ticker, listed_date)
+                Prices before the estimated listing date are not requested
+            watermarks: optional dict of o_ticker: date of the latest stored price.
+                Only prices from the watermark onward are requested for those contracts,
+                and expired contracts that are already caught up are skipped
 
         Returns:
-            url_args: list(tuple) of the (url, payload, and ticker, underlying ticker, clean ticker) for each request"""
-        payload = {"adjusted": self.adjusted, "sort": "desc", "limit": 50000}
-        return [
-            (
-                self._construct_url(o_ticker.o_ticker, o_ticker.expiration_date),
-                payload,
-                o_ticker.o_ticker,
-                o_ticker.underlying_ticker,
-                self._clean_o_ticker(o_ticker.o_ticker),
+            url_args: list(tuple) of the (shard urls, payload, ticker, underlying ticker, clean ticker,
+            ticker id) for each request"""
+        payload = {"adjusted": self.adjusted, "sort": "desc", "limit": AGGS_PAGE_LIMIT}
+        watermarks = watermarks or {}
+        url_args = []
+        for o_ticker in args_data:
+            start_date, end_date = self._determine_start_end_dates(o_ticker.expiration_date)
+            watermark = watermarks.get(o_ticker.o_ticker)
+            if watermark:
+                if self._caught_up_to_expiration(watermark, o_ticker.expiration_date):
+                    continue
+                start_date = max(start_date, watermark)
+            if o_ticker.listed_date:
+                start_date = max(start_date, o_ticker.listed_date)
+            if start_date > end_date:
+                continue
+            url_args.append(
+                (
+                    self._construct_urls(o_ticker.o_ticker, start_date, end_date),
+                    payload,
+                    o_ticker.o_ticker,
+                    o_ticker.underlying_ticker,
+                    self._clean_o_ticker(o_ticker.o_ticker),
+                    o_ticker.id,
+                )
             )
-            for o_ticker in args_data
-        ]
+        return url_args
 
     async def download_data(
         self,
-        url: str,
+        urls: list[str],
         payload: dict,
         o_ticker: str,
         under_ticker: str,
         clean_ticker: str,
+        o_ticker_id: int,
         session: ClientSession = None,
     ):
         """Overwriting inherited download_data().
         This special case will add a specific identified to json filename from the payload dict.
+        In stream-through mode each page is also cleaned and queued for upload to the db as it arrives.
 
         NOTE: session = None prevents the function from crashing without a session input initially.
         This lets us wait for the process pool to insert the session into the args.
         """
         log.info(f"Downloading price data for {o_ticker}")
-        log.debug(f"Downloading data for {o_ticker} with url: {url} and payload: {payload}")
-        results = await self._query_all(session, url, payload)
-        results = [x.get("results") for x in results if x.get("results")]
-
-        if results:
-            log.info(f"Writing price data for {o_ticker} to file")
-            write_api_data_to_file(
-                results,
-                *self._download_path(
-                    under_ticker + "/" + clean_ticker,
-                    str(timestamp_now()),
-                ),
-            )
-        else:
+        log.debug(f"Downloading data for {o_ticker} with urls: {urls} and payload: {payload}")
+        stream = stream_uploader(OptionsPricesRunner) if stream_enabled() else None
+        ticker_data = OptionTicker(o_ticker, o_ticker_id, None, under_ticker)
+        if not keep_raw():
+            async for page in self._iter_sharded_pages(session, urls, payload):
+                await stream.put([page.get("results", [])], ticker_data)
+            return
+
+        if parquet_enabled():
+            writer = landing_zone_writer(self.paginator_type, under_ticker)
+            async for page in self._iter_sharded_pages(session, urls, payload):
+                writer.write([{**record, "options_ticker": o_ticker} for record in page.get("results", [])])
+                if stream:
+                    await stream.put([page.get("results", [])], ticker_data)
+            return
+
+        with JsonListWriter(
+            *self._download_path(under_ticker + "/" + clean_ticker, str(timestamp_now())),
+            write_empty=False,
+        ) as writer:
+            async for page in self._iter_sharded_pages(session, urls, payload):
+                if page.get("results"):
+                    writer.write(page["results"])
+                    if stream:
+                        await stream.put([page["results"]], ticker_data)
+        self._record_download(writer, under_ticker, contract=o_ticker)
+
+        if not writer.count:
             log.info(f"No price data for {o_ticker} in the time range")
 
 
@@ -445,6 +740,7 @@ class CurrentContractSnapshot(PolygonPaginator):
     """Object to query Polygon API and retrieve current snapshot with greeks and IV. Not historical data"""
 
     paginator_type = "ContractSnapshot"
+    resumable = False  # NOTE: snapshots go stale. A new run pulls all of them again
 
     def __init__(self):
         super().__init__()
@@ -453,6 +749,9 @@ class CurrentContractSnapshot(PolygonPaginator):
         """function to construct the url for the snapshot endpoint"""
         return f"/v3/snapshot/options/{under_ticker}/{o_ticker}"
 
+    def _cache_ttl(self, url: str, payload: dict) -> float | None:
+        return SHORT_TTL
+
     def generate_request_args(self, args_data: list[OptionTicker]):
         """Generate the urls to query the options prices endpoint.
         Inputs should be OptionTickers for unexpired contracts.
@@ -489,24 +788,165 @@ class CurrentContractSnapshot(PolygonPaginator):
         """
         log.info(f"Downloading snapshot/greek data for {o_ticker}")
         log.debug(f"Downloading data for {o_ticker} with url: {url} and no payload")
-        results = await self._query_all(session, url)
-        log.info(f"Writing snapshot/greek data for {o_ticker} to file")
-        write_api_data_to_file(
-            results,
-            *self._download_path(
-                under_ticker + "/" + clean_ticker,
-                str(timestamp_now()),
-            ),
-        )
+        with JsonListWriter(
+            *self._download_path(under_ticker + "/" + clean_ticker, str(timestamp_now()))
+        ) as writer:
+            async for page in self._iter_pages(session, url):
+                writer.write(page)
+        self._record_download(writer, under_ticker, contract=o_ticker)
+
+
+class OptionsChainSnapshot(PolygonPaginator):
+    """Object to query the current snapshot with greeks and IV for a whole options chain at once.
+    Pages through the per-underlying snapshot endpoint (up to 250 contracts per page),
+    instead of making one request and writing one file per contract like CurrentContractSnapshot.
+
+    The strike and expiration filters are set from the contracts passed in,
+    so only the part of the chain that is tracked in the db is pulled"""
+
+    paginator_type = "ChainSnapshot"
+    page_limit = 250
+    resumable = False  # NOTE: snapshots go stale. A new run pulls all of them again
+
+    def __init__(self):
+        super().__init__()
+
+    def _construct_url(self, under_ticker: str) -> str:
+        """function to construct the url for the chain snapshot endpoint"""
+        return f"/v3/snapshot/options/{under_ticker}"
+
+    def _cache_ttl(self, url: str, payload: dict) -> float | None:
+        return SHORT_TTL
+
+    def generate_request_args(self, args_data: list[OptionTicker]) -> list[tuple[str, dict, str]]:
+        """Generate one request per underlying ticker, filtered to the strikes and expirations of its contracts.
+        Inputs should be OptionTickers for unexpired contracts.
+
+        Args:
+            args_data: list of named tuples. OptionTicker(options_ticker, id, expiration_date, underlying_ticker)
+
+        Returns:
+            url_args: list(tuple) of the (url, payload, underlying ticker) for each request"""
+        today = datetime.now().date()
+        chains: dict[str, list[OptionTicker]] = {}
+        for o_ticker in args_data:
+            if o_ticker.expiration_date >= today:
+                chains.setdefault(o_ticker.underlying_ticker, []).append(o_ticker)
+
+        url_args = []
+        for under_ticker, contracts in chains.items():
+            strikes = [strike_from_o_ticker(x.o_ticker) for x in contracts]
+            payload = {
+                "limit": self.page_limit,
+                "expiration_date.gte": str(today),
+                "expiration_date.lte": str(max(x.expiration_date for x in contracts)),
+                "strike_price.gte": min(strikes),
+                "strike_price.lte": max(strikes),
+            }
+            url_args.append((self._construct_url(under_ticker), payload, under_ticker))
+        return url_args
+
+    async def download_data(self, url: str, payload: dict, under_ticker: str, session: ClientSession = None):
+        """Overwriting inherited download_data().
+        Each page is written to its own file, in a folder per download of the chain.
+        e.g. "ChainSnapshot/SPY/1688127754374/0.json"
+
+        NOTE: session = None prevents the function from crashing without a session input initially.
+        This lets us wait for the process pool to insert the session into the args.
+        """
+        log.info(f"Downloading chain snapshot/greek data for {under_ticker}")
+        log.debug(f"Downloading data for {under_ticker} with url: {url} and payload: {payload}")
+        download_time = timestamp_now()
+        download_path = under_ticker + "/" + str(download_time)
+        page_count = 0
+        async for page in self._iter_pages(session, url, payload):
+            file_path, file_name = self._download_path(download_path, str(page_count))
+            write_api_data_to_file(page, file_path, file_name)
+            download_manifest().record(
+                self.paginator_type,
+                under_ticker,
+                file_path + file_name,
+                len(page.get("results", [])),
+                written_at=download_time,
+            )
+            page_count += 1
+
+
+class QuoteRequestPlan:
+    """Request plan for HistoricalQuotes, stored as arrays instead of one (o_ticker, payload) tuple per request.
+
+    Contract i requests the trading days `days[starts[i]:stops[i]]`, newest first,
+    except the days in `finished[i]` (finished by an interrupted run, see `subtract()`).
+    The args tuples are only built while iterating, as the tasks are handed to the pool."""
+
+    def __init__(self, o_tickers: np.ndarray, days: np.ndarray, starts: np.ndarray, stops: np.ndarray):
+        self.o_tickers = o_tickers
+        self.days = days
+        self.starts = starts
+        self.stops = stops
+        self.finished: dict[int, set[str]] = {}
+
+    @property
+    def counts(self) -> np.ndarray:
+        counts = self.stops - self.starts
+        for i, days in self.finished.items():
+            counts[i] -= len(days)
+        return counts
+
+    def subtract(self, completed: set[str]):
+        """Drops the requests whose task key is in `completed`, the keys journaled by an interrupted run"""
+        for i in np.flatnonzero(self.counts):
+            o_ticker = self.o_tickers[i]
+            days = {
+                str(day)
+                for day in self.days[self.starts[i] : self.stops[i]]
+                if task_key((o_ticker, {"timestamp": str(day)})) in completed
+            }
+            if days:
+                self.finished[i] = days
+
+    def __len__(self) -> int:
+        return int(self.counts.sum())
+
+    def __iter__(self):
+        for i in np.flatnonzero(self.counts):
+            o_ticker = self.o_tickers[i]
+            finished = self.finished.get(i, ())
+            for day in self.days[self.starts[i] : self.stops[i]][::-1]:
+                if day not in finished:
+                    yield o_ticker, {"timestamp": str(day)}
+
+    def o_ticker_count_mapping(self) -> dict[str, int]:
+        """dict of o_ticker: count of payloads, for the contracts with at least one request"""
+        counts = self.counts
+        has_requests = counts > 0
+        return dict(zip(self.o_tickers[has_requests].tolist(), counts[has_requests].tolist()))
 
 
 class HistoricalQuotes(HistoricalOptionsPrices):
-    """Object to query Polygon API and retrieve historical quotes for the options chain for a given ticker"""
+    """Object to query Polygon API and retrieve historical quotes for the options chain for a given ticker
+
+    By default every task pulls the whole day of quotes and keeps the records closest to the target timestamps.
+    With `window_requests=True` each target is requested on its own instead (`limit=1`, ascending for the first
+    quote in a window, descending for the closing quote), so only the kept records are transferred.
+    `collapse_empty_windows` then asks for the first quote from a window's start to the close, which skips
+    a run of empty windows in one request (and an empty day in a single request). The requests of a day are
+    sequential in that case. Otherwise all the windows of a day are requested concurrently."""
 
     paginator_type = "OptionsQuotes"
+    retry_policy = RetryPolicy(budgets={"connection": 3, "timeout": 1}, base_delay=0.5)
+    # NOTE: millions of small requests. Fail fast rather than let retries pile up behind slow contracts
 
-    def __init__(self, o_ticker_lookup: dict[str, int], months_hist: int = 24):
+    def __init__(
+        self,
+        o_ticker_lookup: dict[str, int],
+        months_hist: int = 24,
+        window_requests: bool = False,
+        collapse_empty_windows: bool = True,
+    ):
         super().__init__(months_hist=months_hist, timespan=Timespans.hour)
+        self.window_requests = window_requests
+        self.collapse_empty_windows = collapse_empty_windows
         self.start_date, self.close_date = self._determine_start_end_dates(
             string_to_date("2060-01-01")
         )  # NOTE: magic number meant to always trigger the newest date (today)
@@ -514,47 +954,82 @@ class HistoricalQuotes(HistoricalOptionsPrices):
             str(self.start_date), str(self.close_date), count=False, cal_type="o_cal"
         )
         self.dates_stamps = self._prepare_timestamps(self.dates)
+        self.target_index = self._build_target_index(self.dates_stamps)
+        self.target_dates = np.array(sorted(self.target_index))
         self.o_ticker_lookup = o_ticker_lookup
 
+    @classmethod
+    def quotes_path(cls, ticker: str) -> str:
+        """Directory of this process's quotes file for the underlying ticker"""
+        return f"{BASE_DOWNLOAD_PATH}/{cls.paginator_type}/{ticker}/{os.getpid()}/"
+
     def _construct_url(self, o_ticker: str) -> str:
         return f"/v3/quotes/{o_ticker}"
 
+    def _cache_ttl(self, url: str, payload: dict) -> float | None:
+        if "timestamp" in payload:
+            return self._ttl_for_date(string_to_date(payload["timestamp"]))
+        return self._ttl_for_date(timestamp_to_datetime(payload["timestamp.gte"], nano_sec=True).date())
+
     def generate_request_args(
-        self, args_data: list[OptionTicker]
-    ) -> tuple[list[tuple[str, dict]], dict[str, int]]:
-        """Generate the urls to query the options quotes endpoint.
+        self,
+        args_data: list[OptionTicker],
+        watermarks: dict[str, date] | None = None,
+        completed: set[str] | None = None,
+    ) -> "QuoteRequestPlan":
+        """Generate the request plan to query the options quotes endpoint.
         Inputs should be OptionTickers. We then generate the date ranges.
         To prepare the args, we make the timestamp pairs (1 hour wide) and query for the oldest quote in each window.
         Except for the final pair, we get the newest as "closing" quote.
         Only create args if the option has not yet expired during the dates in the time range.
+        If `watermarks` (o_ticker: date of the latest stored quote) are given,
+        only dates after the watermark are requested and expired contracts that are caught up are skipped.
+        Dates before a contract's estimated listing date are not requested.
+        The tasks in `completed` (keys journaled by an interrupted run) are left out.
 
         Outputs:
-            output_args: list of (o_ticker: str, payload:dict)
-            o_ticker_count_mapping: dict of o_ticker: count of payloads
-            }
+            QuoteRequestPlan: the range of trading days to request for each contract.
+            Iterating it yields the (o_ticker: str, payload: dict) args,
+            and `o_ticker_count_mapping()` gives the dict of o_ticker: count of payloads
         """
-        output_args = []
-        o_ticker_count_mapping = {}
         log.info(f"Generating request args for {len(args_data)} option tickers")
-        count = 0
-        sorted_index = self.dates.index.sort_values(ascending=False)
-        for o_ticker in args_data:
-            if count % 500 == 0:
-                log.info(f"Generating request args for {count}/{len(args_data)} option tickers")
-            count += 1
-            payloads = [
-                {
-                    "timestamp": x,
-                }
-                for x in sorted_index[sorted_index <= str(o_ticker.expiration_date)].astype(str)
-            ]
+        watermarks = watermarks or {}
+        o_tickers = np.array([x.o_ticker for x in args_data], dtype=object)
+        expirations = np.array([x.expiration_date for x in args_data], dtype="datetime64[D]")
+        watermark_dates = np.array([watermarks.get(x.o_ticker) for x in args_data], dtype="datetime64[D]")
+        listed_dates = np.array([x.listed_date for x in args_data], dtype="datetime64[D]")
+
+        # NOTE: the dates of each contract are contiguous, so its mask is stored as a [start, stop) slice
+        days = self.dates.index.sort_values().values.astype("datetime64[D]")
+        expiry_groups, expiry_group_index = np.unique(expirations, return_inverse=True)
+        stops = np.searchsorted(days, expiry_groups, side="right")[expiry_group_index]
+        has_watermark = ~np.isnat(watermark_dates)
+        starts = np.where(
+            has_watermark,
+            np.searchsorted(days, np.where(has_watermark, watermark_dates, days[0]), side="right"),
+            0,
+        )  # NOTE: quotes are inserted, not upserted. Only dates after the watermark are requested
+        has_listed_date = ~np.isnat(listed_dates)
+        starts = np.maximum(
+            starts,
+            np.where(
+                has_listed_date,
+                np.searchsorted(days, np.where(has_listed_date, listed_dates, days[0]), side="left"),
+                0,
+            ),
+        )
 
-            if payloads:
-                args = [(o_ticker.o_ticker, payload) for payload in payloads]
-                output_args.extend(args)
-                o_ticker_count_mapping[o_ticker.o_ticker] = len(payloads)
+        caught_up = (
+            has_watermark
+            & (expirations < np.datetime64(datetime.now().date()))
+            & (np.busday_count(np.where(has_watermark, watermark_dates, expirations), expirations) <= 1)
+        )
+        stops = np.where(caught_up, starts, np.maximum(stops, starts))
 
-        return output_args, o_ticker_count_mapping
+        plan = QuoteRequestPlan(o_tickers, np.datetime_as_string(days, unit="D"), starts, stops)
+        if completed:
+            plan.subtract(completed)
+        return plan
 
     @staticmethod
     def _prepare_timestamps(dates: pd.DataFrame) -> list[int]:
@@ -585,7 +1060,8 @@ class HistoricalQuotes(HistoricalOptionsPrices):
 
     async def download_data(self, o_ticker: str, payload: dict, session: ClientSession = None):
         """Overwriting inherited download_data().
-        Creates a file per options ticker with all available quote date in the time range
+        Appends the quotes to the worker's newline-delimited json file for the underlying ticker.
+        In stream-through mode they are queued for upload to the db instead (or as well, to keep the raw data)
 
         args:
             o_ticker: str,
@@ -596,66 +1072,128 @@ class HistoricalQuotes(HistoricalOptionsPrices):
         NOTE: session = None prevents the function from crashing without a session input initially.
         This lets us wait for the process pool to insert the session into the args.
         """
-        results = await self._query_all(
-            session,
-            self._construct_url(o_ticker),
-            {**{"limit": 50000, "sort": "timestamp", "order": "desc"}, **payload},
-        )
+        url = self._construct_url(o_ticker)
+        if self.window_requests:
+            results = await self._query_windows(session, url, payload["timestamp"])
+        else:
+            results = []
+            async for page in self._iter_pages(
+                session, url, {**{"limit": AGGS_PAGE_LIMIT, "sort": "timestamp", "order": "desc"}, **payload}
+            ):
+                results.extend(page.get("results", []))
+            results = self.search_for_timestamps(results)
 
-        results = [record for x in results for record in x.get("results", [])]
         if results:
-            results = self.search_for_timestamps(results)
             results = [{**record, "options_ticker_id": self.o_ticker_lookup[o_ticker]} for record in results]
+            if stream_enabled():
+                # NOTE: copies, as cleaning adds the as_of_date to the records the raw writers still hold
+                await stream_uploader(OptionsQuoteRunner).put([dict(record) for record in results])
+                if not keep_raw():
+                    return
 
             ticker = extract_underlying_from_o_ticker(o_ticker)
-            pid = str(os.getpid())
-            path = f"{BASE_DOWNLOAD_PATH}/{self.paginator_type}/{ticker}/{pid}/"
-            write_api_data_to_file(results, path, append=True)
+            if parquet_enabled():
+                landing_zone_writer(self.paginator_type, ticker).write(results)
+            else:
+                # NOTE: written out by a background thread of the worker
+                buffered_writer(self.quotes_path(ticker)).write(results)
 
         else:
             return False, o_ticker
 
-    def lookup_date_timestamps_from_record(self, timestamp: int) -> list[int]:
-        date = timestamp_to_datetime(timestamp, msec_units=False, nano_sec=True)
-        date = str(date.date())
-        return (
-            self.dates_stamps["nanosecond.gte"]
-            .loc[self.dates_stamps["timestamp.gte"].str.contains(date)]
-            .to_list()
-        )
-
-    # TODO: finish this algorithm
-    def search_for_timestamps(self, data: list[dict]) -> list[dict]:
-        """Finds the date from the data timestamps, looks up the desired 9 timestamps for that date.
-        Then returns the 9 records with the closest timestamps to the desired ones.
-        Needs to handle circumstances where there may not be 9 records."""
-
-        target_timestamps = self.lookup_date_timestamps_from_record(data[0]["sip_timestamp"])
+    async def _query_window(
+        self, session: ClientSession, url: str, start: int, end: int, order: str
+    ) -> dict | None:
+        """Returns the first (order="asc") or last (order="desc") quote in [start, end), or None if it is empty.
+        start and end are nanosecond timestamps"""
+        payload = {"limit": 1, "sort": "timestamp", "order": order, "timestamp.gte": start, "timestamp.lt": end}
+        async for page in self._iter_pages(session, url, payload, limit=True):
+            if page.get("results"):
+                return page["results"][0]
+        return None
+
+    async def _query_windows(self, session: ClientSession, url: str, day: str) -> list[dict]:
+        """Requests the records for the target timestamps of `day` window by window. Returned oldest first"""
+        targets = self.target_index.get(day)
+        if targets is None:
+            return []
+        targets = targets.tolist()
+        close_start, close = targets[-2], targets[-1]
+
+        if self.collapse_empty_windows:
+            records = []
+            window = 0
+            while window < len(targets) - 1:
+                # NOTE: searching up to the close, so a run of empty windows costs a single request
+                record = await self._query_window(session, url, targets[window], close, "asc")
+                if record is None:
+                    break
+                records.append(record)
+                window = bisect_right(targets, record["sip_timestamp"])  # the window after the record's window
+            if records and records[-1]["sip_timestamp"] >= close_start:
+                records.append(await self._query_window(session, url, close_start, close, "desc"))
+        else:
+            records = await asyncio.gather(
+                *(
+                    self._query_window(session, url, start, end, "asc")
+                    for start, end in zip(targets[:-1], targets[1:])
+                ),
+                self._query_window(session, url, close_start, close, "desc"),
+            )
 
-        closest_records = []
-        i, j = len(data) - 1, len(target_timestamps) - 1  # Start pointers at the end
+        unique_records = {}
+        for record in records:
+            if record is not None:
+                unique_records.setdefault(record["sip_timestamp"], record)
+        return [unique_records[stamp] for stamp in sorted(unique_records)]
 
-        cur_tgt_timestamp = target_timestamps[j]
-        while j >= 0 and i >= 0:
-            # If closest_records list has all 9 records, break out of the loop
-            if len(closest_records) == 9:
-                break
+    @staticmethod
+    def _build_target_index(dates_stamps: pd.DataFrame) -> dict[str, np.ndarray]:
+        """Maps each date ("YYYY-MM-DD") to the sorted nanosecond timestamps of its 9 target quotes:
+        the start of each of the 8 windows, plus the end of the last window (the closing quote)"""
+        starts = dates_stamps[["timestamp.gte", "nanosecond.gte"]].rename(columns={"nanosecond.gte": "ns"})
+        closes = dates_stamps.loc[dates_stamps["order"] == "desc", ["timestamp.gte", "nanosecond.lte"]]
+        targets = pd.concat([starts, closes.rename(columns={"nanosecond.lte": "ns"})])
+        targets["date"] = targets["timestamp.gte"].str.slice(stop=10)
+        return {day: np.sort(group["ns"].to_numpy(dtype=np.int64)) for day, group in targets.groupby("date")}
+
+    def lookup_date_timestamps_from_record(self, first_timestamp: int, last_timestamp: int) -> np.ndarray:
+        """Returns the target timestamps for every date from the first to the last record's timestamp (ns).
+        Shape is (dates, 9), one row of ascending targets per date"""
+        first, last = pd.to_datetime([first_timestamp, last_timestamp], utc=True).tz_convert("US/Eastern")
+        lo = np.searchsorted(self.target_dates, first.strftime("%Y-%m-%d"), side="left")
+        hi = np.searchsorted(self.target_dates, last.strftime("%Y-%m-%d"), side="right")
+        if lo >= hi:
+            return np.empty((0, 9), dtype=np.int64)
+        return np.stack([self.target_index[day] for day in self.target_dates[lo:hi]])
 
-            record_timestamp = data[i]["sip_timestamp"]
+    def search_for_timestamps(self, data: list[dict]) -> list[dict]:
+        """Finds the dates from the data timestamps, looks up the desired 9 timestamps for each date.
+        Then returns the records closest to them: the first record in each window
+        and the last record before the close. Returned oldest first.
+
+        Windows without any records are skipped, so there may be fewer than 9 records per date.
+        A record is only returned once, e.g. when it is both the first and last record of the final window."""
+        if not data:
+            return []
+        sip_timestamps = np.fromiter(
+            (record["sip_timestamp"] for record in data), dtype=np.int64, count=len(data)
+        )
+        order = np.argsort(sip_timestamps, kind="stable")
+        sip_timestamps = sip_timestamps[order]
+        n = len(sip_timestamps)
 
-            # has to be bigger than the target
-            if record_timestamp < cur_tgt_timestamp:
-                i -= 1
+        targets = self.lookup_date_timestamps_from_record(sip_timestamps[0], sip_timestamps[-1])
+        if not len(targets):
+            return []
 
-            # has to be smaller than the next target
-            elif record_timestamp >= target_timestamps[max(j - 1, 0)]:
-                if j == 0:
-                    closest_records.append(data[i])
-                j -= 1
+        # first record at or after the start of each window, if it is inside the window
+        firsts = np.searchsorted(sip_timestamps, targets[:, :-1], side="left")
+        firsts_found = (firsts < n) & (sip_timestamps[np.minimum(firsts, n - 1)] < targets[:, 1:])
 
-            else:
-                closest_records.append(data[i])
-                j -= 1
-                i -= 1
+        # last record before the close, if it is inside the final window
+        closes = np.searchsorted(sip_timestamps, targets[:, -1], side="left") - 1
+        closes_found = (closes >= 0) & (sip_timestamps[np.maximum(closes, 0)] >= targets[:, -2])
 
-        return closest_records
+        picks = np.unique(np.concatenate([firsts[firsts_found], closes[closes_found]]))
+        return [data[i] for i in order[picks]]
@@ -0,0 +1,60 @@
+import math
+from datetime import date, datetime, timedelta
+from typing import Iterable
+
+from db_tools.utils import OptionTicker, pull_liquidity_stats
+
+from curator.proj_constants import log
+from curator.utils import strike_from_o_ticker
+
+LIQUIDITY_LOOKBACK_DAYS = 30  # days of options volume used to rank the underlyings
+
+# a contract 10% away from the money ranks the same as one 30 days further from expiration
+MONEYNESS_SCALE = 0.1
+DAYS_TO_EXPIRY_SCALE = 30
+
+
+class DownloadPriority:
+    """Orders the download tasks so the most valuable data lands first, and a run cut short is still useful.
+
+    Underlyings are ranked by the options volume traded on them over the last LIQUIDITY_LOOKBACK_DAYS.
+    Contracts are ranked by how close they are to the money (from the underlying's latest close price)
+    and to their expiration date. Lower scores come first.
+    Contracts of underlyings without a stored price are ranked by expiration alone, after the others.
+    Sorting is stable, so tickers without stored data keep their order."""
+
+    def __init__(
+        self, options_volume: dict[str, float], spot_prices: dict[str, float], today: date | None = None
+    ):
+        self.options_volume = options_volume
+        self.spot_prices = spot_prices
+        self.today = today or datetime.now().date()
+
+    @classmethod
+    async def load(cls, tickers: list[str] = [], lookback_days: int = LIQUIDITY_LOOKBACK_DAYS):
+        """Reads the options volume and latest close price of the tickers from the db. [] empty for all"""
+        since = datetime.now() - timedelta(days=lookback_days)
+        options_volume, spot_prices = await pull_liquidity_stats(since=since, tickers=tickers)
+        log.info(
+            f"ranking downloads with the options volume of {len(options_volume)} underlyings "
+            f"and the close price of {len(spot_prices)}"
+        )
+        return cls(options_volume, spot_prices)
+
+    def underlyings(self, tickers: Iterable[str]) -> list[str]:
+        """Returns the tickers, most traded options first"""
+        return sorted(tickers, key=lambda ticker: -self.options_volume.get(ticker, 0.0))
+
+    def contract_score(self, o_ticker: OptionTicker) -> float:
+        score = abs((o_ticker.expiration_date - self.today).days) / DAYS_TO_EXPIRY_SCALE
+        spot = self.spot_prices.get(o_ticker.underlying_ticker)
+        strike = strike_from_o_ticker(o_ticker.o_ticker)
+        if spot and strike:
+            score += abs(math.log(strike / spot)) / MONEYNESS_SCALE
+        return score
+
+    def contracts(self, o_tickers: Iterable[OptionTicker]) -> list[OptionTicker]:
+        """Returns the contracts, nearest the money and to expiration first"""
+        return sorted(
+            o_tickers, key=lambda x: (x.underlying_ticker not in self.spot_prices, self.contract_score(x))
+        )
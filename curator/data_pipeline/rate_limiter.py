@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from aiomultiprocess.core import get_context
+from data_pipeline.exceptions import InvalidArgs
+
+from curator.proj_constants import POLYGON_PLAN, RATE_LIMIT_PROFILES, log
+
+_rate_limiter = None  # the bucket used by paginators in this process. Set by `install_rate_limiter()`
+
+
+class TokenBucket:
+    """Token bucket stored in shared memory so that every process in a pool draws from one request budget.
+
+    Tokens refill continuously at `rate` per second, up to `capacity`. Each request takes one token.
+    A 429 in any process can `pause()` the bucket, holding back all workers until the pause expires.
+    The bucket must be handed to child processes when they are spawned (e.g. through the pool initializer)."""
+
+    def __init__(self, rate: float, capacity: float):
+        ctx = get_context()
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = ctx.Lock()
+        self._tokens = ctx.RawValue("d", capacity)
+        self._updated = ctx.RawValue("d", time.time())
+        self._paused_until = ctx.RawValue("d", 0.0)
+
+    @classmethod
+    def from_profile(cls, plan: str = POLYGON_PLAN) -> "TokenBucket":
+        """Create a bucket from one of the RATE_LIMIT_PROFILES ("free" or "paid")"""
+        if plan not in RATE_LIMIT_PROFILES:
+            raise InvalidArgs(f"Unknown rate limit profile: {plan}. Must be one of {list(RATE_LIMIT_PROFILES)}")
+        log.info(f"using the {plan} tier rate limit profile: {RATE_LIMIT_PROFILES[plan]}")
+        return cls(**RATE_LIMIT_PROFILES[plan])
+
+    def _take(self) -> float:
+        """Take a token if one is available.
+        Returns 0 on success, otherwise the number of seconds to wait before trying again"""
+        with self._lock:
+            now = time.time()
+            if now < self._paused_until.value:
+                return self._paused_until.value - now
+
+            elapsed = max(0.0, now - self._updated.value)
+            self._tokens.value = min(self.capacity, self._tokens.value + elapsed * self.rate)
+            self._updated.value = now
+            if self._tokens.value >= 1:
+                self._tokens.value -= 1
+                return 0.0
+            return (1 - self._tokens.value) / self.rate
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while (wait := self._take()) > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens to all processes for `seconds`. The bucket restarts empty afterwards"""
+        with self._lock:
+            until = time.time() + seconds
+            if until > self._paused_until.value:
+                self._paused_until.value = until
+                self._updated.value = until
+                self._tokens.value = 0.0
+                log.warning(f"rate limiter paused for {seconds} seconds across all processes")
+
+
+def install_rate_limiter(rate_limiter: TokenBucket):
+    """Pool initializer. Makes the shared bucket available to the paginators running in the worker process"""
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+
+
+def shared_rate_limiter() -> TokenBucket:
+    """Returns the bucket for this process, creating it from the configured plan profile if needed.
+    Pass the returned bucket to `install_rate_limiter()` in child processes to share it."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = TokenBucket.from_profile()
+    return _rate_limiter
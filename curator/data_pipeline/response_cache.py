@@ -0,0 +1,156 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import math
+import os
+import time
+from json import JSONDecodeError
+from urllib.parse import parse_qsl, urlsplit
+
+from curator.proj_constants import (
+    BASE_DOWNLOAD_PATH,
+    POLYGON_BASE_URL,
+    RESPONSE_CACHE_MAX_BYTES,
+    log,
+)
+
+_response_cache = None  # the cache used in this process. Created by `response_cache()`
+
+IMMUTABLE = math.inf  # ttl for responses that can never change, e.g. prices of a closed trading day
+SHORT_TTL = 15 * 60  # ttl in seconds for responses that can still change, e.g. today's data or snapshots
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of API responses.
+
+    Entries are keyed on the normalized url and query params (without the apiKey),
+    stored as `<cache_dir>/<key[:2]>/<key>.json` with their expiry time.
+    Reading an entry refreshes its mtime, so mtime order is LRU order.
+    Once the cache grows past `max_bytes`, the least recently used entries are deleted.
+    Every download process opens the same directory, so the cache is shared across processes and runs.
+
+    The entries are read and written in a thread, off the event loop. Each process counts the bytes it wrote,
+    and checks the size of the cache once they reach EVICTION_CHECK_SHARE of `max_bytes`.
+    Only one process at a time scans the directory (see `evict()`)"""
+
+    EVICTION_CHECK_SHARE = 0.01  # share of max_bytes a process writes between size checks
+
+    def __init__(
+        self,
+        cache_dir: str = f"{BASE_DOWNLOAD_PATH}/.response_cache",
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.writes = 0
+        self.written_since_check = 0  # bytes written by this process since its last size check
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(url: str, payload: dict) -> str:
+        """Hash of the endpoint path and the query params from both the url and the payload, minus the apiKey"""
+        split_url = urlsplit(url.replace(POLYGON_BASE_URL, ""))
+        params = dict(parse_qsl(split_url.query))
+        params.update({k: str(v) for k, v in payload.items()})
+        params.pop("apiKey", None)
+        normalized = json.dumps([split_url.path.rstrip("/"), sorted(params.items())])
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return f"{self.cache_dir}/{key[:2]}/{key}.json"
+
+    async def get(self, key: str) -> dict | None:
+        """Returns the cached response, or None if it is missing or expired"""
+        return await asyncio.to_thread(self._read, key)
+
+    def _read(self, key: str) -> dict | None:
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, JSONDecodeError):
+            self.misses += 1
+            return None
+
+        expires_at = entry.get("expires_at")
+        if expires_at is not None and expires_at < time.time():
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)  # NOTE: marks the entry as recently used for the LRU eviction
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return entry["response"]
+
+    async def put(self, key: str, response: dict, ttl: float):
+        """Store a response. `ttl` is in seconds, IMMUTABLE responses never expire"""
+        self.written_since_check += await asyncio.to_thread(self._write, key, response, ttl)
+        self.writes += 1
+        if self.written_since_check >= self.max_bytes * self.EVICTION_CHECK_SHARE:
+            self.written_since_check = 0
+            await asyncio.to_thread(self.evict)
+
+    def _write(self, key: str, response: dict, ttl: float) -> int:
+        """Writes the entry and returns its size in bytes"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {"expires_at": None if ttl == IMMUTABLE else time.time() + ttl, "response": response}
+        data = json.dumps(entry)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(data)
+        os.replace(temp_path, path)  # NOTE: atomic, so other processes never read a partial entry
+        return len(data)
+
+    def evict(self):
+        """Deletes least recently used entries until the cache is back under 90% of `max_bytes`.
+        Skipped if another process is already evicting, as it scans the same directory"""
+        with open(f"{self.cache_dir}/.evict.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        target = self.max_bytes * 0.9
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # NOTE: another process evicted it first
+            total -= size
+            removed += 1
+        log.info(f"response cache evicted {removed} entries, {total / 1e9:.2f} GB remaining")
+
+
+def response_cache() -> ResponseCache:
+    """Returns the response cache for this process, creating it if needed"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
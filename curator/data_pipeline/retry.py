@@ -0,0 +1,143 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from aiohttp.client_exceptions import ClientConnectionError, ClientResponseError
+from aiomultiprocess.core import get_context
+from data_pipeline.exceptions import ProjAPIError, ProjAPIOverload, ProjAPIServerError
+
+from curator.proj_constants import RETRY_BUDGET_PER_RUN, log
+
+_retry_budget = None  # the run-wide budget used in this process. Set by `install_retry_budget()`
+
+# error classes a RetryPolicy knows how to retry. Exceptions outside these classes are never retried.
+# The first class an exception matches is its class, so the 5xx ProjAPIServerError is an "api_error".
+# NOTE: 4xx responses other than 429 (e.g. 400, 403, 404) are permanent, so "client_error" has no retries
+ERROR_CLASSES = {
+    "overload": (ProjAPIOverload,),
+    "api_error": (ProjAPIServerError,),
+    "connection": (ClientConnectionError, ClientResponseError),
+    "timeout": (asyncio.TimeoutError,),
+    "client_error": (ProjAPIError,),
+}
+
+DEFAULT_RETRY_BUDGETS = {
+    "overload": 10,
+    "api_error": 1,
+    "connection": 5,
+    "timeout": 3,
+    "client_error": 0,
+}
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parses a `Retry-After` header (delay in seconds or an HTTP date) into seconds from now"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryBudget:
+    """Counter of retries in shared memory, capping the total number of retries across all processes in a run.
+    Like the rate limiter, it must be handed to child processes when they are spawned."""
+
+    def __init__(self, total: int = RETRY_BUDGET_PER_RUN):
+        self.total = total
+        self._used = get_context().Value("i", 0)
+        self._exhausted = False
+
+    def take(self) -> bool:
+        """Use one retry from the budget. Returns False if the budget is spent"""
+        with self._used.get_lock():
+            if self._used.value >= self.total:
+                if not self._exhausted:
+                    self._exhausted = True
+                    log.warning(f"retry budget of {self.total} for this run is spent. No more retries")
+                return False
+            self._used.value += 1
+            return True
+
+
+def install_retry_budget(retry_budget: RetryBudget):
+    """Makes the shared retry budget available to the paginators running in this process"""
+    global _retry_budget
+    _retry_budget = retry_budget
+
+
+def shared_retry_budget() -> RetryBudget:
+    """Returns the retry budget for this process, creating it if needed"""
+    global _retry_budget
+    if _retry_budget is None:
+        _retry_budget = RetryBudget()
+    return _retry_budget
+
+
+class RetryPolicy:
+    """Decides whether and when a failed request is retried.
+
+    Each error class ("overload", "api_error", "connection", "timeout", "client_error") has its own retry budget
+    per request.
+    Every retry also draws from the run-wide RetryBudget.
+    Delays back off exponentially from `base_delay` (`overload_delay` for 429s) up to `max_delay`.
+    Jitter keeps the coroutines from retrying in lockstep.
+    A `Retry-After` header from the API overrides the delay, up to `max_retry_after`.
+
+    Set `retry_policy` on a PolygonPaginator subclass to change its retry behavior.
+    `budgets` only needs the error classes that differ from DEFAULT_RETRY_BUDGETS."""
+
+    def __init__(
+        self,
+        budgets: dict[str, int] | None = None,
+        base_delay: float = 1.0,
+        overload_delay: float = 10.0,
+        max_delay: float = 60.0,
+        max_retry_after: float = 300.0,
+    ):
+        self.budgets = {**DEFAULT_RETRY_BUDGETS, **(budgets or {})}
+        self.base_delay = base_delay
+        self.overload_delay = overload_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    @staticmethod
+    def error_class(error: BaseException) -> str | None:
+        for name, exceptions in ERROR_CLASSES.items():
+            if isinstance(error, exceptions):
+                return name
+        return None
+
+    def backoff(self, error_class: str, attempt: int) -> float:
+        """Exponential backoff with "equal jitter": half the delay is fixed, the other half is random"""
+        base = self.overload_delay if error_class == "overload" else self.base_delay
+        delay = min(self.max_delay, base * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def retry_delay(self, error: BaseException, attempts: dict[str, int]) -> float | None:
+        """Returns the seconds to wait before retrying after `error`, or None if it should not be retried.
+
+        Args:
+            error: the exception raised by the request
+            attempts: retries made so far for the request, per error class. Updated in place
+        """
+        error_class = self.error_class(error)
+        if error_class is None or attempts.get(error_class, 0) >= self.budgets.get(error_class, 0):
+            return None
+        if not shared_retry_budget().take():
+            return None
+
+        attempts[error_class] = attempts.get(error_class, 0) + 1
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)  # NOTE: a bad header must not park the worker
+        return self.backoff(error_class, attempts[error_class])
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Sequence
+
+from data_pipeline.exceptions import InvalidArgs
+
+from curator.proj_constants import log
+
+# stages with process pools that may run at once. Every download pool already draws from the same shared
+# rate limiter and retry budget. This bounds the processes and db connections they open on top of it
+MAX_CONCURRENT_STAGES = 2
+
+
+class Stage:
+    """A step of the pipeline. `func` is awaited with the result of each stage it `needs` as a kwarg.
+    `after` only orders the stage after others, without passing their results.
+    Stages that only query the db (`uses_pool=False`) don't take one of the graph's pool slots."""
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Awaitable[Any]],
+        needs: Sequence[str] = (),
+        after: Sequence[str] = (),
+        uses_pool: bool = True,
+    ):
+        self.name = name
+        self.func = func
+        self.needs = tuple(needs)
+        self.after = tuple(after)
+        self.uses_pool = uses_pool
+        self.ready: float = 0.0  # seconds from the start of the graph. Set when it runs
+        self.started: float = 0.0
+        self.finished: float = 0.0
+        self.critical_path: list[str] = []  # the chain of upstream stages that finished last, ending with it
+
+    @property
+    def upstream(self) -> tuple[str, ...]:
+        return self.needs + self.after
+
+
+class StageGraph:
+    """Runs the stages of the pipeline as a dependency graph (DAG) instead of one after another.
+
+    Stages are added in order and may only depend on stages added before them, so the graph can't have cycles.
+    Each stage starts as soon as its upstream stages are done and a pool slot is free.
+    When the graph is done, the timing of every stage and the critical path are logged."""
+
+    def __init__(self, name: str, max_concurrent: int = MAX_CONCURRENT_STAGES):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.stages: dict[str, Stage] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.stages
+
+    def add(
+        self,
+        name: str,
+        func: Callable[..., Awaitable[Any]],
+        needs: Sequence[str] = (),
+        after: Sequence[str] = (),
+        uses_pool: bool = True,
+    ):
+        """Adds a stage. `needs` must already be in the graph. `after` stages that aren't are left out,
+        so a stage can be ordered after an optional one"""
+        if name in self.stages:
+            raise InvalidArgs(f"stage {name} is already in the {self.name} graph")
+        missing = [need for need in needs if need not in self.stages]
+        if missing:
+            raise InvalidArgs(f"stage {name} needs {missing}. Add them to the {self.name} graph before it")
+        after = [stage for stage in after if stage in self.stages]
+        self.stages[name] = Stage(name, func, needs, after, uses_pool)
+
+    async def run(self) -> dict[str, Any]:
+        """Runs every stage and returns their results by name"""
+        pool_slots = asyncio.Semaphore(self.max_concurrent)
+        tasks: dict[str, asyncio.Task] = {}
+        start = time.perf_counter()
+
+        async def run_stage(stage: Stage) -> Any:
+            await asyncio.gather(*(tasks[name] for name in stage.upstream))
+            stage.ready = time.perf_counter() - start
+            inputs = {name: tasks[name].result() for name in stage.needs}
+            if stage.uses_pool:
+                async with pool_slots:
+                    result = await self._run_stage(stage, inputs, start)
+            else:
+                result = await self._run_stage(stage, inputs, start)
+            stage.finished = time.perf_counter() - start
+            return result
+
+        for name, stage in self.stages.items():
+            tasks[name] = asyncio.create_task(run_stage(stage), name=f"{self.name}:{name}")
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        self.report()
+        return {name: task.result() for name, task in tasks.items()}
+
+    async def _run_stage(self, stage: Stage, inputs: dict[str, Any], start: float) -> Any:
+        stage.started = time.perf_counter() - start
+        log.info(f"-- starting stage {stage.name} of {self.name}")
+        return await stage.func(**inputs)
+
+    def report(self):
+        """Logs when every stage was ready, queued for a pool slot and ran, and the graph's critical path"""
+        for stage in self.stages.values():
+            upstream = [self.stages[name] for name in stage.upstream]
+            blocker = max(upstream, key=lambda x: x.finished, default=None)
+            stage.critical_path = (blocker.critical_path if blocker else []) + [stage.name]
+            log.info(
+                f"stage {stage.name}: ready at {stage.ready:.1f}s, "
+                f"queued {stage.started - stage.ready:.1f}s, ran {stage.finished - stage.started:.1f}s, "
+                f"done at {stage.finished:.1f}s. critical path: {' -> '.join(stage.critical_path)}"
+            )
+        if self.stages:
+            last = max(self.stages.values(), key=lambda x: x.finished)
+            log.info(
+                f"{self.name} done in {last.finished:.1f}s. critical path: {' -> '.join(last.critical_path)}"
+            )
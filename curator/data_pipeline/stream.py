@@ -0,0 +1,88 @@
+import asyncio
+from typing import Any
+
+from data_pipeline.path_runner import PathRunner
+
+from curator.proj_constants import STREAM_KEEP_RAW, STREAM_UPLOADS_ENABLED, log
+
+_stream_uploaders = {}  # this process's uploaders by runner_type. See stream_uploader()
+
+STREAM_QUEUE_BATCHES = 32  # cleaned batches queued per process before the downloads wait for the uploaders
+STREAM_UPLOADERS_PER_PROCESS = 2  # concurrent db uploads per process
+
+
+def stream_enabled() -> bool:
+    """True if the download workers upload the prices and quotes to the db as they arrive"""
+    return STREAM_UPLOADS_ENABLED
+
+
+def keep_raw() -> bool:
+    """True if the raw downloads are stored on disk as well. Always True when not streaming"""
+    return STREAM_KEEP_RAW or not STREAM_UPLOADS_ENABLED
+
+
+class StreamUploader:
+    """Uploads the records of one data type to the db from the download worker's own event loop.
+
+    The paginators clean each page with the runner's `clean_data()` and `put()` it in a bounded queue.
+    Uploader tasks take the batches off the queue and upload them with the runner's `upload_func()`,
+    while the downloads continue. A full queue makes the downloads wait, so memory stays bounded
+    and the API is not queried faster than the db can take the data."""
+
+    def __init__(
+        self,
+        runner: PathRunner,
+        max_batches: int = STREAM_QUEUE_BATCHES,
+        uploaders: int = STREAM_UPLOADERS_PER_PROCESS,
+    ):
+        self.runner = runner
+        self.queue: asyncio.Queue[list[dict]] = asyncio.Queue(maxsize=max_batches)
+        self.count = 0
+        self.failed = 0
+        self._tasks = [asyncio.create_task(self._upload()) for _ in range(uploaders)]
+
+    async def put(self, raw_data: list, ticker_data: Any = ()):
+        """Cleans the raw data like the runner does for a downloaded file and queues it in db sized batches"""
+        clean_data = self.runner.clean_data(raw_data, ticker_data)
+        if clean_data:
+            for batch in self.runner._make_batch_generator(clean_data):
+                await self.queue.put(batch)
+
+    async def _upload(self):
+        while True:
+            batch = await self.queue.get()
+            try:
+                await self.runner.upload_func(batch)
+                self.count += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                log.exception(e, extra={"context": f"failed to upload a batch of {self.runner.runner_type}"})
+            finally:
+                self.queue.task_done()
+
+    async def close(self) -> bool:
+        """Waits for the queued batches to be uploaded and stops the uploader tasks.
+        Returns False if any batch failed to upload"""
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        log.info(f"{self.count} {self.runner.runner_type} records streamed to the db, {self.failed} failed")
+        return self.failed == 0
+
+
+def stream_uploader(runner_cls: type[PathRunner]) -> StreamUploader:
+    """Returns this process's uploader for the runner's data type, creating it if needed.
+    Must be called from the worker's event loop"""
+    if runner_cls.runner_type not in _stream_uploaders:
+        _stream_uploaders[runner_cls.runner_type] = StreamUploader(runner_cls())
+    return _stream_uploaders[runner_cls.runner_type]
+
+
+async def close_stream_uploaders() -> bool:
+    """Uploads the batches still queued by every uploader in this process. Call before the process exits.
+    Returns False if any batch failed to upload"""
+    uploaded = True
+    while _stream_uploaders:
+        _, uploader = _stream_uploaders.popitem()
+        uploaded = await uploader.close() and uploaded
+    return uploaded
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from aiomultiprocess.types import PoolTask, Queue
+
+log = logging.getLogger(__name__)
+
+WAKE = "task-feed-wake"  # first item of the sentinel that wakes a reader thread blocked on the queue
+SENTINEL_BACKOFF_SECONDS = 0.01  # wait after putting back another feed's sentinel, so its feed can take it
+
+
+class TaskFeed:
+    """Bridges a worker's multiprocessing task queue into its event loop, so the worker never polls it.
+
+    A reader thread blocks on the queue and hands each task to the loop as it arrives, setting `ready`.
+    It only takes as many tasks off the queue as the worker asked for with `request()`,
+    so the tasks a worker can't start yet stay on the queue for the other workers (and the scheduler).
+    The tasks on the `returned` queue, handed back by workers that exited, are taken first.
+
+    Call `close()` before the worker exits. It returns the tasks received but not picked up."""
+
+    def __init__(self, tx: Queue, returned: Optional[Queue] = None):
+        self.tx = tx
+        self.returned = returned
+        self.loop = asyncio.get_running_loop()
+        self.tasks: deque[PoolTask] = deque()
+        self.ready = asyncio.Event()  # set while received tasks are waiting to be picked up
+        self.requested = 0  # tasks asked for and not received yet
+        self._credits = threading.Semaphore(0)
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._getting = False  # the reader is blocked on the queue
+        self._woken = False  # close() put the sentinel on the queue
+        self._wake = (WAKE, os.getpid(), id(self))
+        self._thread = threading.Thread(target=self._read, name="task-feed", daemon=True)
+        self._thread.start()
+
+    def request(self, count: int):
+        """Asks for tasks until `count` are requested or waiting to be picked up"""
+        more = count - self.requested - len(self.tasks)
+        if more > 0:
+            self.requested += more
+            self._credits.release(more)
+
+    def get_nowait(self) -> PoolTask:
+        """Returns the next received task. Raises queue.Empty if there is none"""
+        if not self.tasks:
+            self.ready.clear()
+            raise queue.Empty
+        return self.tasks.popleft()
+
+    def push_back(self, task: PoolTask):
+        """Puts back a task picked up but not started. It is picked up next, or returned by `close()`"""
+        self.tasks.appendleft(task)
+        self.ready.set()
+
+    def _get(self) -> PoolTask:
+        """Blocks until there is a task. The sentinels of the other feeds on the same queue are put back"""
+        if self.returned is not None:
+            try:
+                return self.returned.get_nowait()
+            except queue.Empty:
+                pass
+        while True:
+            task = self.tx.get()
+            if isinstance(task, tuple) and task[0] == WAKE and task != self._wake:
+                self.tx.put(task)
+                # NOTE: without the wait, the sentinel is taken straight back while it is alone on the queue
+                time.sleep(SENTINEL_BACKOFF_SECONDS)
+                continue
+            return task
+
+    def _read(self):
+        while self._credits.acquire():
+            with self._lock:
+                if self._closed.is_set():
+                    return
+                self._getting = True
+            task = self._get()
+            with self._lock:
+                self._getting = False
+                woken = self._woken
+            if task == self._wake:
+                return
+            self.loop.call_soon_threadsafe(self._received, task)
+            if woken:
+                # NOTE: the task was taken before the sentinel, which must not be left on the queue
+                while (task := self._get()) != self._wake:
+                    self.loop.call_soon_threadsafe(self._received, task)
+                return
+
+    def _received(self, task: PoolTask):
+        self.requested -= 1
+        self.tasks.append(task)
+        self.ready.set()
+
+    async def close(self) -> list[PoolTask]:
+        """Stops the reader thread and returns the tasks it received that weren't picked up.
+        A reader blocked on the queue is woken by a sentinel"""
+        with self._lock:
+            self._closed.set()
+            if self._getting:
+                self._woken = True
+                self.tx.put(self._wake)
+        self._credits.release()
+        # NOTE: the thread schedules its last task before it exits, so it is received before the join returns
+        await asyncio.to_thread(self._thread.join)
+        tasks = list(self.tasks)
+        self.tasks.clear()
+        return tasks
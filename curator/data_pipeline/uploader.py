@@ -2,15 +2,21 @@ import asyncio
 from typing import Any
 
 from aiomultiprocess import Pool
+from data_pipeline.landing_zone import parquet_enabled
 from data_pipeline.path_runner import (
     MetaDataRunner,
+    OptionsChainSnapshotRunner,
     OptionsContractsRunner,
+    OptionsPricesParquetRunner,
     OptionsPricesRunner,
+    OptionsQuoteParquetRunner,
     OptionsQuoteRunner,
     OptionsSnapshotRunner,
     PathRunner,
+    StockPricesParquetRunner,
     StockPricesRunner,
 )
+from data_pipeline.stream import stream_enabled
 
 from curator.proj_constants import CPUS, log
 from curator.utils import pool_kwarg_config
@@ -55,9 +61,13 @@ async def upload_stock_metadata(tickers: list[str], all_: bool):
     await etl_pool_uploader(meta, pool_kwargs=pool_kwargs)
 
 
-async def upload_stock_prices(ticker_id_lookup: dict):
-    """This function uploads stock prices to the database"""
-    price_runner = StockPricesRunner()
+async def upload_stock_prices(ticker_id_lookup: dict, since: int | None = None):
+    """This function uploads stock prices to the database.
+    With `since` (a millisecond timestamp), only the files downloaded since then, e.g. by this run"""
+    if stream_enabled():
+        log.info("stock prices were streamed to the database while downloading")
+        return
+    price_runner = StockPricesParquetRunner(since) if parquet_enabled() else StockPricesRunner(since)
     pool_kwargs = {"childconcurrency": 3}
     await etl_pool_uploader(price_runner, path_input_args=ticker_id_lookup, pool_kwargs=pool_kwargs)
 
@@ -69,24 +79,39 @@ async def upload_options_contracts(ticker_id_lookup: dict, months_hist: int, his
     await etl_pool_uploader(opt_runner, path_input_args=ticker_id_lookup, pool_kwargs=pool_kwargs)
 
 
-async def upload_options_prices(o_tickers: dict):
+async def upload_options_prices(o_tickers: dict, since: int | None = None):
     """This function uploads options prices data to the database
 
     Args:
-        o_tickers: dict(o_ticker_id: OptionsTicker tuple)"""
-    opt_price_runner = OptionsPricesRunner()
+        o_tickers: dict(o_ticker_id: OptionsTicker tuple)
+        since: only the files downloaded since this millisecond timestamp, e.g. by this run"""
+    if stream_enabled():
+        log.info("options prices were streamed to the database while downloading")
+        return
+    opt_price_runner = OptionsPricesParquetRunner(since) if parquet_enabled() else OptionsPricesRunner(since)
     pool_kwargs = {"childconcurrency": 1, "queuecount": int(CPUS / 3)}
     await etl_pool_uploader(opt_price_runner, path_input_args=o_tickers, pool_kwargs=pool_kwargs)
 
 
-async def upload_options_snapshots(o_tickers: dict):
-    snap_runner = OptionsSnapshotRunner()
+async def upload_options_snapshots(o_tickers: dict, chain: bool = False):
+    """This function uploads options snapshot data to the database
+
+    Args:
+        o_tickers: dict(o_ticker: OptionsTicker tuple)
+        chain: upload the per-underlying chain snapshots instead of the per-contract snapshots"""
+    snap_runner = OptionsChainSnapshotRunner() if chain else OptionsSnapshotRunner()
     pool_kwargs = {"childconcurrency": 3}
     await etl_pool_uploader(snap_runner, path_input_args=o_tickers, pool_kwargs=pool_kwargs)
 
 
-async def upload_options_quotes(ticker: str):
-    quote_runner = OptionsQuoteRunner()
+async def upload_options_quotes(ticker: str, since: int | None = None):
+    """This function uploads the options quotes of an underlying to the database.
+    With `since` (a millisecond timestamp), only the quotes files written since then, e.g. by this run.
+    Quotes are inserted, so each file must only be uploaded once"""
+    if stream_enabled():
+        log.info(f"options quotes for {ticker} were streamed to the database while downloading")
+        return []
+    quote_runner = OptionsQuoteParquetRunner(since) if parquet_enabled() else OptionsQuoteRunner(since)
     pool_kwargs = {"childconcurrency": 3}
     pool_kwargs = pool_kwarg_config(pool_kwargs)
 
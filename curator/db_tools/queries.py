@@ -16,7 +16,7 @@ from db_tools.schemas import (
     StockTickers,
     TickerModel,
 )
-from sqlalchemy import case, delete, func, or_, select, update
+from sqlalchemy import and_, case, delete, func, or_, select, update
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -74,19 +74,41 @@ async def query_options_tickers(
     """
     This is to pull all options contracts for a given underlying ticker.
     The batch input is to only pull o_ticker_ids for given o_tickers
+
+    `first_listed_as_of` is only returned when it is later than the earliest listing of the underlying.
+    Contracts in the earliest listing may have been listed long before it, so their listing date is unknown
     """
     # NOTE: may need to adjust to not pull all columns from table
     if batch and all_:
         raise InvalidArgs("Can't have query all_ and a batch")
 
+    # The earliest listing is aggregated over every contract of the underlying, before the expiration,
+    # batch and ticker filters below narrow the rows
+    earliest_listing = (
+        select(
+            OptionsTickers.underlying_ticker_id.label("ticker_id"),
+            func.min(OptionsTickers.first_listed_as_of).label("earliest_listing"),
+        )
+        .group_by(OptionsTickers.underlying_ticker_id)
+        .subquery()
+    )
     stmt = (
         select(
             OptionsTickers.options_ticker,
             OptionsTickers.id,
             OptionsTickers.expiration_date,
             StockTickers.ticker,
+            case(
+                (
+                    OptionsTickers.first_listed_as_of > earliest_listing.c.earliest_listing,
+                    OptionsTickers.first_listed_as_of,
+                ),
+                else_=None,
+            ).label("first_listed_as_of"),
         )
-        .join(StockTickers)
+        .select_from(OptionsTickers)
+        .join(StockTickers, StockTickers.id == OptionsTickers.underlying_ticker_id)
+        .join(earliest_listing, earliest_listing.c.ticker_id == OptionsTickers.underlying_ticker_id)
         .where(StockTickers.type.in_(["ADRC", "ETF", "CS"]))
     )
     if not all_:
@@ -186,6 +208,7 @@ async def update_options_tickers(session: AsyncSession, data: list[OptionsTicker
             cfi=stmt.excluded.cfi,
             exercise_style=stmt.excluded.exercise_style,
             primary_exchange=stmt.excluded.primary_exchange,
+            first_listed_as_of=func.least(OptionsTickers.first_listed_as_of, stmt.excluded.first_listed_as_of),
         ),
     )
     await session.execute(stmt)
@@ -250,48 +273,35 @@ async def latest_date_per_ticker(session: AsyncSession, tickers: list[str] = [],
     """
 
     if options:
-        # Query for options data
-        subquery = (
-            select(
-                OptionsTickers.id.label("ticker_id"),
-                OptionsTickers.expiration_date,
-                func.max(
-                    case(
-                        (
-                            OptionsQuotesRaw.as_of_date < OptionsTickers.expiration_date,
-                            OptionsQuotesRaw.as_of_date,
-                        ),
-                        else_=None,
-                    )
-                ).label("latest_quote_date"),
-                func.max(
-                    case(
-                        (
-                            OptionsPricesRaw.as_of_date < OptionsTickers.expiration_date,
-                            OptionsPricesRaw.as_of_date,
-                        ),
-                        else_=None,
-                    )
-                ).label("latest_price_date"),
+        # Query for options data. The latest quote and price dates are aggregated separately
+        # so a contract's quotes and prices are never joined against each other
+        def latest_date_subquery(table, label: str):
+            return (
+                select(table.options_ticker_id.label("ticker_id"), func.max(table.as_of_date).label(label))
+                .join(OptionsTickers, OptionsTickers.id == table.options_ticker_id)
+                .join(StockTickers, StockTickers.id == OptionsTickers.underlying_ticker_id)
+                .where(table.as_of_date < OptionsTickers.expiration_date)
+                .where(or_(StockTickers.ticker.in_(tickers), len(tickers) == 0))
+                .group_by(table.options_ticker_id)
+                .subquery()
             )
-            .join(StockTickers, StockTickers.id == OptionsTickers.underlying_ticker_id)
-            .outerjoin(OptionsQuotesRaw, OptionsQuotesRaw.options_ticker_id == OptionsTickers.id)
-            .outerjoin(OptionsPricesRaw, OptionsPricesRaw.options_ticker_id == OptionsTickers.id)
-            .where(or_(StockTickers.ticker.in_(tickers), len(tickers) == 0))
-            .group_by(OptionsTickers.id, OptionsTickers.expiration_date)
-            .subquery()
-        )
+
+        quotes_subquery = latest_date_subquery(OptionsQuotesRaw, "latest_quote_date")
+        prices_subquery = latest_date_subquery(OptionsPricesRaw, "latest_price_date")
 
         query = (
             select(
                 StockTickers.ticker,
                 OptionsTickers.options_ticker,
                 OptionsTickers.expiration_date,
-                subquery.c.latest_price_date,
-                subquery.c.latest_quote_date,
+                prices_subquery.c.latest_price_date,
+                quotes_subquery.c.latest_quote_date,
             )
-            .join(subquery, subquery.c.ticker_id == OptionsTickers.id)
+            .select_from(OptionsTickers)
             .join(StockTickers, StockTickers.id == OptionsTickers.underlying_ticker_id)
+            .outerjoin(prices_subquery, prices_subquery.c.ticker_id == OptionsTickers.id)
+            .outerjoin(quotes_subquery, quotes_subquery.c.ticker_id == OptionsTickers.id)
+            .where(or_(StockTickers.ticker.in_(tickers), len(tickers) == 0))
         )
 
     else:
@@ -309,3 +319,45 @@ async def latest_date_per_ticker(session: AsyncSession, tickers: list[str] = [],
         )
 
     return (await session.execute(query)).all()
+
+
+@Session
+async def options_volume_per_ticker(session: AsyncSession, since: datetime, tickers: list[str] = []):
+    """query to retrieve the total options volume traded on each underlying ticker since a date.
+    If tickers is [] empty, return all. Tickers without options prices since the date are left out
+    """
+    query = (
+        select(StockTickers.ticker, func.sum(OptionsPricesRaw.volume).label("options_volume"))
+        .join(OptionsTickers, OptionsTickers.id == OptionsPricesRaw.options_ticker_id)
+        .join(StockTickers, StockTickers.id == OptionsTickers.underlying_ticker_id)
+        .where(OptionsPricesRaw.as_of_date >= since)
+        .where(or_(StockTickers.ticker.in_(tickers), len(tickers) == 0))
+        .group_by(StockTickers.ticker)
+    )
+    return (await session.execute(query)).all()
+
+
+@Session
+async def latest_close_per_ticker(session: AsyncSession, tickers: list[str] = []):
+    """query to retrieve the most recent stored close price of each stock ticker.
+    If tickers is [] empty, return all
+    """
+    subquery = (
+        select(StockPricesRaw.ticker_id, func.max(StockPricesRaw.as_of_date).label("latest_date"))
+        .join(StockTickers, StockTickers.id == StockPricesRaw.ticker_id)
+        .where(or_(StockTickers.ticker.in_(tickers), len(tickers) == 0))
+        .group_by(StockPricesRaw.ticker_id)
+        .subquery()
+    )
+    query = (
+        select(StockTickers.ticker, StockPricesRaw.close_price)
+        .join(
+            subquery,
+            and_(
+                subquery.c.ticker_id == StockPricesRaw.ticker_id,
+                subquery.c.latest_date == StockPricesRaw.as_of_date,
+            ),
+        )
+        .join(StockTickers, StockTickers.id == StockPricesRaw.ticker_id)
+    )
+    return (await session.execute(query)).all()
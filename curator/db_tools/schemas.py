@@ -99,6 +99,7 @@ class OptionsTickers(Base):
     cfi = Column(String)
     exercise_style = Column(String)
     primary_exchange = Column(String)
+    first_listed_as_of = Column(Date)  # the first monthly "as_of" listing the contract appeared in
 
 
 class OptionsTickerModel(BaseModel):
@@ -113,6 +114,7 @@ class OptionsTickerModel(BaseModel):
     cfi: Optional[str]
     exercise_style: Optional[str]
     primary_exchange: Optional[str]
+    first_listed_as_of: Optional[date]
     id: Optional[int]
 
 
@@ -1,9 +1,20 @@
 from collections import namedtuple
+from datetime import date, datetime
 
-from db_tools.queries import query_options_tickers, query_stock_tickers
-from pandas import DataFrame
+from db_tools.queries import (
+    latest_close_per_ticker,
+    latest_date_per_ticker,
+    options_volume_per_ticker,
+    query_options_tickers,
+    query_stock_tickers,
+)
 
-OptionTicker = namedtuple("OptionTicker", ["o_ticker", "id", "expiration_date", "underlying_ticker"])
+from curator.utils import previous_listing_date
+
+OptionTicker = namedtuple(
+    "OptionTicker", ["o_ticker", "id", "expiration_date", "underlying_ticker", "listed_date"], defaults=(None,)
+)
+# NOTE: listed_date is the earliest date the contract may have been listed. None if unknown
 
 
 async def pull_tickers_from_db(tickers: list[str] = [], all_: bool = True) -> list[dict]:
@@ -36,11 +47,49 @@ async def generate_o_ticker_lookup(
 
     o_tickers = await query_options_tickers(stock_tickers=tickers, all_=all_, unexpired=unexpired)
 
-    return {x[0]: OptionTicker(*x) for x in o_tickers}
+    # NOTE: a contract first seen in a monthly listing was missing from the previous listing. So listed after it
+    return {
+        x[0]: OptionTicker(*x[:4], listed_date=previous_listing_date(x[4]) if x[4] else None) for x in o_tickers
+    }
+
+
+async def pull_stock_price_watermarks(tickers: list[str] = []) -> dict[str, date]:
+    """Looks up the high-water mark (date of the most recent stored price) for each stock ticker.
+    If tickers is [] empty, return all. Tickers without prices are left out
+
+    Returns:
+        watermarks: dict[str, date], e.g. {"SPY": date(2024, 6, 7)}
+    """
+    results = await latest_date_per_ticker(tickers=tickers, options=False)
+    return {x[0]: x[1].date() for x in results if x[1] is not None}
+
 
+async def split_quotes_and_prices_dates(tickers: list[str] = []) -> tuple[dict[str, date], dict[str, date]]:
+    """Runs the query and splits the high-water marks of each options contract by prices and quotes segments.
+    If tickers is [] empty, return all. Contracts without prices/quotes are left out of that segment
 
-async def split_quotes_and_prices_dates(tickers: list[str] = []) -> tuple[DataFrame, DataFrame]:
-    """Runs the query then performs the pandas operations and splits by quotes and prices segments"""
-    # df = await latest_date_per_ticker(tickers, options=True)
-    # price_df = df[["options_ticker", "latest_price_date"]].loc[df["latest"]]
-    pass
+    Returns:
+        price_watermarks: dict[str, date] of o_ticker: date of the most recent stored price
+        quote_watermarks: dict[str, date] of o_ticker: date of the most recent stored quote
+    """
+    results = await latest_date_per_ticker(tickers=tickers, options=True)
+    price_watermarks = {x[1]: x[3].date() for x in results if x[3] is not None}
+    quote_watermarks = {x[1]: x[4].date() for x in results if x[4] is not None}
+    return price_watermarks, quote_watermarks
+
+
+async def pull_liquidity_stats(
+    since: datetime, tickers: list[str] = []
+) -> tuple[dict[str, float], dict[str, float]]:
+    """Looks up the options volume traded on each underlying since a date and its latest stored close price.
+    If tickers is [] empty, return all. Tickers without stored data are left out
+
+    Returns:
+        options_volume: dict[str, float] of ticker: total options volume since the date
+        spot_prices: dict[str, float] of ticker: most recent close price
+    """
+    volumes = await options_volume_per_ticker(since=since, tickers=tickers)
+    closes = await latest_close_per_ticker(tickers=tickers)
+    options_volume = {x[0]: float(x[1]) for x in volumes if x[1] is not None}
+    spot_prices = {x[0]: float(x[1]) for x in closes if x[1]}
+    return options_volume, spot_prices
@@ -52,16 +52,44 @@ def db_uri_maker() -> str:
 POSTGRES_DATABASE_URL = db_uri_maker()
 POSTGRES_BATCH_MAX = 62000
 
-BASE_DOWNLOAD_PATH = str(Path("~").expanduser()) + "/.polygon_data"
+BASE_DOWNLOAD_PATH = os.getenv("POLYGON_DOWNLOAD_PATH", str(Path("~").expanduser()) + "/.polygon_data")
 
-POLYGON_BASE_URL = "https://api.polygon.io"
+# storage for the raw stock prices, options prices and options quotes: "json" or "parquet" (requires pyarrow)
+STORAGE_BACKEND = os.getenv("POLYGON_STORAGE_BACKEND", "json").lower()
+LANDING_ZONE_PATH = BASE_DOWNLOAD_PATH + "/parquet"
+
+# opt-in stream-through mode: download workers clean the prices and quotes and upload them as they arrive.
+# The raw downloads are only stored on disk as well with POLYGON_STREAM_KEEP_RAW
+STREAM_UPLOADS_ENABLED = os.getenv("POLYGON_STREAM_UPLOADS", "false").lower() in ("1", "true")
+STREAM_KEEP_RAW = os.getenv("POLYGON_STREAM_KEEP_RAW", "false").lower() in ("1", "true")
+
+# opt-in on-disk cache of API responses, stored under BASE_DOWNLOAD_PATH/.response_cache
+RESPONSE_CACHE_ENABLED = os.getenv("POLYGON_RESPONSE_CACHE", "false").lower() in ("1", "true")
+RESPONSE_CACHE_MAX_BYTES = int(float(os.getenv("POLYGON_RESPONSE_CACHE_GB", "20")) * 1e9)
+
+# point at a stand-in server, e.g. data_pipeline/fake_polygon.py, to run the pipeline without the real API
+POLYGON_BASE_URL = os.getenv("POLYGON_BASE_URL", "https://api.polygon.io")
 POLYGON_API_KEY = os.getenv("POLYGON_API_KEY")
+# Polygon subscription tier, "free" or "paid" ("local" for a stand-in server). Selects the rate limit profile
+POLYGON_PLAN = os.getenv("POLYGON_PLAN", "paid")
 
 # total number of requests the API can handle at once. 100/sec rate limit
 MAX_CONCURRENT_REQUESTS = 250
+# Max number of requests per second for the paid API tier: 100
+MAX_QUERY_PER_SECOND = 99
 # Max number of requests per minute for the free API tier: 5
 MAX_QUERY_PER_MINUTE = 4
 
+# max number of request retries across all download processes in a single run
+RETRY_BUDGET_PER_RUN = 10000
+
+# token bucket settings shared by every download process. rate is tokens/sec, capacity is the max burst
+RATE_LIMIT_PROFILES = {
+    "free": {"rate": MAX_QUERY_PER_MINUTE / 60, "capacity": 1},
+    "paid": {"rate": MAX_QUERY_PER_SECOND, "capacity": MAX_QUERY_PER_SECOND},
+    "local": {"rate": 100000, "capacity": 100000},
+}
+
 CPUS = cpu_count() - 2
 
 POOL_DEFAULT_KWARGS = {
@@ -3,9 +3,10 @@ import inspect
 import json
 import logging
 import os
-from datetime import datetime
+import threading
+from datetime import date, datetime
 from json import JSONDecodeError
-from typing import TextIO
+from typing import Iterable, TextIO
 
 import numpy as np
 from dateutil.relativedelta import relativedelta
@@ -13,6 +14,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from curator.proj_constants import POOL_DEFAULT_KWARGS, async_session_maker, e_cal, log, o_cal
 
+_buffered_writers = {}  # this process's BufferedJsonlWriters by directory. Managed by `buffered_writer()`
+
 _async_session_maker = async_session_maker  # NOTE: This is monkeypatched by a test fixture!
 
 
@@ -49,6 +52,13 @@ def first_weekday_of_month(year_month_array: np.ndarray) -> np.ndarray:
     # NOTE: may need to add info for market holidays
 
 
+def previous_listing_date(as_of: date) -> date:
+    """Returns the "as_of" date of the monthly options contracts listing before the one on `as_of`.
+    (the first weekday of the previous month)"""
+    previous_month = as_of.replace(day=1) - relativedelta(months=1)
+    return first_weekday_of_month(np.array([previous_month.strftime("%Y-%m")])).tolist()[0]
+
+
 def trading_days_in_range(start_date: str, end_date: str, cal_type="e_cal", count: bool = True) -> int:
     if cal_type == "e_cal":
         cal = e_cal
@@ -83,6 +93,11 @@ def extract_underlying_from_o_ticker(o_ticker: str) -> str:
     return underlying
 
 
+def strike_from_o_ticker(o_ticker: str) -> float:
+    """The last 8 digits of an options ticker are the strike price x 1000"""
+    return int(o_ticker[-8:]) / 1000
+
+
 def Session(func):
     """
     Decorator that adds a SQLAlchemy AsyncSession to the function passed if the function is not
@@ -166,6 +181,196 @@ def write_api_data_to_file(data: list[dict] | dict, file_path: str, file_name: s
             f.write(",\n")
 
 
+class JsonListWriter:
+    """Writes a json list to file one item at a time, so the whole list never has to be held in memory.
+    The file is only created once the first item is written.
+    On close, an empty list is still written to file if `write_empty` is set
+
+    Example:
+    with JsonListWriter(file_path, file_name) as writer:
+        async for page in paginator._iter_pages(session, url, payload):
+            writer.write(page)
+    """
+
+    def __init__(self, file_path: str, file_name: str, write_empty: bool = True):
+        self.file_path = file_path
+        self.file_name = file_name
+        self.write_empty = write_empty
+        self.count = 0
+        self.closed = False
+        self._file: TextIO | None = None
+
+    def __enter__(self) -> "JsonListWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def written(self) -> bool:
+        """True once the file has been created"""
+        return self._file is not None
+
+    def _open(self):
+        os.makedirs(self.file_path, exist_ok=True)
+        self._file = open(self.file_path + self.file_name, "w")
+        self._file.write("[")
+
+    def write(self, item: dict | list):
+        if self._file is None:
+            self._open()
+        elif self.count:
+            self._file.write(",\n")
+        json.dump(item, self._file)
+        self.count += 1
+
+    def flush(self) -> int:
+        """Flushes the items written so far to the OS. Returns the size of the file, where writing can resume"""
+        self._file.flush()
+        return self._file.tell()
+
+    @classmethod
+    def resume(cls, file_path: str, file_name: str, offset: int, count: int) -> "JsonListWriter":
+        """Reopens the file of an interrupted download to keep writing after its first `count` items.
+        `offset` is the size of the file after those items (from `flush()`), anything after it is cut off"""
+        writer = cls(file_path, file_name)
+        writer._file = open(file_path + file_name, "r+")
+        writer._file.truncate(offset)
+        writer._file.seek(offset)
+        writer.count = count
+        return writer
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._file is None and self.write_empty:
+            self._open()
+        if self._file is not None:
+            self._file.write("]")
+            self._file.close()
+            log.info(f"Data written to {self.file_path + self.file_name}")
+
+
+class BufferedJsonlWriter:
+    """Appends records to a newline-delimited json file from a background thread,
+    so the event loop never blocks on file I/O.
+
+    Records are buffered in memory and flushed as one chunk once `flush_records` are buffered,
+    or every `flush_seconds`. The file stays open until `close()`.
+    `checkpoint()` writes out the buffer and fsyncs the file.
+    Get the writers through `buffered_writer()`, which keeps one per directory in each process."""
+
+    def __init__(self, file_path: str, file_name: str, flush_records: int = 5000, flush_seconds: float = 5.0):
+        os.makedirs(file_path, exist_ok=True)
+        self.file_path = file_path
+        self.file_name = file_name
+        self.flush_records = flush_records
+        self.flush_seconds = flush_seconds
+        self.count = 0
+        self.closed = False
+        self._buffer: list[dict] = []
+        self._buffer_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._file = open(file_path + file_name, "a")
+        self._thread = threading.Thread(target=self._run, name=f"writer-{file_name}", daemon=True)
+        self._thread.start()
+
+    def write(self, records: list[dict]):
+        """Buffers the records. Never blocks on disk"""
+        with self._buffer_lock:
+            self._buffer.extend(records)
+            full = len(self._buffer) >= self.flush_records
+        self.count += len(records)
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self.closed:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes out the buffer, without fsyncing the file.
+        Once it returns, every record written before the call is in the file, even if another thread flushes"""
+        with self._file_lock:
+            with self._buffer_lock:
+                records, self._buffer = self._buffer, []
+            if not records:
+                return
+            self._file.write("".join(json.dumps(record) + "\n" for record in records))
+            self._file.flush()
+
+    def checkpoint(self):
+        """Writes out the buffer and fsyncs the file, so everything written so far survives a crash"""
+        self.flush()
+        with self._file_lock:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._wake.set()
+        self._thread.join()
+        self.checkpoint()
+        self._file.close()
+        log.info(f"{self.count} records written to {self.file_path + self.file_name}")
+
+
+def buffered_writer(file_path: str) -> BufferedJsonlWriter:
+    """Returns this process's writer for the directory, creating it if needed.
+    A new writer starts a new file named with the current millisecond timestamp,
+    so the files of different runs are never mixed"""
+    if file_path not in _buffered_writers:
+        _buffered_writers[file_path] = BufferedJsonlWriter(file_path, str(timestamp_now()) + ".jsonl")
+    return _buffered_writers[file_path]
+
+
+def checkpoint_buffered_writers():
+    """fsyncs every buffered writer in this process. May be called from another thread than the writes"""
+    for writer in list(_buffered_writers.values()):
+        writer.checkpoint()
+
+
+def flush_buffered_writers(file_paths: Iterable[str] | None = None):
+    """Writes out the buffer of this process's buffered writers for the directories (or of all of them),
+    so other processes can read it. May be called from another thread than the writes"""
+    if file_paths is None:
+        writers = list(_buffered_writers.values())
+    else:
+        writers = [_buffered_writers[path] for path in file_paths if path in _buffered_writers]
+    for writer in writers:
+        writer.flush()
+
+
+def close_buffered_writers():
+    """Flushes and closes every buffered writer in this process. Call before the process exits"""
+    while _buffered_writers:
+        _, writer = _buffered_writers.popitem()
+        writer.close()
+
+
+def read_jsonl_file(file_path: str) -> list[dict]:
+    """Read records from a newline-delimited json file.
+    Lines that can't be parsed (e.g. the last line after a crash) are skipped"""
+    data = []
+    skipped = 0
+    with open(file_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                data.append(json.loads(line))
+            except JSONDecodeError:
+                skipped += 1
+    if skipped:
+        log.warning(f"skipped {skipped} unreadable lines in {file_path}")
+    return data
+
+
 def close_json_file(file: TextIO):
     """removes the dangling comma and adds a closing bracket to correctly format json files
     Specifically will be used with Quotes downloads"""
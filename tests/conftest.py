@@ -0,0 +1,28 @@
+import os
+import socket
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+
+# NOTE: proj_constants reads the env at import, so it is set before any test module imports the pipeline
+_scratch = tempfile.mkdtemp(prefix="curator_tests_")
+_pgpass = Path(_scratch) / ".pgpass"
+_pgpass.write_text("localhost:5432:db:u:p")
+os.environ["ENVIRONMENT"] = "LOCAL"
+os.environ["PGPASSFILE"] = str(_pgpass)
+os.environ["POLYGON_DOWNLOAD_PATH"] = f"{_scratch}/polygon_data"
+
+# the data_pipeline modules import each other as top level packages, from the curator folder
+CURATOR_PATH = Path(__file__).resolve().parents[1] / "curator"
+sys.path.insert(0, str(CURATOR_PATH))
+
+
+@pytest.fixture
+def free_port() -> int:
+    """A port for a local server, e.g. data_pipeline/fake_polygon.py"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
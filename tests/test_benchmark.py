@@ -0,0 +1,46 @@
+import inspect
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from aiomultiprocess.pool import PoolWorker
+from data_pipeline.benchmark import _process_tree_rss, run_benchmark
+from data_pipeline.fake_polygon import FakePolygon, SyntheticMarket
+
+
+# pgpass file ("host:port:db:user:password") of a scratch db with the schema migrated, `add` writes to it
+SCRATCH_PGPASSFILE = os.getenv("CURATOR_TEST_PGPASSFILE")
+
+
+def test_process_tree_rss_includes_the_children():
+    alone = _process_tree_rss(os.getpid())
+    allocate = "import time; data = b'x' * 200 * 2**20; time.sleep(30)"
+    child = subprocess.Popen([sys.executable, "-c", allocate])
+    try:
+        while _process_tree_rss(child.pid) < 200 * 2**20:
+            time.sleep(0.01)  # NOTE: until the child has allocated its buffer
+        assert _process_tree_rss(os.getpid()) >= alone + 200 * 2**20
+    finally:
+        child.kill()
+        child.wait()
+    assert _process_tree_rss(child.pid) == 0
+
+
+@pytest.mark.skipif(not SCRATCH_PGPASSFILE, reason="set CURATOR_TEST_PGPASSFILE to run `add` on a scratch db")
+@pytest.mark.skipif(
+    "init_client_session" not in inspect.signature(PoolWorker.__init__).parameters,
+    reason="needs the project's aiomultiprocess fork",
+)
+async def test_add_round_trip(monkeypatch, tmp_path, free_port):
+    """Runs a small `main.py add` against the fake server, from the stock metadata to the options quotes"""
+    monkeypatch.setenv("PGPASSFILE", SCRATCH_PGPASSFILE)
+    market = SyntheticMarket(seed=3, n_tickers=1, expirations=1, strikes=2, quotes_per_day=50)
+    server = FakePolygon(market=market, port=free_port, latency=0.001, latency_jitter=0)
+    metrics = await run_benchmark(server, market.tickers, [1, 2, 3, 4, 5, 6], 1, "local", str(tmp_path))
+
+    assert metrics["return_code"] == 0
+    assert metrics["statuses"] == {200: metrics["requests"]}
+    assert metrics["records"] > 0
+    assert metrics["peak_tree_rss_mb"] > 0
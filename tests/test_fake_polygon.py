@@ -0,0 +1,96 @@
+import json
+import os
+from datetime import date
+from glob import glob
+
+import numpy as np
+import pytest
+from aiohttp import ClientSession
+from data_pipeline import polygon_utils
+from data_pipeline.fake_polygon import FakePolygon, SyntheticMarket
+from data_pipeline.polygon_utils import HistoricalQuotes
+from data_pipeline.rate_limiter import install_rate_limiter, TokenBucket
+
+from curator.utils import close_buffered_writers, trading_days_in_range
+
+
+AS_OF = date(2025, 6, 3)
+
+
+@pytest.fixture
+async def server(monkeypatch, free_port):
+    """Fake Polygon server the paginators of this process are pointed at"""
+    market = SyntheticMarket(seed=11, n_tickers=2, quotes_per_day=300)
+    server = FakePolygon(market, port=free_port, latency=0)
+    monkeypatch.setattr(polygon_utils, "POLYGON_BASE_URL", server.base_url)
+    monkeypatch.setattr(polygon_utils, "POLYGON_API_KEY", "test")
+    install_rate_limiter(TokenBucket.from_profile("local"))
+    await server.start()
+    yield server
+    await server.stop()
+
+
+@pytest.fixture
+async def session(server):
+    async with ClientSession(base_url=server.base_url) as session:
+        yield session
+
+
+@pytest.fixture
+def contract(server) -> dict:
+    return server.market.contracts(server.market.tickers[0], AS_OF)[0]
+
+
+async def test_listing_follows_next_url(server, session, contract):
+    paginator = HistoricalQuotes({})
+    payload = {"underlying_ticker": contract["underlying_ticker"], "as_of": str(AS_OF), "limit": 7}
+    pages = await paginator._query_all(session, "/v3/reference/options/contracts", payload)
+    expected = server.market.contracts(contract["underlying_ticker"], AS_OF)
+    assert len(expected) > 7
+    assert [result for page in pages for result in page["results"]] == expected
+    assert len(pages) == server.stats.requests == -(-len(expected) // 7)
+
+
+async def test_client_error_is_not_retried(server, session, caplog):
+    paginator = HistoricalQuotes({})
+    assert await paginator._query_all(session, "/v3/reference/unknown", {}) == []
+    assert server.stats.requests == 1
+    [record] = [record for record in caplog.records if "client error" in record.getMessage()]
+    assert "status code 404" in record.getMessage() and "/v3/reference/unknown" in record.getMessage()
+    assert record.exc_info is None
+
+
+@pytest.mark.parametrize("window_requests", [False, True])
+async def test_quotes_round_trip(server, session, contract, window_requests):
+    """Downloads a week of quotes of a contract and reads them back from the quotes file"""
+    o_ticker = contract["ticker"]
+    paginator = HistoricalQuotes({o_ticker: 42}, window_requests=window_requests)
+    paginator.dates = trading_days_in_range(str(AS_OF), "2025-06-06", count=False, cal_type="o_cal")
+    paginator.dates_stamps = paginator._prepare_timestamps(paginator.dates)
+    paginator.target_index = paginator._build_target_index(paginator.dates_stamps)
+    paginator.target_dates = np.array(sorted(paginator.target_index))
+
+    days = paginator.target_dates.tolist()
+    for day in days:
+        assert await paginator.download_data(o_ticker, {"timestamp": day}, session=session) is None
+    assert await paginator.download_data(o_ticker, {"timestamp": "2025-06-07"}, session=session) == (
+        False,
+        o_ticker,
+    )
+    close_buffered_writers()
+
+    quotes_path = HistoricalQuotes.quotes_path(contract["underlying_ticker"])
+    records = []
+    for file_path in sorted(glob(f"{quotes_path}*.jsonl")):
+        with open(file_path) as f:
+            records.extend(json.loads(line) for line in f)
+    for file_path in glob(f"{quotes_path}*"):
+        os.remove(file_path)
+
+    expected = [
+        {**record, "options_ticker_id": 42}
+        for day in days
+        for record in paginator.search_for_timestamps(server.market.quotes(o_ticker, date.fromisoformat(day)))
+    ]
+    assert len(expected) == len(days) * 7  # NOTE: the fake market closes at 16:00, the final window is empty
+    assert records == expected
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from data_pipeline.orchestrator import ALL_COMPONENTS, build_import_graph
+
+
+def upstream(graph) -> dict[str, tuple[str, ...]]:
+    return {name: stage.upstream for name, stage in graph.stages.items()}
+
+
+def test_import_graph_wiring():
+    graph = build_import_graph(ALL_COMPONENTS, ["SPY"], datetime(2024, 1, 1), datetime(2024, 2, 1), 2)
+    assert upstream(graph) == {
+        "stock_metadata": (),
+        "ticker_lookup": ("stock_metadata",),
+        "stock_prices": ("ticker_lookup",),
+        "options_contracts": ("ticker_lookup",),
+        "priority": (),
+        "o_tickers": ("options_contracts",),
+        "options_prices": ("o_tickers", "priority"),
+        "unexpired_o_tickers": ("options_contracts",),
+        "options_snapshots": ("unexpired_o_tickers",),
+        "options_quotes": ("ticker_lookup", "o_tickers", "priority"),
+    }
+    assert [name for name, stage in graph.stages.items() if not stage.uses_pool] == [
+        "ticker_lookup",
+        "priority",
+        "o_tickers",
+        "unexpired_o_tickers",
+    ]
+
+
+def test_refresh_graph_waits_for_the_watermarks():
+    graph = build_import_graph([4, 6], ["SPY"], datetime(2024, 1, 1), datetime(2024, 2, 1), 2, refresh=True)
+    assert upstream(graph) == {
+        "ticker_lookup": (),  # NOTE: the stages of components that aren't part of the run are left out
+        "priority": (),
+        "o_tickers": (),
+        "watermarks": (),
+        "options_prices": ("o_tickers", "priority", "watermarks"),
+        "options_quotes": ("ticker_lookup", "o_tickers", "priority", "watermarks"),
+    }
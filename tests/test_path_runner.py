@@ -0,0 +1,16 @@
+import os
+
+from data_pipeline.path_runner import OptionsQuoteRunner
+
+
+def test_quotes_of_an_underlying_without_files(tmp_path):
+    runner = OptionsQuoteRunner(since=1000)
+    runner.base_directory = str(tmp_path)
+    assert runner.generate_path_args("ZAAA") == []
+
+    os.makedirs(tmp_path / "ZAAA" / "123")
+    (tmp_path / "ZAAA" / "123" / "1000.jsonl").write_text("")
+    (tmp_path / "ZAAA" / "123" / "999.jsonl").write_text("")
+    assert runner.generate_path_args("ZAAA") == [(f"{tmp_path}/ZAAA/123/1000.jsonl", "ZAAA")]
+    runner.since = 2000
+    assert runner.generate_path_args("ZAAA") == []
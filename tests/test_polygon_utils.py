@@ -0,0 +1,157 @@
+import random
+from datetime import date, datetime, time
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pytest
+from data_pipeline.journal import task_key
+from data_pipeline.polygon_utils import HistoricalQuotes, QuoteRequestPlan
+
+from curator.utils import trading_days_in_range
+
+
+DAY = date(2025, 6, 3)
+O_TICKER = "O:SPY250620C00500000"
+
+
+def ns(hour: int, minute: int = 0, day: date = DAY) -> int:
+    return int(datetime.combine(day, time(hour, minute), ZoneInfo("America/New_York")).timestamp() * 10**9)
+
+
+def quote(sip_timestamp: int) -> dict:
+    return {"sip_timestamp": sip_timestamp, "bid_price": 1.0, "ask_price": 1.1}
+
+
+@pytest.fixture
+def quotes() -> HistoricalQuotes:
+    """HistoricalQuotes with the target timestamps of a fixed week, instead of the months before today"""
+    paginator = HistoricalQuotes({O_TICKER: 1})
+    paginator.dates = trading_days_in_range("2025-06-02", "2025-06-06", count=False, cal_type="o_cal")
+    paginator.dates_stamps = paginator._prepare_timestamps(paginator.dates)
+    paginator.target_index = paginator._build_target_index(paginator.dates_stamps)
+    paginator.target_dates = np.array(sorted(paginator.target_index))
+    return paginator
+
+
+def test_target_timestamps(quotes):
+    """The starts of the hourly windows from the open, then the close of the final window"""
+    starts = [ns(hour, 30) for hour in range(9, 16)] + [ns(16)]
+    assert quotes.target_index[str(DAY)].tolist() == starts + [ns(17)]
+
+
+class TestSearchForTimestamps:
+    def test_keeps_the_first_record_of_each_window_and_the_close(self, quotes):
+        kept = [ns(9, 31), ns(11, 40), ns(15, 40), ns(16, 10), ns(16, 20)]
+        dropped = [ns(9, 45), ns(15, 50), ns(16, 15), ns(17, 5)]
+        data = [quote(stamp) for stamp in kept + dropped]
+        random.Random(1).shuffle(data)
+        assert [record["sip_timestamp"] for record in quotes.search_for_timestamps(data)] == kept
+
+    def test_record_that_is_first_and_close_is_returned_once(self, quotes):
+        data = [quote(ns(16, 30)), quote(ns(10, 0))]
+        assert quotes.search_for_timestamps(data) == [data[1], data[0]]
+
+    def test_spans_several_days(self, quotes):
+        next_day = date(2025, 6, 4)
+        data = [quote(ns(12, 0, next_day)), quote(ns(12, 0)), quote(ns(12, 1))]
+        assert quotes.search_for_timestamps(data) == [data[1], data[0]]
+
+    def test_no_targets(self, quotes):
+        assert quotes.search_for_timestamps([]) == []
+        assert quotes.search_for_timestamps([quote(ns(12, 0, date(2025, 6, 7)))]) == []  # NOTE: a saturday
+
+
+class TestQuoteRequestPlan:
+    days = np.array(["2025-06-02", "2025-06-03", "2025-06-04", "2025-06-05", "2025-06-06"])
+
+    def plan(self) -> QuoteRequestPlan:
+        o_tickers = np.array(["A", "B", "C"], dtype=object)
+        return QuoteRequestPlan(o_tickers, self.days, np.array([0, 2, 4]), np.array([3, 5, 4]))
+
+    def test_requests_newest_first(self):
+        plan = self.plan()
+        assert len(plan) == 6
+        assert [(o_ticker, payload["timestamp"][-2:]) for o_ticker, payload in plan] == [
+            ("A", "04"),
+            ("A", "03"),
+            ("A", "02"),
+            ("B", "06"),
+            ("B", "05"),
+            ("B", "04"),
+        ]
+        assert plan.o_ticker_count_mapping() == {"A": 3, "B": 3}
+
+    def test_subtract_drops_the_completed_requests(self):
+        plan = self.plan()
+        completed = {
+            task_key(("A", {"timestamp": "2025-06-03"})),
+            task_key(("B", {"timestamp": "2025-06-06"})),
+            task_key(("B", {"timestamp": "2025-06-02"})),  # NOTE: outside the range of B
+            task_key(("C", {"timestamp": "2025-06-05"})),
+        }
+        plan.subtract(completed)
+        assert len(plan) == 4
+        assert [(o_ticker, payload["timestamp"][-2:]) for o_ticker, payload in plan] == [
+            ("A", "04"),
+            ("A", "02"),
+            ("B", "05"),
+            ("B", "04"),
+        ]
+        assert plan.o_ticker_count_mapping() == {"A": 2, "B": 2}
+
+    def test_subtract_drops_finished_contracts(self):
+        plan = self.plan()
+        plan.subtract({task_key(("A", {"timestamp": day})) for day in self.days})
+        assert plan.o_ticker_count_mapping() == {"B": 3}
+        assert {o_ticker for o_ticker, _ in plan} == {"B"}
+
+
+class TestCollapseEmptyWindows:
+    @pytest.fixture
+    def requests(self, quotes, monkeypatch) -> list[tuple[int, int, str]]:
+        """Serves the window queries from `self.records`, and records them"""
+        requests = []
+
+        async def query_window(session, url, start, end, order):
+            requests.append((start, end, order))
+            window = [record for record in self.records if start <= record["sip_timestamp"] < end]
+            if not window:
+                return None
+            return window[0] if order == "asc" else window[-1]
+
+        monkeypatch.setattr(quotes, "_query_window", query_window)
+        return requests
+
+    async def test_skips_a_run_of_empty_windows_in_one_request(self, quotes, requests):
+        self.records = [quote(ns(9, 31)), quote(ns(9, 40)), quote(ns(14, 0))]
+        results = await quotes._query_windows(None, "/v3/quotes/x", str(DAY))
+        assert [record["sip_timestamp"] for record in results] == [ns(9, 31), ns(14, 0)]
+        assert requests == [
+            (ns(9, 30), ns(17), "asc"),
+            (ns(10, 30), ns(17), "asc"),
+            (ns(14, 30), ns(17), "asc"),
+        ]
+
+    async def test_requests_the_close_after_a_record_in_the_final_window(self, quotes, requests):
+        self.records = [quote(ns(9, 31)), quote(ns(16, 30)), quote(ns(16, 45))]
+        results = await quotes._query_windows(None, "/v3/quotes/x", str(DAY))
+        assert [record["sip_timestamp"] for record in results] == [ns(9, 31), ns(16, 30), ns(16, 45)]
+        assert requests[-1] == (ns(16), ns(17), "desc")
+        assert len(requests) == 3
+
+    async def test_empty_day_costs_one_request(self, quotes, requests):
+        self.records = []
+        assert await quotes._query_windows(None, "/v3/quotes/x", str(DAY)) == []
+        assert len(requests) == 1
+        assert await quotes._query_windows(None, "/v3/quotes/x", "2025-06-07") == []
+        assert len(requests) == 1
+
+    async def test_same_records_as_every_window(self, quotes, requests):
+        self.records = [quote(ns(hour, minute)) for hour in range(9, 17) for minute in (35, 50)]
+        collapsed = await quotes._query_windows(None, "/v3/quotes/x", str(DAY))
+        collapsed_requests = len(requests)
+
+        quotes.collapse_empty_windows = False
+        assert await quotes._query_windows(None, "/v3/quotes/x", str(DAY)) == collapsed
+        assert len(requests) - collapsed_requests == 9
+        assert collapsed_requests == 9
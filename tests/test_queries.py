@@ -0,0 +1,40 @@
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class CapturingSession(AsyncSession):
+    """Records the statements executed instead of sending them to a database"""
+
+    def __init__(self):
+        super().__init__()
+        self.statements = []
+
+    async def execute(self, statement, *args, **kwargs):
+        self.statements.append(statement)
+        return self
+
+    def all(self):
+        return []
+
+
+def compiled(statement) -> str:
+    return " ".join(str(statement.compile(dialect=postgresql.dialect())).split())
+
+
+async def test_earliest_listing_ignores_the_contract_filters():
+    from db_tools.queries import query_options_tickers
+
+    session = CapturingSession()
+    await query_options_tickers(
+        session, ["SPY"], batch=[{"options_ticker": "O:SPY251219C00650000"}], unexpired=True
+    )
+    sql = compiled(session.statements[0])
+
+    assert " OVER " not in sql
+    subquery, _, outer = sql.partition(") AS anon_1")
+    assert "min(options_tickers.first_listed_as_of)" in subquery
+    assert "GROUP BY options_tickers.underlying_ticker_id" in subquery
+    # the expiration, batch and ticker filters only narrow the outer rows
+    assert "WHERE" not in subquery
+    assert "options_tickers.expiration_date >=" in outer
+    assert "options_tickers.options_ticker IN" in outer
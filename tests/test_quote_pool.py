@@ -0,0 +1,211 @@
+import asyncio
+import queue
+from collections import defaultdict
+
+import pytest
+from data_pipeline.QuotePool import ContractProgress, EMPTY_RUN_LENGTH, QuotePool, QuoteScheduler
+
+
+def make_pool(max_queued_tasks: int, queues: int = 2, prefetch_tasks: int = 2) -> QuotePool:
+    """A QuotePool without worker processes. Its queues are plain queues, drained by `work()`"""
+    pool = object.__new__(QuotePool)
+    pool.o_ticker_count_mapping = {}
+    pool.scheduler = QuoteScheduler(
+        pool.o_ticker_count_mapping, prefetch_tasks=prefetch_tasks, processes=queues
+    )
+    pool.scheduler.qids = list(range(queues))
+    pool.queues = {qid: (queue.Queue(), None) for qid in range(queues)}
+    pool.tasks_scheduled = 0
+    pool.failed_tasks = 0
+    pool.current_o_ticker = None
+    pool.open_contract = None
+    pool.task_tickers = {}
+    pool.ticker_tasks = {}
+    pool.ticker_futures = {}
+    pool.task_capacity = asyncio.Event()
+    pool.last_id = 0
+    pool.running = True
+    pool.max_queued_tasks = max_queued_tasks
+    return pool
+
+
+async def work(pool: QuotePool, received: dict[int, list[tuple]], peak: list[int]):
+    """Stands in for the workers: finishes the tasks of every queue, one per queue at a time"""
+    while True:
+        await asyncio.sleep(0.001)
+        peak[0] = max(peak[0], len(pool.task_tickers))
+        for qid, (tx, _) in pool.queues.items():
+            try:
+                tid, _, args, _, task_count = tx.get_nowait()
+            except queue.Empty:
+                continue
+            received[qid].append((args[0], args[1], task_count))
+            pool.finish_work(tid, None, None)
+
+
+def contract_args(ticker: str, contracts: int, days: int) -> tuple[list[tuple], dict[str, int]]:
+    args = [(f"O:{ticker}{c}", day) for c in range(contracts) for day in range(days)]
+    return args, {f"O:{ticker}{c}": days for c in range(contracts)}
+
+
+async def noop(*args):
+    pass
+
+
+async def test_feed_sends_whole_contracts_and_resolves_the_ticker():
+    pool = make_pool(max_queued_tasks=3)
+    received, peak = defaultdict(list), [0]
+    worker = asyncio.create_task(work(pool, received, peak))
+    try:
+        args, mapping = contract_args("A", contracts=4, days=5)
+        assert await pool.feed(noop, args, mapping, "A") == 20
+        assert await asyncio.wait_for(pool.ticker_done("A"), 2) == "A"
+    finally:
+        worker.cancel()
+
+    assert sum(len(tasks) for tasks in received.values()) == 20
+    contract_queues = defaultdict(set)
+    for qid, tasks in received.items():
+        for o_ticker, _, task_count in tasks:
+            contract_queues[o_ticker].add(qid)
+            assert task_count == 5
+        # NOTE: a queue receives each contract whole, its days in order
+        o_tickers = [o_ticker for o_ticker, _, _ in tasks]
+        assert o_tickers == sorted(o_tickers)
+        assert [day for _, day, _ in tasks] == [day for _ in range(len(tasks) // 5) for day in range(5)]
+    assert all(len(qids) == 1 for qids in contract_queues.values())
+    assert len(received) == 2
+    # NOTE: the feed only waits between contracts, so it overshoots by up to one contract
+    assert peak[0] <= 3 + 5
+    assert pool.ticker_tasks == {} and pool.ticker_futures == {} and pool.task_tickers == {}
+
+
+async def test_tickers_resolve_as_their_own_tasks_finish():
+    pool = make_pool(max_queued_tasks=100)
+    received, peak = defaultdict(list), [0]
+    a_args, a_mapping = contract_args("A", contracts=2, days=3)
+    b_args, b_mapping = contract_args("B", contracts=2, days=3)
+    await pool.feed(noop, a_args, a_mapping, "A")
+    a_done = pool.ticker_done("A")
+    await pool.feed(noop, b_args, b_mapping, "B")
+    b_done = pool.ticker_done("B")
+    assert not a_done.done()
+
+    worker = asyncio.create_task(work(pool, received, peak))
+    try:
+        assert await asyncio.wait_for(a_done, 2) == "A"
+        assert await asyncio.wait_for(b_done, 2) == "B"
+    finally:
+        worker.cancel()
+    o_tickers = {o_ticker for tasks in received.values() for o_ticker, _, _ in tasks}
+    assert o_tickers == set(a_mapping) | set(b_mapping)
+
+
+async def test_ticker_done_after_the_tasks_finished():
+    pool = make_pool(max_queued_tasks=100)
+    received, peak = defaultdict(list), [0]
+    worker = asyncio.create_task(work(pool, received, peak))
+    try:
+        args, mapping = contract_args("A", contracts=1, days=2)
+        await pool.feed(noop, args, mapping, "A")
+        while pool.task_tickers:
+            await asyncio.sleep(0.001)
+        done = pool.ticker_done("A")
+        assert done.done() and done.result() == "A"
+        assert pool.ticker_done("NOTHING").done()  # NOTE: a ticker without any tasks
+    finally:
+        worker.cancel()
+
+
+async def test_failed_tasks_still_finish_the_ticker():
+    pool = make_pool(max_queued_tasks=100)
+    args, mapping = contract_args("A", contracts=1, days=2)
+    await pool.feed(noop, args, mapping, "A")
+    done = pool.ticker_done("A")
+    for tid in list(pool.task_tickers):
+        pool.finish_work(tid, None, "Traceback: boom")
+    assert done.done()
+    assert pool.failed_tasks == 2
+
+
+async def test_feed_checks_the_task_count_of_each_contract():
+    pool = make_pool(max_queued_tasks=100)
+    args, mapping = contract_args("A", contracts=2, days=3)
+    with pytest.raises(ValueError):
+        await pool.feed(noop, args, {**mapping, "O:A0": 4}, "A")
+
+
+async def test_feed_on_a_closed_pool():
+    pool = make_pool(max_queued_tasks=100)
+    pool.running = False
+    with pytest.raises(RuntimeError):
+        await pool.feed(noop, [], {}, "A")
+
+
+def test_scheduler_steals_whole_contracts_from_the_longest_backlog():
+    scheduler = QuoteScheduler({}, prefetch_tasks=1, processes=2)
+    scheduler.qids = [0, 1]
+    scheduler.initialize_queue_size(("O:A0",))
+    contracts = [[(tid, noop, (f"O:A{tid}", 0), {}, 1)] for tid in range(1, 4)]
+    for tid, contract in enumerate(contracts, start=1):
+        scheduler.task_queues[tid] = 0
+        scheduler.queue_size[0] += 1
+        scheduler.hold(0, contract)
+
+    assert scheduler.next_contract(0) == contracts[0]
+    assert scheduler.next_contract(0) is None  # NOTE: queue 0 has its prefetch in flight
+    assert scheduler.next_contract(1) == contracts[1]
+    assert scheduler.stolen == 1
+    assert scheduler.task_queues[2] == 1
+    assert scheduler.queue_size == {0: 2, 1: 1}
+
+    assert scheduler.complete_task(1) == 0
+    assert scheduler.next_contract(0) == contracts[2]
+    assert scheduler.next_contract(1) is None
+
+
+def test_scheduler_splits_the_processes_between_the_queues():
+    scheduler = QuoteScheduler({}, prefetch_tasks=1, processes=5)
+    scheduler.qids = [0, 1]
+    scheduler.initialize_queue_size(("O:A0",))
+    assert scheduler.workers == {0: 3, 1: 2}
+    assert scheduler.queue_size == {0: 0, 1: 0}
+
+    scheduler.queue_size = {0: 5, 1: 4}
+    assert scheduler.cycle_queue() == 0  # NOTE: fewer tasks per worker, 5 / 3 against 4 / 2
+    contract = [(1, noop, ("O:A1", 0), {}, 1)]
+    scheduler.task_queues[1] = 1
+    scheduler.hold(1, contract)
+    scheduler.in_flight = {0: 2, 1: 2}
+    assert scheduler.next_contract(1) is None  # NOTE: its 2 workers have their prefetch in flight
+    assert scheduler.next_contract(0) == contract
+
+
+class TestContractProgress:
+    def test_merges_empty_tids_into_runs(self):
+        contract = ContractProgress("O:A", task_count=30)
+        for tid in (5, 7, 6):
+            contract.add_empty(tid)
+        assert contract.run_ends == {5: 7}
+        assert contract.run_starts == {7: 5}
+
+        contract.add_empty(10)
+        assert contract.run_ends == {5: 7, 10: 10}
+        assert contract.listed
+
+    def test_run_of_empty_tasks_marks_the_listing_date(self):
+        contract = ContractProgress("O:A", task_count=30)
+        for tid in range(1, EMPTY_RUN_LENGTH):
+            contract.add_empty(tid)
+        assert contract.listed
+        contract.add_empty(EMPTY_RUN_LENGTH)
+        assert not contract.listed
+        assert contract.run_ends == contract.run_starts == {}
+
+    def test_gap_between_runs_is_filled_last(self):
+        contract = ContractProgress("O:A", task_count=30)
+        for tid in [*range(1, 11), *range(12, 21)]:
+            contract.add_empty(tid)
+        assert contract.listed
+        contract.add_empty(11)
+        assert not contract.listed
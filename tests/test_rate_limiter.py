@@ -0,0 +1,51 @@
+import time
+
+import pytest
+from data_pipeline.exceptions import InvalidArgs
+from data_pipeline.rate_limiter import TokenBucket
+
+
+def test_bucket_starts_full_then_waits_for_a_refill():
+    bucket = TokenBucket(rate=10, capacity=3)
+    assert [bucket._take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    wait = bucket._take()
+    assert 0 < wait <= 0.1
+
+
+def test_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(rate=10, capacity=3)
+    for _ in range(3):
+        bucket._take()
+    bucket._updated.value -= 60  # NOTE: as if a minute passed, which refills far more than the capacity
+    assert [bucket._take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket._take() > 0
+
+
+def test_pause_holds_back_tokens_and_restarts_empty():
+    bucket = TokenBucket(rate=10, capacity=3)
+    bucket.pause(5)
+    assert 4.9 < bucket._take() <= 5
+    bucket.pause(1)  # NOTE: a shorter pause doesn't cut the current one short
+    assert bucket._take() > 4.9
+
+    bucket._paused_until.value = time.time() - 0.15  # NOTE: the pause ended 1.5 tokens ago
+    bucket._updated.value = bucket._paused_until.value
+    assert bucket._tokens.value == 0.0
+    assert bucket._take() == 0.0
+    assert bucket._take() > 0
+
+
+async def test_acquire_waits_for_a_token():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.perf_counter()
+    for _ in range(3):
+        await bucket.acquire()
+    assert time.perf_counter() - start >= 2 / 50 * 0.9
+
+
+def test_from_profile():
+    bucket = TokenBucket.from_profile("free")
+    assert bucket.capacity == 1
+    assert bucket.rate < 1
+    with pytest.raises(InvalidArgs):
+        TokenBucket.from_profile("platinum")
@@ -0,0 +1,53 @@
+import os
+import time
+
+import pytest
+from data_pipeline.response_cache import IMMUTABLE, ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path) -> ResponseCache:
+    return ResponseCache(cache_dir=str(tmp_path / "cache"), max_bytes=10**9)
+
+
+def test_key_ignores_the_api_key_and_param_order():
+    key = ResponseCache.key("/v3/quotes/O:SPY", {"timestamp": "2024-01-02", "limit": 50000, "apiKey": "a"})
+    assert key == ResponseCache.key("/v3/quotes/O:SPY/?limit=50000&apiKey=b", {"timestamp": "2024-01-02"})
+    assert key != ResponseCache.key("/v3/quotes/O:SPY", {"timestamp": "2024-01-03", "limit": 50000})
+
+
+async def test_entries_expire_after_their_ttl(cache):
+    await cache.put("fresh", {"results": [1]}, ttl=60)
+    await cache.put("stale", {"results": [2]}, ttl=-1)
+    await cache.put("closed_day", {"results": [3]}, ttl=IMMUTABLE)
+    assert await cache.get("fresh") == {"results": [1]}
+    assert await cache.get("stale") is None
+    assert await cache.get("closed_day") == {"results": [3]}
+    assert await cache.get("missing") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+async def test_evicts_the_least_recently_used_entries(cache):
+    for i, key in enumerate(["aa0", "aa1", "aa2", "aa3"]):
+        await cache.put(key, {"results": ["x" * 100]}, ttl=IMMUTABLE)
+        os.utime(cache._path(key), (time.time() - 100 + i, time.time() - 100 + i))
+    assert await cache.get("aa0") is not None  # NOTE: reading it makes it the most recently used
+
+    entry_size = os.path.getsize(cache._path("aa0"))
+    cache.max_bytes = entry_size * 3
+    cache.evict()  # NOTE: down to 90% of max_bytes, so 2 entries are left
+    assert [await cache.get(key) is not None for key in ["aa0", "aa1", "aa2", "aa3"]] == [
+        True,
+        False,
+        False,
+        True,
+    ]
+
+
+async def test_put_checks_the_size_once_enough_was_written(tmp_path):
+    cache = ResponseCache(cache_dir=str(tmp_path / "cache"), max_bytes=50000)
+    for i in range(30):
+        await cache.put(f"{i:03d}", {"results": ["x" * 1000]}, ttl=IMMUTABLE)
+    sub_dirs = [sub_dir for sub_dir in os.scandir(cache.cache_dir) if sub_dir.is_dir()]
+    assert sum(entry.stat().st_size for sub_dir in sub_dirs for entry in os.scandir(sub_dir)) <= cache.max_bytes
+    assert cache.writes == 30
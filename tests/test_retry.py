@@ -0,0 +1,87 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from aiohttp.client_exceptions import ClientConnectionError
+from data_pipeline import retry
+from data_pipeline.exceptions import ProjAPIError, ProjAPIOverload, ProjAPIServerError
+from data_pipeline.retry import install_retry_budget, parse_retry_after, RetryBudget, RetryPolicy
+
+
+@pytest.fixture(autouse=True)
+def retry_budget():
+    """A fresh run-wide budget for every test"""
+    previous = retry._retry_budget
+    budget = RetryBudget(total=1000)
+    install_retry_budget(budget)
+    yield budget
+    install_retry_budget(previous)
+
+
+def test_retry_budget_caps_the_retries_of_a_run():
+    budget = RetryBudget(total=2)
+    assert [budget.take() for _ in range(3)] == [True, True, False]
+    assert budget._used.value == 2
+
+
+def test_policy_stops_when_the_run_budget_is_spent():
+    install_retry_budget(RetryBudget(total=1))
+    policy = RetryPolicy()
+    attempts = {}
+    assert policy.retry_delay(ClientConnectionError(), attempts) is not None
+    assert policy.retry_delay(ClientConnectionError(), attempts) is None
+
+
+def test_error_classes():
+    assert RetryPolicy.error_class(ProjAPIOverload()) == "overload"
+    assert RetryPolicy.error_class(ProjAPIServerError()) == "api_error"
+    assert RetryPolicy.error_class(ClientConnectionError()) == "connection"
+    assert RetryPolicy.error_class(asyncio.TimeoutError()) == "timeout"
+    assert RetryPolicy.error_class(ProjAPIError(status=404)) == "client_error"
+    assert RetryPolicy.error_class(ValueError()) is None
+
+
+def test_client_errors_are_not_retried(retry_budget):
+    assert RetryPolicy().retry_delay(ProjAPIError(status=403), {}) is None
+    assert retry_budget._used.value == 0  # NOTE: 4xx other than 429 are permanent
+
+
+def test_budget_per_error_class():
+    policy = RetryPolicy(budgets={"connection": 2}, base_delay=0.01)
+    attempts = {}
+    assert policy.retry_delay(ClientConnectionError(), attempts) is not None
+    assert policy.retry_delay(ClientConnectionError(), attempts) is not None
+    assert policy.retry_delay(ClientConnectionError(), attempts) is None
+    assert policy.retry_delay(asyncio.TimeoutError(), attempts) is not None  # NOTE: counted apart
+    assert attempts == {"connection": 2, "timeout": 1}
+    assert policy.retry_delay(ValueError(), attempts) is None
+
+
+def test_backoff_is_exponential_with_equal_jitter():
+    random.seed(3)
+    policy = RetryPolicy(base_delay=1.0, overload_delay=10.0, max_delay=8.0)
+    for attempt, delay in ((1, 1.0), (2, 2.0), (3, 4.0), (4, 8.0), (5, 8.0)):
+        samples = [policy.backoff("connection", attempt) for _ in range(200)]
+        assert all(delay / 2 <= sample <= delay for sample in samples)
+        assert len(set(samples)) > 1  # NOTE: the jitter keeps retries from happening in lockstep
+    assert 4.0 <= policy.backoff("overload", 1) <= 8.0  # NOTE: 10 seconds, capped at max_delay
+
+
+def test_retry_after_overrides_the_backoff_up_to_the_cap():
+    policy = RetryPolicy(max_retry_after=300.0)
+    assert policy.retry_delay(ProjAPIOverload(retry_after=7.0), {}) == 7.0
+    assert policy.retry_delay(ProjAPIOverload(retry_after=0.0), {}) == 0.0
+    assert policy.retry_delay(ProjAPIOverload(retry_after=86400.0), {}) == 300.0
+    assert 5.0 <= policy.retry_delay(ProjAPIOverload(), {}) <= 10.0
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("12") == 12.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=120)
+    assert 110 < parse_retry_after(format_datetime(retry_at, usegmt=True)) <= 120
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from data_pipeline.exceptions import InvalidArgs
+from data_pipeline.stages import StageGraph
+
+
+def stage(events: list, name: str, seconds: float = 0.01, result=None):
+    async def func(**inputs):
+        events.append(("start", name, sorted(inputs)))
+        await asyncio.sleep(seconds)
+        events.append(("end", name))
+        return result if result is not None else name
+
+    return func
+
+
+def started(events: list, name: str) -> int:
+    return next(i for i, event in enumerate(events) if event[:2] == ("start", name))
+
+
+def ended(events: list, name: str) -> int:
+    return events.index(("end", name))
+
+
+async def test_stages_run_after_their_upstream_stages():
+    events = []
+    graph = StageGraph("test", max_concurrent=3)
+    graph.add("tickers", stage(events, "tickers", result=["A"]), uses_pool=False)
+    graph.add("prices", stage(events, "prices", 0.05), needs=["tickers"])
+    graph.add("contracts", stage(events, "contracts"), needs=["tickers"])
+    graph.add("quotes", stage(events, "quotes"), needs=["contracts"], after=["prices"])
+    results = await graph.run()
+
+    assert results == {"tickers": ["A"], "prices": "prices", "contracts": "contracts", "quotes": "quotes"}
+    assert ended(events, "tickers") < started(events, "prices")
+    assert ended(events, "tickers") < started(events, "contracts")
+    assert started(events, "contracts") < ended(events, "prices")  # NOTE: siblings run at once
+    assert ended(events, "prices") < started(events, "quotes")
+    assert ("start", "quotes", ["contracts"]) in events  # NOTE: `after` orders without passing the result
+    assert graph.stages["quotes"].critical_path == ["tickers", "prices", "quotes"]
+
+
+async def test_pool_slots_bound_the_stages_running_at_once():
+    events = []
+    graph = StageGraph("test", max_concurrent=1)
+    graph.add("lookup", stage(events, "lookup", 0.03), uses_pool=False)
+    graph.add("a", stage(events, "a", 0.02))
+    graph.add("b", stage(events, "b", 0.02))
+    await graph.run()
+
+    first, second = sorted(["a", "b"], key=lambda name: started(events, name))
+    assert ended(events, first) < started(events, second)
+    assert started(events, "lookup") < ended(events, first)  # NOTE: it doesn't take a pool slot
+    assert graph.stages[second].started - graph.stages[second].ready >= 0.015
+
+
+def test_add_validates_the_graph():
+    graph = StageGraph("test")
+    with pytest.raises(InvalidArgs):
+        graph.add("quotes", stage([], "quotes"), needs=["contracts"])
+    graph.add("contracts", stage([], "contracts"), after=["optional"])
+    assert graph.stages["contracts"].after == ()
+    assert "contracts" in graph
+    with pytest.raises(InvalidArgs):
+        graph.add("contracts", stage([], "contracts"))
+
+
+async def test_a_failed_stage_cancels_the_rest():
+    events = []
+
+    async def fail():
+        raise RuntimeError("boom")
+
+    graph = StageGraph("test")
+    graph.add("fail", fail)
+    graph.add("slow", stage(events, "slow", 10))
+    graph.add("downstream", stage(events, "downstream"), needs=["fail"])
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(graph.run(), 2)
+    assert ("end", "slow") not in events
+    assert not any(event[1] == "downstream" for event in events)
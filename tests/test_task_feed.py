@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import queue
+import time
+
+import pytest
+from data_pipeline.task_feed import TaskFeed, WAKE
+
+
+def task(tid: int) -> tuple:
+    return (tid, None, ("O:A", {"timestamp": "2025-06-03"}), {}, 1)
+
+
+async def received(feed: TaskFeed, count: int) -> list[tuple]:
+    tasks = []
+    while len(tasks) < count:
+        await asyncio.wait_for(feed.ready.wait(), 2)
+        try:
+            tasks.append(feed.get_nowait())
+        except queue.Empty:
+            pass
+    return tasks
+
+
+def drain(q) -> list:
+    items = []
+    while True:
+        try:
+            items.append(q.get(timeout=0.2))
+        except queue.Empty:
+            return items
+
+
+@pytest.fixture
+def tx():
+    return multiprocessing.Queue()
+
+
+async def test_only_takes_the_requested_tasks(tx):
+    for tid in range(1, 6):
+        tx.put(task(tid))
+    feed = TaskFeed(tx)
+    feed.request(2)
+    assert [t[0] for t in await received(feed, 2)] == [1, 2]
+    await asyncio.sleep(0.05)
+    with pytest.raises(queue.Empty):
+        feed.get_nowait()
+    assert not feed.ready.is_set()
+
+    feed.request(2)
+    feed.request(2)  # NOTE: tops up to the count, it doesn't add to it
+    assert [t[0] for t in await received(feed, 2)] == [3, 4]
+    assert await feed.close() == []
+    assert [t[0] for t in drain(tx)] == [5]  # NOTE: left on the queue for the other workers
+
+
+async def test_push_back_is_picked_up_next(tx):
+    tx.put(task(1))
+    tx.put(task(2))
+    feed = TaskFeed(tx)
+    feed.request(2)
+    first, second = await received(feed, 2)
+    feed.push_back(second)
+    feed.push_back(first)
+    assert feed.ready.is_set()
+    assert feed.get_nowait() == first
+    assert await feed.close() == [second]
+
+
+async def test_close_returns_the_tasks_not_picked_up(tx):
+    feed = TaskFeed(tx)
+    feed.request(3)
+    for tid in range(1, 4):
+        tx.put(task(tid))
+    await received(feed, 1)
+    await asyncio.sleep(0.05)
+    assert [t[0] for t in await feed.close()] == [2, 3]
+
+
+async def test_close_wakes_a_blocked_reader(tx):
+    feed = TaskFeed(tx)
+    feed.request(1)
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    assert await feed.close() == []
+    assert time.perf_counter() - start < 1
+    assert drain(tx) == []  # NOTE: the sentinel doesn't outlive the feed
+
+
+async def test_close_of_an_idle_feed_puts_no_sentinel(tx):
+    feed = TaskFeed(tx)
+    assert await feed.close() == []
+    assert drain(tx) == []
+
+
+async def test_sentinels_of_other_feeds_are_put_back(tx):
+    first, second = TaskFeed(tx), TaskFeed(tx)
+    first.request(1)
+    second.request(1)
+    await asyncio.sleep(0.05)
+    await first.close()
+    tx.put(task(1))
+    assert [t[0] for t in await received(second, 1)] == [1]
+    assert await second.close() == []
+    assert not any(isinstance(item, tuple) and item[0] == WAKE for item in drain(tx))
+
+
+async def test_backs_off_from_the_sentinel_of_another_feed():
+    class CountingQueue(queue.Queue):
+        puts = 0
+
+        def put(self, item, *args, **kwargs):
+            self.puts += 1
+            super().put(item, *args, **kwargs)
+
+    tx = CountingQueue()
+    tx.put((WAKE, 0, 0))  # NOTE: the sentinel of a feed that hasn't taken it yet
+    feed = TaskFeed(tx)
+    feed.request(1)
+    await asyncio.sleep(0.2)
+    tx.put(task(1))
+    assert [t[0] for t in await received(feed, 1)] == [1]
+    assert await feed.close() == []
+    assert tx.puts < 40
+
+
+async def test_returned_tasks_are_taken_first(tx):
+    returned = multiprocessing.Queue()
+    returned.put(task(1))
+    tx.put(task(2))
+    await asyncio.sleep(0.05)
+    feed = TaskFeed(tx, returned)
+    feed.request(2)
+    assert [t[0] for t in await received(feed, 2)] == [1, 2]
+    assert await feed.close() == []